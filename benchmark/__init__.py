@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Feb 25 15:12:39 2019
+
+@author: bdaniere
+"""
+
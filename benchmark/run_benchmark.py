@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+Benchmark of the pipeline on synthetic RPLS / building data, the geocoding API being replaced by a local stub
+To be launched from the project directory (param.json is read by the core modules) :
+
+     python -m benchmark.run_benchmark --sizes 1000:10000 100000:100000
+     python -m benchmark.run_benchmark --compare benchmark/results/old.json benchmark/results/new.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import geocoder_RPLS
+from benchmark import synthetic_data
+from core import geocode_hlm_core
+from core import import_building
+from core import post_geocodage
+from core import static_functions
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+ch_results = os.path.dirname(os.path.abspath(__file__)).replace('\\', '/') + "/results/"
+
+""" Classes / methods / functions """
+
+
+def timed(timings, step, function, *args):
+    """
+    Execute function(*args) and store its wall time in timings[step]
+
+    :return: result of function
+    """
+
+    start_time = time.time()
+    result = function(*args)
+    timings[step] = round(time.time() - start_time, 3)
+    logging.info("BENCHMARK -- {} : {} s".format(step, timings[step]))
+    return result
+
+
+def configure_pipeline(work_dir, csv_path, api_url):
+    """
+    Point the core modules to the synthetic data, the stub geocoder and a temporary output directory
+    """
+
+    geocode_hlm_core.param["data"]["csv_hlm"] = csv_path
+    geocode_hlm_core.param["data"]["list_cod_insee"] = [11262]
+    geocode_hlm_core.param["geocoding"]["use_cache"] = False
+    static_functions.param["geocoding"]["api_url"] = api_url
+
+    for module in [geocode_hlm_core, import_building, post_geocodage, geocoder_RPLS]:
+        module.ch_output = work_dir
+
+
+def run_benchmark(nb_address, nb_building):
+    """
+    Time the main steps of the pipeline for one size of synthetic data
+
+    :param nb_address: number of RPLS rows
+    :param nb_building: number of buildings
+    :return: dict {step : wall time (s)}
+    """
+
+    logging.info("BENCHMARK -- {} addresses / {} buildings".format(nb_address, nb_building))
+    timings = {}
+    work_dir = tempfile.mkdtemp(prefix="benchmark_rpls_").replace('\\', '/') + "/"
+
+    gdf_building = synthetic_data.generate_building(nb_building)
+    csv_path = work_dir + "rpls.csv"
+    synthetic_data.generate_rpls_csv(nb_address, csv_path)
+    stub_server, api_url = synthetic_data.start_stub_geocoder(gdf_building.total_bounds)
+    configure_pipeline(work_dir, csv_path, api_url)
+
+    try:
+        # Building
+        building = import_building.Building()
+        building.gdf_building = timed(timings, "clean_gdf_by_geometry", static_functions.clean_gdf_by_geometry,
+                                      gdf_building)
+        timed(timings, "process_small_building", building.process_small_building)
+
+        # Geocoding : pre-treatment alone, then complete run with the stub geocoder
+        timed(timings, "geocode_hlm_pretreatment", geocode_hlm_core.GeocodeHlm(building.gdf_building).correct_hlm_csv)
+        hlm = geocode_hlm_core.GeocodeHlm(building.gdf_building)
+        timed(timings, "geocode_hlm_run", hlm.run)
+
+        # Post geocoding
+        post_geocoding = post_geocodage.PostGeocodeData(hlm.output_gdf, building.gdf_building,
+                                                        building.get_projected_geometry())
+        timed(timings, "inside_centroid_building", post_geocoding.inside_centroid_building)
+        timed(timings, "finding_nearest_neighbour", post_geocoding.finding_nearest_neighbour)
+        timed(timings, "assign_street_result", post_geocoding.assign_street_result)
+        post_geocoding.formatting_hlm_building_output()
+        post_geocoding.drop_duplicate_geometry()
+        post_geocoding.gdf_connexion_line = timed(timings, "connect_result_point_to_line",
+                                                  post_geocoding.connect_result_point_to_line,
+                                                  post_geocoding.init_result_geocoder, post_geocoding.gdf_geom_point)
+
+        # Dashboard
+        timed(timings, "generate_dashboard", geocoder_RPLS.generate_dashboard_indicator, hlm, post_geocoding, False)
+
+    finally:
+        stub_server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return timings
+
+
+def git_revision():
+    """ Short hash of the current git revision ('unknown' outside a git repository) """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save_results(runs):
+    """
+    Save the benchmark results in ch_results/<date>_<revision>.json
+
+    :param runs: list of dict (sizes & timings)
+    :return: path of the result file
+    """
+
+    if not os.path.isdir(ch_results):
+        os.makedirs(ch_results)
+
+    revision = git_revision()
+    result_path = ch_results + "{}_{}.json".format(time.strftime("%Y%m%d_%H%M%S"), revision)
+    with open(result_path, 'w') as result_file:
+        json.dump({"revision": revision, "date": time.strftime("%Y-%m-%d %H:%M:%S"), "runs": runs}, result_file,
+                  indent=2)
+
+    logging.info("BENCHMARK -- results saved in " + result_path)
+    return result_path
+
+
+def compare_results(reference_path, new_path):
+    """
+    Print the timings of two result files, step by step, with the ratio new / reference
+    """
+
+    with open(reference_path) as reference_file, open(new_path) as new_file:
+        reference, new = json.load(reference_file), json.load(new_file)
+
+    print("{} ({}) -> {} ({})".format(reference["revision"], reference["date"], new["revision"], new["date"]))
+    reference_runs = {(run["nb_address"], run["nb_building"]): run["timings"] for run in reference["runs"]}
+
+    for run in new["runs"]:
+        size = (run["nb_address"], run["nb_building"])
+        if size not in reference_runs:
+            continue
+        print("\n{} addresses / {} buildings".format(*size))
+        for step, new_time in run["timings"].items():
+            reference_time = reference_runs[size].get(step)
+            ratio = "{:.2f}".format(new_time / reference_time) if reference_time else "-"
+            print("  {:<30} {:>10} {:>10} {:>8}".format(step, reference_time, new_time, ratio))
+
+
+"""
+PROCESS
+"""
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the pipeline on synthetic data")
+    parser.add_argument("--sizes", nargs="+", default=["1000:10000"],
+                        help="sizes to benchmark, as nb_address:nb_building")
+    parser.add_argument("--compare", nargs=2, metavar=("REFERENCE", "NEW"),
+                        help="compare two result files instead of running the benchmark")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+    else:
+        benchmark_runs = []
+        for size in args.sizes:
+            nb_address, nb_building = [int(value) for value in size.split(':')]
+            benchmark_runs.append({"nb_address": nb_address, "nb_building": nb_building,
+                                   "timings": run_benchmark(nb_address, nb_building)})
+        save_results(benchmark_runs)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+"""
+
+import hashlib
+import io
+import logging
+import threading
+from email.parser import BytesParser
+from email.policy import default
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+# Synthetic territory : Narbonne (11262)
+origin_lon, origin_lat = 3.0, 43.18
+meter_lat = 1 / 111320.
+meter_lon = 1 / (111320. * np.cos(np.radians(origin_lat)))
+
+street_types = ['RUE', 'AV', 'BD', 'CHE', 'IMP', 'PL', 'ALL']
+# Columns of the RPLS csv file, in their order
+rpls_columns = ['REG', 'LIBREG', 'DEP', 'LIBDEP', 'EPCI', 'LIBEPCI', 'DEPCOM', 'LIBCOM', 'CODEPOSTAL', 'NUMVOIE',
+                'INDREP', 'TYPVOIE', 'NOMVOIE', 'COMPLGEO', 'LIEUDIT', 'BAT', 'ESC', 'COULOIR', 'ETAGE', 'COMPLIDENT',
+                'ENTREE', 'NUMBOITE', 'IMMEU', 'NUMAPPT', 'SURFHAB', 'NEWLOGT', 'FINAN', 'FINANAUTRE', 'CONV',
+                'NUMCONV', 'DATCONV', 'DPEDATE', 'LIBSEGPATRIM', 'DROIT', 'QPV', 'SRU_EXPIR', 'SRU_ALINEA']
+
+street_names = ['DES LILAS', 'JEAN JAURES', 'DE LA REPUBLIQUE', 'DU PORT', 'DES ECOLES', 'VICTOR HUGO',
+                'DES ROSES', 'PASTEUR', 'DU MOULIN', 'DE LA GARE']
+
+""" Classes / methods / functions """
+
+
+def generate_building(nb_building, seed=0):
+    """
+    Generate a building footprint layer on a regular grid (20 m step), with ~10 % of small buildings (< 30 m²) :
+    half of them touching a bigger building (annex), the other half isolated
+
+    :param nb_building: number of buildings
+    :param seed: seed of the random generator
+    :return: gpd.GeoDataFrame (epsg : 4326) with [id, geometry]
+    """
+
+    random = np.random.RandomState(seed)
+    nb_column = int(np.ceil(np.sqrt(nb_building)))
+    position = np.arange(nb_building)
+    x_min = origin_lon + (position % nb_column) * 20 * meter_lon
+    y_min = origin_lat + (position // nb_column) * 20 * meter_lat
+
+    width = random.uniform(8, 15, nb_building)
+    height = random.uniform(8, 15, nb_building)
+
+    # Small buildings : annex (touching the previous building on its east side) or isolated
+    small = random.rand(nb_building) < 0.1
+    annex = np.flatnonzero(small & (position % 2 == 0) & (position % nb_column != 0))
+    width[small], height[small] = 4, 4
+    x_min[annex] = x_min[annex - 1] + width[annex - 1] * meter_lon
+
+    geometry = [box(x, y, x + w * meter_lon, y + h * meter_lat) for x, y, w, h in
+                zip(x_min, y_min, width, height)]
+    return gpd.GeoDataFrame({'id': position}, geometry=geometry, crs={'init': 'epsg:4326'})
+
+
+def generate_rpls_csv(nb_address, csv_path, seed=0):
+    """
+    Generate a RPLS csv file (';' separator, every column of rpls_columns) on the commune 11262,
+    with the anomalies corrected by GeocodeHlm : time format street number, street type repeated in the street name, several housing by address
+
+    :param nb_address: number of rows (housing)
+    :param csv_path: path of the output csv
+    :param seed: seed of the random generator
+    """
+
+    random = np.random.RandomState(seed)
+    nb_unique_address = max(nb_address // 3, 1)
+    address = random.randint(0, nb_unique_address, nb_address)
+
+    numvoie = (address % 150 + 1).astype(str).astype(object)
+    time_format = random.rand(nb_address) < 0.01
+    numvoie[time_format] = ['{}:00 AM'.format(num) for num in numvoie[time_format]]
+
+    typvoie = np.array(street_types, dtype=object)[address % len(street_types)]
+    nomvoie = np.array(street_names, dtype=object)[(address // 150) % len(street_names)]
+    duplicate_type = random.rand(nb_address) < 0.02
+    nomvoie[duplicate_type] = typvoie[duplicate_type] + ' ' + nomvoie[duplicate_type]
+
+    df_rpls = pd.DataFrame({'REG': 76, 'LIBREG': 'Occitanie', 'DEP': 11, 'LIBDEP': 'Aude', 'EPCI': 241100593,
+                            'LIBEPCI': 'CA Le Grand Narbonne', 'DEPCOM': 11262, 'LIBCOM': 'NARBONNE',
+                            'CODEPOSTAL': 11100, 'NUMVOIE': numvoie, 'INDREP': '', 'TYPVOIE': typvoie,
+                            'NOMVOIE': nomvoie, 'COMPLGEO': '', 'LIEUDIT': '', 'BAT': 'A', 'ESC': '', 'COULOIR': '',
+                            'ETAGE': random.randint(0, 8, nb_address), 'COMPLIDENT': '', 'ENTREE': '',
+                            'NUMBOITE': '', 'IMMEU': address, 'NUMAPPT': np.arange(nb_address),
+                            'SURFHAB': random.randint(20, 120, nb_address), 'NEWLOGT': 0, 'FINAN': 13,
+                            'FINANAUTRE': '', 'CONV': 1, 'NUMCONV': '', 'DATCONV': '', 'DPEDATE': '',
+                            'LIBSEGPATRIM': '', 'DROIT': 1, 'QPV': 0, 'SRU_EXPIR': '', 'SRU_ALINEA': ''},
+                           columns=rpls_columns)
+    df_rpls.to_csv(csv_path, sep=';', index=False, encoding='utf-8')
+
+
+class StubGeocoderHandler(BaseHTTPRequestHandler):
+    """
+    Local stub of the api-adresse /search/csv/ endpoint : every row of the posted csv is returned with
+    latitude / longitude (deterministic, in the bbox of the class attribute) and result_* fields
+    """
+
+    bbox = (origin_lon, origin_lat, origin_lon + 0.01, origin_lat + 0.01)
+
+    def posted_csv(self):
+        """ pd.DataFrame (str columns) of the posted csv """
+
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        message = BytesParser(policy=default).parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode('utf-8') + b'\r\n\r\n' + body)
+        data = [part.get_payload(decode=True) for part in message.iter_parts()
+                if part.get_param('name', header='content-disposition') == 'data'][0]
+        return pd.read_csv(io.BytesIO(data), sep=';', dtype=str, keep_default_na=False)
+
+    def geocode(self, df):
+        """ Add the geocoding fields to the posted addresses """
+
+        address = df.NUMVOIE + ' ' + df.TYPVOIE + ' ' + df.NOMVOIE
+        address_hash = np.array([int(hashlib.md5(value.encode('utf-8')).hexdigest()[:8], 16) for value in address])
+
+        xmin, ymin, xmax, ymax = self.bbox
+        df['latitude'] = ymin + (address_hash % 10007) / 10007. * (ymax - ymin)
+        df['longitude'] = xmin + (address_hash % 10009) / 10009. * (xmax - xmin)
+        df['result_label'] = address + ' 11100 Narbonne'
+        df['result_score'] = np.round(0.5 + (address_hash % 50) / 100., 2)
+        df['result_type'] = np.where(address_hash % 10 == 0, 'street', 'housenumber')
+        df['result_citycode'] = df.DEPCOM
+        return df
+
+    def send_csv(self, df):
+        """ Send a DataFrame as the csv response """
+
+        response = df.to_csv(sep=';', index=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def do_POST(self):
+        self.send_csv(self.geocode(self.posted_csv()))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_geocoder(bbox, handler_class=StubGeocoderHandler):
+    """
+    Start the stub geocoder in a background thread
+
+    :param bbox: (xmin, ymin, xmax, ymax) of the returned coordinates (epsg : 4326)
+    :param handler_class: request handler of the stub (StubGeocoderHandler or a subclass)
+    :return: ThreadingHTTPServer (call shutdown() to stop it) & url of the /search/csv/ endpoint
+    """
+
+    handler_class.bbox = tuple(bbox)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    url = "http://127.0.0.1:{}/search/csv/".format(server.server_address[1])
+    logging.info("Stub geocoder listening on " + url)
+    return server, url
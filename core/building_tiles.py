@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+"""
+
+import glob
+import logging
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+""" Classes / methods / functions """
+
+
+def tile_grid(bounds, tile_size):
+    """
+    Split a bbox in a grid of square tiles
+
+    :param bounds: (xmin, ymin, xmax, ymax) in a projected CRS
+    :param tile_size: size of a tile (in the CRS unit)
+    :return: list of (xmin, ymin, xmax, ymax)
+    """
+
+    xmin, ymin, xmax, ymax = bounds
+    return [(x, y, x + tile_size, y + tile_size) for x in np.arange(xmin, xmax, tile_size)
+            for y in np.arange(ymin, ymax, tile_size)]
+
+
+def bounds_to_crs(bounds, from_crs, to_crs):
+    """
+    Bbox containing a bbox once reprojected
+
+    :return: (xmin, ymin, xmax, ymax) in to_crs
+    """
+    return tuple(gpd.GeoSeries([box(*bounds)], crs=from_crs).to_crs(to_crs).total_bounds)
+
+
+def geometry_id(gdf):
+    """
+    Identifier of each building computed from its geometry (64-bit hash of the WKB) : the same building read by
+    two tiles gets the same identifier
+
+    :param gdf: gpd.GeoDataFrame
+    :return: np.array of int64
+    """
+    return pd.util.hash_array(np.array([geom.wkb for geom in gdf.geometry], dtype=object)).astype(np.int64)
+
+
+def owned_by_tile(gdf, tile, crs):
+    """
+    A building is owned by the tile containing its representative point (a half-open [xmin, xmax) x [ymin, ymax)
+    interval, so that each building is owned by exactly one tile)
+
+    :param gdf: gpd.GeoDataFrame of the buildings read by the tile (core & halo)
+    :param tile: (xmin, ymin, xmax, ymax) in crs
+    :param crs: projected CRS of the tile grid
+    :return: np.array of bool
+    """
+
+    xmin, ymin, xmax, ymax = tile
+    point = gdf.geometry.representative_point().to_crs(crs)
+    x, y = point.x.values, point.y.values
+    return (x >= xmin) & (x < xmax) & (y >= ymin) & (y < ymax)
+
+
+def largest_footprint_size(gdf, crs):
+    """
+    Largest width or height of the building footprints : a building wider than the halo of the tiles can adjoin
+    small buildings which are not read by its tile
+
+    :param gdf: gpd.GeoDataFrame of buildings
+    :param crs: projected CRS of the tile grid
+    :return: float (in the CRS unit), 0 if gdf is empty
+    """
+
+    if gdf.empty:
+        return 0.
+    bounds = gdf.geometry.to_crs(crs).bounds
+    return float(np.maximum(bounds.maxx - bounds.minx, bounds.maxy - bounds.miny).max())
+
+
+class TileSpill:
+    """
+    Intermediate results of the tiles written to disk (pickle), so that only one tile is held in memory
+    """
+
+    def __init__(self, tile_dir):
+        """
+        Constructor of the class : the results of a previous run are removed
+
+        :param tile_dir: directory of the tile results
+        """
+
+        self.tile_dir = tile_dir
+        if not os.path.isdir(self.tile_dir):
+            os.makedirs(self.tile_dir)
+        for old_tile in glob.glob(os.path.join(self.tile_dir, "tile_*.pkl")):
+            os.remove(old_tile)
+
+    def write(self, gdf, tile_index):
+        """ Write the result of a tile """
+        gdf.to_pickle(os.path.join(self.tile_dir, "tile_{:06d}.pkl".format(tile_index)))
+
+    def read_all(self, crs):
+        """
+        Read and concatenate the results of every tile
+
+        :param crs: CRS of the tile results
+        :return: gpd.GeoDataFrame
+        """
+
+        tile_paths = sorted(glob.glob(os.path.join(self.tile_dir, "tile_*.pkl")))
+        if not tile_paths:
+            return gpd.GeoDataFrame(columns=['id', 'geometry'], crs=crs)
+
+        gdf = gpd.GeoDataFrame(pd.concat([pd.read_pickle(tile_path) for tile_path in tile_paths]), crs=crs)
+        gdf.index = gdf.id
+        return gdf
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+"""
+
+import glob
+import hashlib
+import logging
+import os
+import pickle
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+# Ordered stages of the pipeline
+stages = ['building', 'geocoding', 'post_geocoding', 'dashboard']
+
+""" Classes / methods / functions """
+
+
+def hash_file(file_path, block_size=1048576):
+    """
+    Content hash of a file, read by blocks
+
+    :param file_path: path of the file
+    :param block_size: number of bytes read by block
+    :return: str - sha256 hex digest
+    """
+
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class StageCheckpoint:
+    """
+    Checkpoint of the pipeline stages : the result of each stage is saved (pickle) under a key
+    hashing param.json, the input files of the stage (or the key of a source which is not a file, see source_key)
+    and the key of the previous stage
+    A stage whose key has not changed is read from its checkpoint instead of being computed
+    """
+
+    def __init__(self, checkpoint_dir, param_path, from_stage=None):
+        """
+        Constructor of the class
+
+        :param checkpoint_dir: directory of the checkpoint files
+        :param param_path: path of param.json
+        :param from_stage: name of the first stage to compute again, even if its checkpoint exists
+        """
+
+        assert from_stage is None or from_stage in stages, "the stage must be one of {}".format(stages)
+
+        self.checkpoint_dir = checkpoint_dir
+        self.from_stage = from_stage
+        self.previous_key = hash_file(param_path)
+
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+    def stage_key(self, stage, input_paths, source_key=''):
+        """
+        Key of a stage : hash of the previous stage key, the stage name, the content of its input files
+        and the key of its source
+
+        :param stage: name of the stage
+        :param input_paths: list of the input files of the stage
+        :param source_key: str identifying the content of a source which is not a file (database table, download)
+        :return: str - sha256 hex digest
+        """
+
+        stage_hash = hashlib.sha256((self.previous_key + stage + source_key).encode('utf-8'))
+        for input_path in sorted(input_paths):
+            stage_hash.update(hash_file(input_path).encode('utf-8'))
+        return stage_hash.hexdigest()
+
+    def run(self, stage, input_paths, function, *args, source_key=''):
+        """
+        Read the stage result from its checkpoint, or compute it with function(*args) and save it
+
+        :param stage: name of the stage
+        :param input_paths: list of the input files of the stage
+        :param function: function computing the stage result
+        :param source_key: str identifying the content of a source which is not a file (see stage_key)
+        :return: stage result
+        """
+
+        key = self.stage_key(stage, input_paths, source_key)
+        self.previous_key = key
+        checkpoint_path = os.path.join(self.checkpoint_dir, "{}_{}.pkl".format(stage, key[:16]))
+
+        forced = self.from_stage is not None and stages.index(stage) >= stages.index(self.from_stage)
+        if not forced and os.path.isfile(checkpoint_path):
+            logging.info("Stage '{}' : inputs unchanged - read checkpoint {}".format(stage, checkpoint_path))
+            with open(checkpoint_path, 'rb') as checkpoint_file:
+                return pickle.load(checkpoint_file)
+
+        result = function(*args)
+
+        # Only the last checkpoint of a stage is kept
+        for old_checkpoint in glob.glob(os.path.join(self.checkpoint_dir, stage + "_*.pkl")):
+            os.remove(old_checkpoint)
+        with open(checkpoint_path, 'wb') as checkpoint_file:
+            pickle.dump(result, checkpoint_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        return result
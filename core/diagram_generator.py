@@ -10,8 +10,10 @@ import logging
 from math import pi
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-from bokeh.models import ColumnDataSource
+from bokeh.layouts import column
+from bokeh.models import ColumnDataSource, DataTable, Div, TableColumn
 from bokeh.palettes import Category20c
 from bokeh.plotting import figure
 from bokeh.tile_providers import get_provider, Vendors
@@ -24,6 +26,10 @@ Globals variables activate bd
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
 
+# Attributes displayed by the map tooltips (the other attributes are not embedded in the dashboard)
+tooltip_columns = [('result_label', 'Adresse'), ('nb', 'Nombre adresse'), ('result_type', 'Type geocodage'),
+                   ('result_score', 'Score de geocodage'), ('SURFHAB', 'surface habitable (HLM)')]
+
 """ Classes / methods / functions """
 
 
@@ -152,31 +158,65 @@ class BokehBarChart(BokehChart):
         self.generate_chart()
 
 
+class BokehPerformanceTable:
+    """
+    class for creating a bokeh table of the pipeline performance
+    :param records: list of dict (core.profiling.records)
+    """
+
+    def __init__(self, title, records):
+        self.title = title
+        self.data = pd.DataFrame(records)
+        self.chart = Div()
+
+    def generate_chart(self):
+        """
+        Generation of the bokeh.models.DataTable (with its title) of the measures of each step
+        """
+
+        columns = [TableColumn(field="step", title=u"Étape"),
+                   TableColumn(field="wall_time_s", title=u"Durée (s)"),
+                   TableColumn(field="cpu_time_s", title=u"Temps CPU (s)"),
+                   TableColumn(field="peak_rss_mb", title=u"Pic mémoire (Mo)"),
+                   TableColumn(field="rows", title=u"Nombre de lignes")]
+        table = DataTable(source=ColumnDataSource(self.data), columns=columns, width=1200,
+                          height=30 + 25 * len(self.data), index_position=None)
+
+        self.chart = column(Div(text=u"<b style='color:olive'>{}</b>".format(self.title)), table)
+
+    def run(self):
+        self.generate_chart()
+
+
 class BokehMap:
     """
     class for creating a bokeh map figure
     :param gdf: Input GeoDataFrame (Point)
+    :param max_feature_detail: number of features of a layer above which the layer is aggregated (points),
+                               simplified (polygons) or not displayed (lines) - None : always full detail
+    :param hexbin_size_m: size (in meters) of the hexagons aggregating the points
+    :param simplify_tolerance_px: tolerance (in pixels at the extent of the layer) of the simplified polygons
+    :param aggregate_polygons: the polygon layers which are not detailed are aggregated by hexagon (as the points)
+                               instead of being simplified
     """
 
-    def __init__(self, title, gdf, data_name):
+    def __init__(self, title, gdf, data_name, max_feature_detail=None, hexbin_size_m=150, simplify_tolerance_px=1,
+                 aggregate_polygons=False):
         self.data = gdf
-        self.data = self.data.to_crs(epsg='3857')
         self.chart = figure()
         self.title = title
         self.data_name = data_name
+        self.max_feature_detail = max_feature_detail
+        self.hexbin_size_m = hexbin_size_m
+        self.simplify_tolerance_px = simplify_tolerance_px
+        self.aggregate_polygons = aggregate_polygons
 
     def create_map_bokeh_figure(self):
         """
         creation of the cartographic figure to welcome the data
         """
 
-        TOOLTIPS = [
-            ('Adresse', '@result_label'),
-            ('Nombre adresse', "@nb"),
-            ('Type geocodage', '@result_type'),
-            ("Score de geocodage", "@result_score"),
-            ("surface habitable (HLM)", "@SURFHAB")
-        ]
+        TOOLTIPS = [(label, '@' + column) for column, label in tooltip_columns]
         tile_provider = get_provider(Vendors.CARTODBPOSITRON)
         self.chart = figure(title=self.title, plot_width=800, plot_height=600, x_axis_type="mercator",
                             y_axis_type="mercator",
@@ -191,115 +231,239 @@ class BokehMap:
         self.chart.outline_line_alpha = 0.3
         self.chart.outline_line_color = "navy"
 
+    def is_detailed(self, gdf):
+        """ True if the layer gdf is small enough to be displayed with full detail """
+        return self.max_feature_detail is None or len(gdf) <= self.max_feature_detail
+
     def add_first_layer_to_map(self, fill_color, line_color):
         """ Add data in self.chart"""
-        bokeh_data = ColumnDataSource(self.data)
-        self.chart.circle('x', 'y', source=bokeh_data, fill_color=fill_color, line_color=line_color, size=10,
-                          legend=self.data_name)
-        self.chart.legend.click_policy = "hide"
+        add_point_layer(self, self.data, self.data_name, fill_color, line_color)
 
     def init_map(self):
         """ Execution of the different methods of the class """
-        self.data = gdf_geometry_to_xy(self.data)
         self.create_map_bokeh_figure()
 
 
 # Static function for Bokeh Map
-def gdf_geometry_to_xy(data):
+def lonlat_to_mercator(lon, lat):
     """
-    Transform the self.data.geometry to x & y field
-    Drop the initial geometry
+    Projection of longitude / latitude arrays (epsg : 4326) to Web Mercator (epsg : 3857)
 
-    :param data: input gpd.GeoDataFrame (Point) to display the Dashboard cartography box
-    :return: data formatting for displaying in Dashboard cartography box
+    :param lon: np.array of longitude
+    :param lat: np.array of latitude
+    :return: np.array of x & np.array of y (epsg : 3857)
     """
+    earth_radius = 6378137.0
+    x = np.radians(lon) * earth_radius
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * earth_radius
+    return x, y
 
-    assert type(data) == gpd.geodataframe.GeoDataFrame, "input data for generation of" \
-                                                        "Bokeh mapping is not GeoDataFrame type"
 
-    data['x'] = data.apply(get_point_coords, geom='geometry', coord_type='x', axis=1)
-    data['y'] = data.apply(get_point_coords, geom='geometry', coord_type='y', axis=1)
-    data = data.drop('geometry', axis=1).copy()
+def geometry_to_rings(geometry):
+    """
+    Decomposition of a geometry in parts, each part being a list of coordinate sequences
+    (Point / LineString : one sequence, Polygon : exterior then interiors, Multi* : one part by geometry)
+
+    :param geometry: shapely geometry
+    :return: list of list of coordinate sequence
+    """
+
+    if geometry is None or geometry.is_empty:
+        return []
+    if geometry.geom_type in ['Point', 'LineString', 'LinearRing']:
+        return [[geometry.coords]]
+    if geometry.geom_type == 'Polygon':
+        return [[geometry.exterior.coords] + [interior.coords for interior in geometry.interiors]]
+
+    # MultiPoint / MultiLineString / MultiPolygon / GeometryCollection
+    return [rings for part in geometry.geoms for rings in geometry_to_rings(part)]
+
 
-    return data
+def sequence_to_array(sequence):
+    """ x / y coordinates of a shapely coordinate sequence as np.array of shape (n, 2) """
+    array = np.asarray(sequence, dtype=float)
+    return array[:, :2] if array.ndim == 2 else np.empty((0, 2))
 
 
-def get_point_coords(row, geom, coord_type):
+def gdf_to_mercator_coords(gdf):
     """
-    Calculates coordinates ('x' or 'y') of a Point geometry
-    source : https://automating-gis-processes.github.io/2018/2017/lessons/L5/interactive-map-bokeh.html
+    Extraction of the coordinates of every geometry of gdf in one pass :
+    all the coordinate sequences are stacked in one buffer, projected to epsg 3857 at once, then split by
+    geometry / part / ring
+
+    :param gdf: gpd.GeoDataFrame (any geometry type)
+    :return: xs, ys : list (by geometry) of list (by part) of list (by ring) of np.array
     """
-    if coord_type == 'x':
-        return row[geom].x
-    elif coord_type == 'y':
-        return row[geom].y
 
+    geoseries = to_wgs84(gdf.geometry)
+
+    ring_arrays, ring_count_by_part, part_count_by_geometry = [], [], []
+    for geometry in geoseries:
+        parts = geometry_to_rings(geometry)
+        part_count_by_geometry.append(len(parts))
+        for rings in parts:
+            ring_count_by_part.append(len(rings))
+            ring_arrays.extend(sequence_to_array(ring) for ring in rings)
+
+    coords = np.concatenate(ring_arrays) if ring_arrays else np.empty((0, 2))
+    x, y = lonlat_to_mercator(coords[:, 0], coords[:, 1])
+    ring_end = np.cumsum([len(ring) for ring in ring_arrays], dtype=int)
+
+    def nest(values):
+        """ Split the flat buffer by ring, then group the rings by part and the parts by geometry """
+        rings = np.split(values, ring_end[:-1])
+        nested, ring_position, part_position = [], 0, 0
+        for part_count in part_count_by_geometry:
+            geometry_parts = []
+            for ring_count in ring_count_by_part[part_position:part_position + part_count]:
+                geometry_parts.append(rings[ring_position:ring_position + ring_count])
+                ring_position += ring_count
+            part_position += part_count
+            nested.append(geometry_parts)
+        return nested
 
-def getLineCoords(row, geom, coord_type):
+    return nest(x), nest(y)
+
+
+def join_parts_with_nan(geometry_parts):
+    """ Concatenation of the first ring of each part, separated by nan values (multi-part line for bokeh) """
+    arrays = [array for part in geometry_parts for array in (part[0], [np.nan])][:-1]
+    return np.concatenate(arrays) if arrays else np.array([])
+
+
+def to_wgs84(geoseries):
+    """ Re-projection of a GeoSeries to epsg 4326 (if needed) """
+    if geoseries.crs is not None and geoseries.crs.to_epsg() != 4326:
+        return geoseries.to_crs(epsg=4326)
+    return geoseries
+
+
+def gdf_to_column_data(gdf):
+    """
+    Tooltip attributes of gdf as a dict of np.array, for bokeh.models.ColumnDataSource
+    """
+    return {column: gdf[column].values for column, label in tooltip_columns if column in gdf.columns}
+
+
+def simplify_for_extent(gdf, plot_width, tolerance_px=1):
+    """
+    Simplification of the geometries with a tolerance of tolerance_px pixels of the map at the extent of the layer
+    (the details smaller than a pixel are not visible without zooming)
+    The topology is preserved : a footprint smaller than the tolerance keeps a simplified ring instead of
+    collapsing, and a geometry whose simplification is empty keeps its initial geometry
+
+    :param gdf: gpd.GeoDataFrame (Polygon)
+    :param plot_width: width of the map (in pixels)
+    :param tolerance_px: tolerance (in pixels), increased when the dashboard is generated again with less detail
+    :return: gpd.GeoDataFrame (epsg : 4326) with simplified geometries
+    """
+
+    geoseries = to_wgs84(gdf.geometry)
+    xmin, ymin, xmax, ymax = geoseries.total_bounds
+    tolerance = max(xmax - xmin, ymax - ymin) * tolerance_px / plot_width
+
+    simplified = geoseries.simplify(tolerance, preserve_topology=True)
+    simplified = gpd.GeoSeries([geometry if simplified_geometry.is_empty else simplified_geometry
+                                for geometry, simplified_geometry in zip(geoseries, simplified)],
+                               index=geoseries.index, crs=geoseries.crs)
+
+    gdf = gdf.set_geometry(simplified)
+    logging.info("-- {} polygons simplified (tolerance : {:.6f} degree)".format(len(gdf), tolerance))
+    return gdf
+
+
+def add_point_layer(obj_bokeh_map, gdf, data_name, fill_color, line_color):
     """
-    Returns a list of coordinates ('x' or 'y') of a LineString geometry
-    source : https://automating-gis-processes.github.io/2018/2017/lessons/L5/interactive-map-bokeh.html
+    Add a point layer to the map : circles if the layer is small enough, else hexagon aggregates (hexbin)
+
+    :param obj_bokeh_map: BokehMap
+    :param gdf: gpd.GeoDataFrame (Point / MultiPoint)
     """
-    if coord_type == 'x':
-        return list(row[geom].coords.xy[0])
-    elif coord_type == 'y':
-        return list(row[geom].coords.xy[1])
+
+    column_data = gdf_geometry_to_xy(gdf)
+
+    if obj_bokeh_map.is_detailed(gdf):
+        obj_bokeh_map.chart.circle('x', 'y', source=ColumnDataSource(column_data), fill_color=fill_color,
+                                   line_color=line_color, size=10, legend=data_name)
+    else:
+        logging.info("-- {} points of '{}' aggregated by hexagon".format(len(gdf), data_name))
+        obj_bokeh_map.chart.hexbin(column_data['x'], column_data['y'], size=obj_bokeh_map.hexbin_size_m,
+                                   palette="Oranges9", line_color=None, fill_alpha=0.7,
+                                   legend=data_name + u" (agrégé)")
+
+    obj_bokeh_map.chart.legend.click_policy = "hide"
 
 
-def getPolyCoords(row, geom, coord_type):
+def gdf_geometry_to_xy(data):
     """
-    Returns the coordinates ('x' or 'y') of edges of a Polygon exterior
-    source : https://automating-gis-processes.github.io/2018/2017/lessons/L5/interactive-map-bokeh.html
+    Transform the data.geometry (Point) to x & y arrays (epsg : 3857)
+    Drop the initial geometry
+
+    :param data: input gpd.GeoDataFrame (Point) to display the Dashboard cartography box
+    :return: dict of np.array formatting for displaying in Dashboard cartography box (ColumnDataSource)
     """
-    # ATTENTION, les coordonnées prise en compte sont uniquement les coordonnées extérieur
-    # (donc pas les polygon a trous)
 
-    # Parse the exterior of the coordinate
-    exterior = row[geom].exterior
+    assert type(data) == gpd.geodataframe.GeoDataFrame, "input data for generation of" \
+                                                        "Bokeh mapping is not GeoDataFrame type"
+
+    geoseries = to_wgs84(data.geometry)
+    column_data = gdf_to_column_data(data)
+    if (data.geom_type == 'Point').all():
+        column_data['x'], column_data['y'] = lonlat_to_mercator(geoseries.x.values, geoseries.y.values)
+        return column_data
 
-    if coord_type == 'x':
-        # Get the x coordinates of the exterior
-        return list(exterior.coords.xy[0])
-    elif coord_type == 'y':
-        # Get the y coordinates of the exterior
-        return list(exterior.coords.xy[1])
+    # MultiPoint : one row by point, the attributes being repeated
+    xs, ys = gdf_to_mercator_coords(data)
+    point_count = [len(parts) for parts in xs]
+    column_data = {column: np.repeat(values, point_count) for column, values in column_data.items()}
+    column_data['x'] = np.array([part[0][0] for parts in xs for part in parts])
+    column_data['y'] = np.array([part[0][0] for parts in ys for part in parts])
+    return column_data
 
 
 def add_new_data_in_bokeh_map(obj_bokeh_map, gdf, data_name, fill_color, line_color):
-    # check if input gdf is type gpd.GeoDataFrame and re project to epsg 3857
+    # check if input gdf is type gpd.GeoDataFrame
     assert type(gdf) == gpd.geodataframe.GeoDataFrame, "input data for generation of Bokeh mapping" \
                                                        "is not GeoDataFrame type"
-    gdf = gdf.to_crs(epsg='3857')
 
     # specific treatment depending on the type of geometry
-    if gdf.geom_type.max() == 'Point':
-        gdf = gdf_geometry_to_xy(gdf)
+    geom_type = gdf.geom_type.max()
 
-        bokeh_data = ColumnDataSource(gdf)
-        obj_bokeh_map.chart.circle('x', 'y', source=bokeh_data, fill_color=fill_color, line_color=line_color, size=10,
-                                   legend=data_name)
-        obj_bokeh_map.chart.legend.click_policy = "hide"
+    if geom_type in ['Point', 'MultiPoint']:
+        add_point_layer(obj_bokeh_map, gdf, data_name, fill_color, line_color)
 
-    elif gdf.geom_type.max() == 'LineString':
-        # Keep only gdf geometry for geometry transformation
-        temp_gdf = gpd.GeoDataFrame(gdf.geometry)
+    elif geom_type in ['LineString', 'MultiLineString'] and not obj_bokeh_map.is_detailed(gdf):
+        logging.warning("-- '{}' is not displayed : {} lines (full detail only below {} features)".format(
+            data_name, len(gdf), obj_bokeh_map.max_feature_detail))
 
-        gdf['x'] = temp_gdf.apply(getLineCoords, geom='geometry', coord_type='x', axis=1)
-        gdf['y'] = temp_gdf.apply(getLineCoords, geom='geometry', coord_type='y', axis=1)
-        gdf = gdf.drop('geometry', axis=1)
+    elif geom_type in ['LineString', 'MultiLineString']:
+        # the parts of a MultiLineString are separated by nan values
+        xs, ys = gdf_to_mercator_coords(gdf)
+        column_data = gdf_to_column_data(gdf)
+        column_data['x'] = [join_parts_with_nan(geometry_parts) for geometry_parts in xs]
+        column_data['y'] = [join_parts_with_nan(geometry_parts) for geometry_parts in ys]
 
-        bokeh_data = ColumnDataSource(gdf)
+        bokeh_data = ColumnDataSource(column_data)
         obj_bokeh_map.chart.multi_line('x', 'y', source=bokeh_data, color='red', line_width=0.5, legend=data_name)
         obj_bokeh_map.chart.legend.click_policy = "hide"
 
-    elif gdf.geom_type.max() == 'Polygon':
-        gdf['x'] = gdf.apply(getPolyCoords, geom='geometry', coord_type='x', axis=1)
-        gdf['y'] = gdf.apply(getPolyCoords, geom='geometry', coord_type='y', axis=1)
-        gdf = gdf.drop('geometry', axis=1)
+    elif geom_type in ['Polygon', 'MultiPolygon'] and not obj_bokeh_map.is_detailed(gdf) and \
+            obj_bokeh_map.aggregate_polygons:
+        logging.info("-- {} polygons of '{}' aggregated by hexagon".format(len(gdf), data_name))
+        add_point_layer(obj_bokeh_map, gdf.set_geometry(to_wgs84(gdf.geometry).representative_point()), data_name,
+                        fill_color, line_color)
+
+    elif geom_type in ['Polygon', 'MultiPolygon']:
+        # multi_polygons : one list of parts by feature, each part being [exterior, interiors...]
+        if not obj_bokeh_map.is_detailed(gdf):
+            gdf = simplify_for_extent(gdf, obj_bokeh_map.chart.plot_width, obj_bokeh_map.simplify_tolerance_px)
+
+        column_data = gdf_to_column_data(gdf)
+        column_data['x'], column_data['y'] = gdf_to_mercator_coords(gdf)
 
-        bokeh_data = ColumnDataSource(gdf)
-        obj_bokeh_map.chart.patches('x', 'y', source=bokeh_data, fill_color=fill_color, line_color=line_color,
-                                    line_width=0.2, legend=data_name)
+        bokeh_data = ColumnDataSource(column_data)
+        obj_bokeh_map.chart.multi_polygons('x', 'y', source=bokeh_data, fill_color=fill_color,
+                                           line_color=line_color, line_width=0.2, legend=data_name)
         obj_bokeh_map.chart.legend.click_policy = "hide"
 
     else:
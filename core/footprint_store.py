@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+"""
+
+import json
+import logging
+import os
+
+import geopandas as gpd
+import numpy as np
+from pyproj import Transformer
+from shapely.geometry import MultiPolygon, Polygon
+
+try:
+    # shapely >= 2 : vectorised construction of the polygons
+    from shapely import linearrings as shapely_linearrings, polygons as shapely_polygons
+except ImportError:
+    shapely_linearrings, shapely_polygons = None, None
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+# Arrays of the store, saved in <name>.npy
+store_arrays = ['ids', 'coords', 'projected_coords', 'ring_offsets', 'polygon_offsets', 'building_offsets', 'bounds',
+                'cell_offsets', 'cell_items']
+# Version of the store layout : a store written by another version is written again
+store_version = 2
+
+""" Classes / methods / functions """
+
+
+def geometry_to_rings(geometry):
+    """
+    Rings of a Polygon / MultiPolygon
+
+    :return: list of polygons, each one being a list of rings (exterior first) as np.array of shape (n, 2)
+    """
+
+    polygons = geometry.geoms if isinstance(geometry, MultiPolygon) else [geometry]
+    return [[np.asarray(polygon.exterior.coords)[:, :2]] + [np.asarray(ring.coords)[:, :2] for ring in
+                                                            polygon.interiors] for polygon in polygons]
+
+
+def grid_index(bounds, grid_size):
+    """
+    Uniform grid index of bboxes : each bbox is listed in every cell it overlaps (CSR arrays)
+
+    :param bounds: np.array of shape (n, 4)
+    :param grid_size: number of cells along each axis
+    :return: dict of the grid parameters, np.array of cell offsets & np.array of cell items (bbox positions)
+    """
+
+    xmin, ymin = bounds[:, 0].min(), bounds[:, 1].min()
+    cell_width = max((bounds[:, 2].max() - xmin) / grid_size, 1e-9)
+    cell_height = max((bounds[:, 3].max() - ymin) / grid_size, 1e-9)
+    grid = {"xmin": float(xmin), "ymin": float(ymin), "cell_width": float(cell_width),
+            "cell_height": float(cell_height), "grid_size": int(grid_size)}
+
+    ix0, iy0, ix1, iy1 = [np.clip(((bounds[:, column] - origin) / size).astype(np.int64), 0, grid_size - 1) for
+                          column, origin, size in [(0, xmin, cell_width), (1, ymin, cell_height),
+                                                   (2, xmin, cell_width), (3, ymin, cell_height)]]
+
+    # One (cell, bbox) pair by overlapped cell
+    nx = ix1 - ix0 + 1
+    nb_cell = nx * (iy1 - iy0 + 1)
+    position = np.repeat(np.arange(len(bounds)), nb_cell)
+    local = np.arange(nb_cell.sum()) - np.repeat(np.cumsum(nb_cell) - nb_cell, nb_cell)
+    cell = (iy0[position] + local // nx[position]) * grid_size + ix0[position] + local % nx[position]
+
+    order = np.argsort(cell, kind='mergesort')
+    cell_offsets = np.searchsorted(cell[order], np.arange(grid_size * grid_size + 1))
+    return grid, cell_offsets, position[order]
+
+
+def simple_polygons(coords, start, end):
+    """
+    Polygons without hole from slices of a coordinate buffer
+
+    :param coords: np.array of shape (n, 2)
+    :param start: np.array of the first coordinate of each polygon
+    :param end: np.array of the coordinate following the last one of each polygon
+    :return: list of Polygon
+    """
+
+    if shapely_polygons is None:
+        return [Polygon(np.asarray(coords[first:last])) for first, last in zip(start, end)]
+
+    length = end - start
+    ring_index = np.repeat(np.arange(len(start)), length)
+    point = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length) + np.repeat(start, length)
+    return list(shapely_polygons(shapely_linearrings(np.asarray(coords[point]), indices=ring_index)))
+
+
+class FootprintStore:
+    """
+    Preprocessed building footprints : coordinate buffers (epsg 4326 and projected CRS) with ring / polygon / building
+    offset arrays and a persisted grid spatial index, saved as .npy files and opened as memory maps
+    Opening the store neither parses nor reprojects the layer, the geometries are only built for the buildings used,
+    and the pages are shared by the processes opening the same store (batch workers)
+    """
+
+    def __init__(self, store_dir):
+        """
+        Constructor of the class : open the arrays of the store as memory maps
+
+        :param store_dir: directory of the store
+        """
+
+        with open(os.path.join(store_dir, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        for name in store_arrays:
+            setattr(self, name, np.load(os.path.join(store_dir, name + ".npy"), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def is_up_to_date(store_dir, source_key):
+        """ The store exists and has been written from the same source """
+
+        meta_path = os.path.join(store_dir, "meta.json")
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        return meta.get("store_version") == store_version and meta.get("source_key") == source_key
+
+    @staticmethod
+    def write(store_dir, gdf, source_key, projected_epsg):
+        """
+        Write a building layer in the store
+
+        :param store_dir: directory of the store
+        :param gdf: gpd.GeoDataFrame (epsg : 4326) with [id, geometry] (Polygon / MultiPolygon)
+        :param source_key: str identifying the source of the layer (see is_up_to_date)
+        :param projected_epsg: epsg of the projected coordinates of the store (param["global"]["epsg"])
+        """
+
+        logging.info("-- write the footprint store ({} buildings)".format(len(gdf)))
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+
+        # meta.json is written last : an interrupted writing leaves an invalid store
+        meta_path = os.path.join(store_dir, "meta.json")
+        if os.path.isfile(meta_path):
+            os.remove(meta_path)
+
+        coords, ring_offsets, polygon_offsets, building_offsets = [], [0], [0], [0]
+        for geometry in gdf.geometry:
+            for polygon in geometry_to_rings(geometry):
+                for ring in polygon:
+                    coords.append(ring)
+                    ring_offsets.append(ring_offsets[-1] + len(ring))
+                polygon_offsets.append(polygon_offsets[-1] + len(polygon))
+            building_offsets.append(len(polygon_offsets) - 1)
+
+        # The coordinates are projected in one call, with the same offsets
+        coords = np.concatenate(coords) if coords else np.zeros((0, 2))
+        projected_crs = "epsg:" + str(projected_epsg)
+        projected_x, projected_y = Transformer.from_crs("epsg:4326", projected_crs, always_xy=True).transform(
+            coords[:, 0], coords[:, 1])
+
+        ids = gdf.id.values
+        arrays = {'ids': ids.astype(np.int64) if np.issubdtype(ids.dtype, np.integer) else ids.astype(str),
+                  'coords': coords,
+                  'projected_coords': np.column_stack([projected_x, projected_y]),
+                  'ring_offsets': np.array(ring_offsets, dtype=np.int64),
+                  'polygon_offsets': np.array(polygon_offsets, dtype=np.int64),
+                  'building_offsets': np.array(building_offsets, dtype=np.int64),
+                  'bounds': np.array(gdf.geometry.bounds.values, dtype=float).reshape(-1, 4)}
+
+        # Grid of ~4 buildings by cell
+        grid = {}
+        arrays['cell_offsets'], arrays['cell_items'] = np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if len(gdf):
+            grid, arrays['cell_offsets'], arrays['cell_items'] = grid_index(arrays['bounds'],
+                                                                            max(int(np.sqrt(len(gdf) / 4.)), 1))
+        meta = {"store_version": store_version, "source_key": source_key, "count": len(gdf), "crs": "epsg:4326",
+                "projected_crs": projected_crs, "grid": grid}
+
+        for name in store_arrays:
+            np.save(os.path.join(store_dir, name + ".npy"), arrays[name])
+        with open(meta_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+    def query_bbox(self, bounds):
+        """
+        Positions of the buildings whose bbox intersects a bbox
+
+        :param bounds: (xmin, ymin, xmax, ymax) in epsg 4326
+        :return: np.array of positions (sorted)
+        """
+
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        grid = self.meta["grid"]
+        xmin, ymin, xmax, ymax = bounds
+        ix0, ix1 = [int(np.clip((x - grid["xmin"]) // grid["cell_width"], 0, grid["grid_size"] - 1)) for x in
+                    (xmin, xmax)]
+        iy0, iy1 = [int(np.clip((y - grid["ymin"]) // grid["cell_height"], 0, grid["grid_size"] - 1)) for y in
+                    (ymin, ymax)]
+
+        candidate = np.unique(np.concatenate(
+            [self.cell_items[self.cell_offsets[iy * grid["grid_size"] + ix0]:
+                             self.cell_offsets[iy * grid["grid_size"] + ix1 + 1]] for iy in range(iy0, iy1 + 1)]))
+
+        candidate_bounds = self.bounds[candidate]
+        intersect = (candidate_bounds[:, 0] <= xmax) & (candidate_bounds[:, 2] >= xmin) & \
+                    (candidate_bounds[:, 1] <= ymax) & (candidate_bounds[:, 3] >= ymin)
+        return candidate[intersect]
+
+    def geometries(self, positions, projected=False):
+        """
+        Build the geometries of stored buildings : the buildings made of one ring (most of them) are built in one
+        call, the others (holes, multipolygons) one by one
+
+        :param positions: np.array of the positions of the buildings
+        :param projected: build the geometries from the projected coordinates (meta["projected_crs"])
+        :return: list of Polygon / MultiPolygon
+        """
+
+        coords = self.projected_coords if projected else self.coords
+        first_polygon = self.building_offsets[positions]
+        first_ring = self.polygon_offsets[first_polygon]
+        simple = (self.building_offsets[positions + 1] - first_polygon == 1) & \
+                 (self.polygon_offsets[first_polygon + 1] - first_ring == 1)
+
+        geometry = np.empty(len(positions), dtype=object)
+        geometry[simple] = simple_polygons(coords, self.ring_offsets[first_ring[simple]],
+                                           self.ring_offsets[first_ring[simple] + 1])
+
+        for index in np.flatnonzero(~simple):
+            building_polygons = []
+            for polygon in range(self.building_offsets[positions[index]], self.building_offsets[positions[index] + 1]):
+                rings = [np.asarray(coords[self.ring_offsets[ring]:self.ring_offsets[ring + 1]]) for ring in
+                         range(self.polygon_offsets[polygon], self.polygon_offsets[polygon + 1])]
+                building_polygons.append(Polygon(rings[0], rings[1:]))
+            geometry[index] = building_polygons[0] if len(building_polygons) == 1 else MultiPolygon(building_polygons)
+
+        return list(geometry)
+
+    def to_gdf(self, positions=None):
+        """
+        Build the GeoDataFrame of the stored buildings
+
+        :param positions: positions of the buildings (all the buildings if None)
+        :return: gpd.GeoDataFrame (epsg : 4326) with [id, geometry], indexed by id
+        """
+
+        positions = np.arange(len(self)) if positions is None else np.asarray(positions, dtype=np.int64)
+        gdf = gpd.GeoDataFrame({'id': np.asarray(self.ids[positions])}, geometry=self.geometries(positions),
+                               crs={'init': 'epsg:4326'})
+        gdf.index = gdf.id
+        return gdf
+
+    def projected_geometry(self, positions=None):
+        """
+        Projected geometry of the stored buildings, read from the projected coordinates (no reprojection)
+
+        :param positions: positions of the buildings (all the buildings if None)
+        :return: gpd.GeoSeries (crs : meta["projected_crs"]) in the order of to_gdf(positions), indexed by id
+        """
+
+        positions = np.arange(len(self)) if positions is None else np.asarray(positions, dtype=np.int64)
+        return gpd.GeoSeries(self.geometries(positions, projected=True), index=np.asarray(self.ids[positions]),
+                             crs={'init': self.meta["projected_crs"]})
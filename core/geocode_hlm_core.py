@@ -6,13 +6,18 @@ Created on Tue Jun 19 19:00:00 2019
 
 """
 
+import codecs
 import json
 import logging
 import os
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 
+from core import geocoding_cache
+from core import local_geocoder
+from core import profiling
 from core import static_functions
 
 """
@@ -26,6 +31,11 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s --
 ch_dir = os.getcwd().replace('\\', '/')
 ch_output = ch_dir + "/output/"
 
+# RPLS columns never used by the pipeline (and causing encoding errors with the API)
+unused_rpls_columns = {'LIBEPCI', 'EPCI', 'DPEDATE', 'CONV', 'NUMCONV', 'FINANAUTRE', 'LIBSEGPATRIM', 'LIBREG', 'DROIT'}
+# Numeric RPLS columns used by the pipeline : every other column is read as str
+rpls_numeric_columns = {'SURFHAB': float}
+
 """ Classes / methods / functions """
 
 
@@ -46,14 +56,8 @@ class GeocodeHlm:
 
         # Read RPLS csv file
         assert param["data"]["csv_hlm"].split('.')[-1] == "csv", "the value of the key 'csv_hlm' must be a csv file"
-
-        try:
-            self.df_hlm = pd.read_csv(param["data"]["csv_hlm"], sep=';', encoding='utf-8')
-        except UnicodeDecodeError:
-            self.df_hlm = pd.read_csv(param["data"]["csv_hlm"], sep=';', encoding='latin-1')
-            logging.error("Impossible to read csv with utf-8 encoding - Use Latin-1")
-
-        self.df_hlm = self.df_hlm[self.df_hlm.DEPCOM.isin(param["data"]["list_cod_insee"])]
+        self.df_hlm = self.read_rpls_csv(param["data"]["csv_hlm"], param["data"]["list_cod_insee"],
+                                         param["data"]["csv_chunk_size"])
         self.dict_count_entity["count init adress"] = self.df_hlm.count().max()
 
         # Read GeoDataFrame building
@@ -61,121 +65,139 @@ class GeocodeHlm:
         assert type(
             self.gdf_building) == gpd.geodataframe.GeoDataFrame, "the buildings must be in GeoDataFrame format"
 
-    def correct_street_name_time_format(self):
+    @staticmethod
+    def detect_csv_encoding(csv_path, sample_size=1000000):
         """
-        Some lines in the input data present anomalies on the street number, which are in the format time -
-        Detection and correction of this error
+        Detect the encoding of the RPLS csv file from a sample of its first bytes
+
+        :param csv_path: path of the csv file
+        :param sample_size: number of bytes read
+        :return: 'utf-8' or 'latin-1'
         """
 
-        self.df_hlm.NUMVOIE = self.df_hlm.NUMVOIE.astype(str)
-        num_street_time_index = self.df_hlm.index[self.df_hlm.NUMVOIE.str.contains('AM|AP') == True]
-        self.dict_error["time format error"] = len(num_street_time_index)
-        logging.info(' correct {} entity with time NUMVOIE '.format(len(num_street_time_index)))
+        with open(csv_path, 'rb') as csv_file:
+            sample = csv_file.read(sample_size)
 
-        for time_street_number in num_street_time_index:
-            if self.df_hlm.NUMVOIE.loc[time_street_number][-2:] == 'AM':
-                self.df_hlm.NUMVOIE.loc[time_street_number] = self.df_hlm.NUMVOIE.loc[time_street_number].split(':')[0]
-            if self.df_hlm.NUMVOIE.loc[time_street_number][-2:] == 'AP':
-                self.df_hlm.NUMVOIE.loc[time_street_number] = int(
-                    self.df_hlm.NUMVOIE.loc[time_street_number].split(':')[0]) + 12
+        try:
+            # final=False : the sample can end in the middle of a multi-byte character
+            codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+            return 'utf-8'
+        except UnicodeDecodeError:
+            logging.error("Impossible to read csv with utf-8 encoding - Use Latin-1")
+            return 'latin-1'
 
-    def correct_type_street_is_in_name_street(self):
+    @staticmethod
+    def read_csv_with_fallback(csv_path, read_function, **read_csv_param):
         """
-        Some lines of the entered data present anomalies on the type of street: the information is in duplicate
-        Detection and correction of this error (drop the duplicate value)
+        Read a csv file in the encoding detected on its first bytes (see detect_csv_encoding) : if a byte further
+        in the file is not utf-8, the whole file is read again in latin-1
+
+        :param csv_path: path of the csv file
+        :param read_function: function(reader) consuming the pd.read_csv reader and returning the result,
+                              called again from the start of the file for the latin-1 reading
+        :param read_csv_param: parameters of pd.read_csv (sep, dtype, chunksize ...)
+        :return: result of read_function
         """
 
-        type_street_error_count = 0
-        cut_name_list = self.df_hlm.NOMVOIE.str.split(' ')
-
-        for cut_name_index in cut_name_list.index:
-            try:
-                if cut_name_list[cut_name_index][0] == self.df_hlm.TYPVOIE[cut_name_index]:
-                    self.df_hlm.NOMVOIE[cut_name_index] = ' '.join(cut_name_list[cut_name_index][1:])
-                    type_street_error_count += 1
-            except TypeError:
-                # Error caused by nan value in cut_name_list
-                pass
-        self.dict_error["duplicate street name"] = type_street_error_count
-        logging.info(' correct {} entity with duplicate street type '.format(type_street_error_count))
+        encoding = GeocodeHlm.detect_csv_encoding(csv_path)
+        try:
+            return read_function(pd.read_csv(csv_path, encoding=encoding, **read_csv_param))
+        except UnicodeDecodeError:
+            logging.error("Impossible to read csv with utf-8 encoding - Use Latin-1")
+            return read_function(pd.read_csv(csv_path, encoding='latin-1', **read_csv_param))
 
-    def drop_duplicate_address(self):
+    def read_rpls_csv(self, csv_path, list_cod_insee, chunk_size):
         """
-        The input file shows all the addresses corresponding to HLMs
-        grouping addresses to avoid duplication / limit processing time thereafter
-        recovery of number and address area by location
+        Read the RPLS csv file by chunks, keeping only the rows of the studied communes (DEPCOM)
+        and the columns used by the pipeline : every column is read as str, except rpls_numeric_columns
+
+        :param csv_path: path of the RPLS csv file
+        :param list_cod_insee: list of the INSEE code of the studied communes
+        :param chunk_size: number of rows read by chunk
+        :return: pd.DataFrame containing the RPLS rows of the studied communes
         """
 
-        drop_col = ['NUMVOIE', 'INDREP', 'TYPVOIE', 'NOMVOIE', 'CODEPOSTAL', 'LIBCOM']
-        df_hlm = self.df_hlm.copy()
+        logging.info("Read RPLS csv by chunks of {} rows".format(chunk_size))
 
-        def count_duplicate_value_before_drop(df):
-            """
-            Group by for recover sum of addresses & living space by location
+        # INSEE codes compared on 5 characters : 1053 (int in param.json) and "01053" (DEPCOM) are the same commune
+        cod_insee = set(local_geocoder.normalize_citycode(pd.Series(list_cod_insee, dtype=object)))
+        df_hlm = self.read_csv_with_fallback(
+            csv_path, lambda reader: pd.concat([chunk[local_geocoder.normalize_citycode(chunk.DEPCOM).isin(cod_insee)]
+                                                for chunk in reader]),
+            sep=';', dtype=str, usecols=lambda column: column not in unused_rpls_columns, chunksize=chunk_size)
+        df_hlm = df_hlm.astype({column: dtype for column, dtype in rpls_numeric_columns.items()
+                                if column in df_hlm.columns})
 
-            :param df: pd.DataFrame containing RPLS fils information (after the two first corrections)
-            :return df : pd.DataFrame containing RPLS file information (after the two first corrections) &
-                         "nb" field (each value = 1)
-                         "temp_address" field with concatenated  complete address
-            :return nb_group_by: pd.core.series.Series containing the number of identical addresses for each line
-            :return surface_group_by: pd.core.series.Series containing the sum of surface for
-                                      identical addresses for each line
-            """
+        logging.info("-- {} rows kept - peak RSS : {} Mo".format(len(df_hlm), profiling.peak_rss_mb()))
 
-            df['nb'] = 1
-            df['index'] = df.index
+        return df_hlm
 
-            df['temp_address'] = df.apply(
-                lambda row: str(row.NUMVOIE) + ' ' + str(row.INDREP) + ' ' + str(row.TYPVOIE) + ' ' + str(
-                    row.NOMVOIE) + ' ' + str(row.CODEPOSTAL) + ' ' + str(row.LIBCOM), axis=1)
+    def correct_street_name_time_format(self):
+        """
+        Some lines in the input data present anomalies on the street number, which are in the format time -
+        Detection and correction of this error
+        """
 
-            nb_group_by = df.groupby('temp_address')["nb"].apply(lambda x: x.astype(int).sum())
-            surface_group_by = df.groupby('temp_address')["SURFHAB"].apply(lambda x: x.astype(int).sum())
+        numvoie = self.df_hlm.NUMVOIE.astype(str)
+        time_format = (numvoie.str.contains('AM|AP') == True).values
+        self.dict_error["time format error"] = int(time_format.sum())
+        logging.info(' correct {} entity with time NUMVOIE '.format(time_format.sum()))
 
-            assert type(df) == pd.DataFrame
-            return df, nb_group_by, surface_group_by
+        # Keep the hour : 'AM' as str, 'AP' as int + 12
+        hour = numvoie.str.split(':').str[0]
+        morning = time_format & (numvoie.str[-2:] == 'AM').values
+        afternoon = time_format & (numvoie.str[-2:] == 'AP').values
 
-        def drop_duplicate(df):
-            """
-            Drop duplicates address, based on drop_col list
+        numvoie = numvoie.astype(object)
+        numvoie[morning] = hour[morning]
+        numvoie[afternoon] = hour[afternoon].astype(int) + 12
+        self.df_hlm.NUMVOIE = numvoie
 
-            :param df: pd.DataFrame - output of function "count_duplicate_value_before_drop"
-            :return: pd.DataFrame containing RPLS file information without duplicates address
-            """
-            count_address_before = df.count()[0]
-            df = df.sort_values("NOMVOIE", ascending=False)
-            df = df.drop_duplicates(drop_col, keep='first')
+    def correct_type_street_is_in_name_street(self):
+        """
+        Some lines of the entered data present anomalies on the type of street: the information is in duplicate
+        Detection and correction of this error (drop the duplicate value)
+        """
 
-            drop_address_duplicate = count_address_before - df.count()[0]
-            logging.info("Drop duplicate address : {} address delete".format(drop_address_duplicate))
+        # First word of the street name / rest of the street name (nan value stay nan)
+        cut_name = self.df_hlm.NOMVOIE.str.partition(' ')
+        duplicate_type = (cut_name[0] == self.df_hlm.TYPVOIE).values
 
-            return df, drop_address_duplicate
+        self.df_hlm.loc[duplicate_type, 'NOMVOIE'] = cut_name[2][duplicate_type]
+        type_street_error_count = int(duplicate_type.sum())
 
-        def update_nb_and_surface_column(df, nb_group_by, surface_group_by):
-            """
-            Adding the number of unique addresses (removed during processing) and
-            sum of the areas for an output address
+        self.dict_error["duplicate street name"] = type_street_error_count
+        logging.info(' correct {} entity with duplicate street type '.format(type_street_error_count))
 
-            :param df: pd.DataFrame containing the unique address of the RPLS file
-            :param nb_group_by: pd.core.series.Series containing the number of unique address
-                                (having been deleted upstream)
-            :param surface_group_by:pd.core.series.Series containing the sum of living space per address
-            :return: pd.DataFrame containing the unique address of the RPLS file, with the sum of living space and
-                     number of housing per unique adress
-            """
+    def drop_duplicate_address(self):
+        """
+        The input file shows all the addresses corresponding to HLMs
+        grouping addresses to avoid duplication / limit processing time thereafter
+        recovery of number and address area by location
+
+        Each address is encoded as a code (64-bit hash of the address columns, factorized in order of first
+        appearance), the number of housing and the living space being summed in one group by on this code
+        The first row of each address is kept as its representative
+        """
+
+        df_hlm = self.df_hlm
+        count_address_before = len(df_hlm)
 
-            df.index = df.temp_address
-            df.update(pd.DataFrame(nb_group_by))
-            df.update(surface_group_by)
+        address_hash = pd.util.hash_pandas_object(df_hlm[geocoding_cache.address_columns], index=False).values
+        address_code = pd.factorize(address_hash)[0]
+        address_code = address_code.astype(np.int32)
 
-            df.index = df['index']
-            df = df.drop(columns=["temp_address", "index"])
+        # Number of housing & living space by address, in one pass
+        df_sum = pd.DataFrame({'nb': 1, 'SURFHAB': df_hlm.SURFHAB.astype(int).values}).groupby(address_code).sum()
 
-            return df
+        # The representative of an address is its first row (codes are in order of first appearance)
+        representative_position = np.unique(address_code, return_index=True)[1]
+        self.df_hlm = df_hlm.iloc[representative_position].copy()
+        self.df_hlm['nb'] = df_sum.nb.values
+        self.df_hlm['SURFHAB'] = df_sum.SURFHAB.values
 
-        df_hlm, nb_unique_address, nb_unique_address_surface = count_duplicate_value_before_drop(df_hlm)
-        df_hlm, drop_duplicate_count = drop_duplicate(df_hlm)
-        self.df_hlm = update_nb_and_surface_column(df_hlm, nb_unique_address, nb_unique_address_surface)
+        drop_duplicate_count = count_address_before - len(self.df_hlm)
+        logging.info("Drop duplicate address : {} address delete".format(drop_duplicate_count))
 
         self.dict_error["duplicate adress (drop)"] = drop_duplicate_count
         self.dict_count_entity["drop duplicate adress"] = drop_duplicate_count
@@ -186,10 +208,9 @@ class GeocodeHlm:
         """
 
         # Problem on some addresses in float type: deletion of these
-        self.df_hlm.NUMVOIE = self.df_hlm.NUMVOIE.apply(lambda x: str(x).split('.')[0])
-        self.df_hlm.NUMVOIE = self.df_hlm.NUMVOIE.apply(lambda x: str(x).split('/')[0])
+        self.df_hlm.NUMVOIE = self.df_hlm.NUMVOIE.astype(str).str.partition('.')[0].str.partition('/')[0]
 
-        self.df_hlm.TYPVOIE.loc[self.df_hlm.TYPVOIE == self.df_hlm.NUMVOIE] = ''
+        self.df_hlm.loc[self.df_hlm.TYPVOIE == self.df_hlm.NUMVOIE, 'TYPVOIE'] = ''
         self.df_hlm = static_functions.drop_value_in_column(self.df_hlm, 'TYPVOIE', 'INCONNUE', '')
 
         # DROP str 'nan' in cols and change ? to E
@@ -198,17 +219,14 @@ class GeocodeHlm:
             if (geocoding_cols != 'NOMVOIE') or (geocoding_cols != 'LIBCOM'):
                 self.df_hlm = static_functions.drop_value_in_column(self.df_hlm, geocoding_cols, 'nan', '')
 
+    @profiling.profiled('df_hlm')
     def correct_hlm_csv(self):
         """ grouping input data correction functions """
 
         logging.info("START csv HLM pretreatment")
         pd.options.mode.chained_assignment = None
 
-        #
-        # To avoid encoding errors with the API
-        self.df_hlm = static_functions.drop_columns(self.df_hlm, {'LIBEPCI', 'EPCI', 'DPEDATE', 'CONV', 'NUMCONV',
-                                                                  'FINANAUTRE', 'LIBSEGPATRIM', 'LIBREG', 'DROIT'})
-
+        # The columns causing encoding errors with the API are not read (see unused_rpls_columns)
         self.correct_street_name_time_format()
         self.correct_type_street_is_in_name_street()
         self.drop_duplicate_address()
@@ -218,6 +236,7 @@ class GeocodeHlm:
         logging.info("END csv HLM pretreatment")
 
     @staticmethod
+    @profiling.profiled()
     def formatting_geocoding_result(gdf_hlm):
         """
         Select columns to export & drop geocoding error
@@ -227,8 +246,9 @@ class GeocodeHlm:
         """
 
         logging.info("Formatting data after geocoding")
-        # Deleting results that are not in the list of common codes (geocoding error)
-        gdf_hlm = gdf_hlm[gdf_hlm.result_citycode.isin(param["data"]["list_cod_insee"])]
+        # Deleting results that are not in the list of common codes (geocoding error), compared on 5 characters
+        cod_insee = local_geocoder.normalize_citycode(pd.Series(param["data"]["list_cod_insee"], dtype=object))
+        gdf_hlm = gdf_hlm[local_geocoder.normalize_citycode(gdf_hlm.result_citycode).isin(cod_insee).values]
 
         # Drop some columns for export
         try:
@@ -251,11 +271,32 @@ class GeocodeHlm:
         """
 
         self.correct_hlm_csv()
-        df_hlm = static_functions.geocode_with_api(ch_output, ch_dir)
+
+        cache = None
+        if param["geocoding"]["use_cache"]:
+            cache = geocoding_cache.GeocodingCache(param["geocoding"]["cache_path"],
+                                                   param["geocoding"]["cache_version"],
+                                                   param["geocoding"]["cache_ttl_days"],
+                                                   static_functions.geocoding_source())
+
+        # Incremental mode : carry forward the result of the previous run, geocode only the new addresses
+        previous_result_path = ch_output + "result_geocoding.csv"
+        if param["geocoding"]["incremental"] and os.path.isfile(previous_result_path):
+            cache = geocoding_cache.PreviousRunResult(previous_result_path, cache)
+
+        df_hlm = static_functions.geocode_with_api(ch_output, ch_dir, cache)
         self.dict_count_entity["count result geocoding"] = df_hlm.count().max()
 
+        if isinstance(cache, geocoding_cache.PreviousRunResult):
+            self.dict_count_entity["incremental unchanged adress"] = cache.count_previous
+            cache = cache.fallback_cache
+
+        if cache is not None:
+            self.dict_count_entity["geocoding cache hit"] = cache.count_hit
+            self.dict_count_entity["geocoding cache miss"] = cache.count_miss
+
         gdf_hlm = static_functions.geocode_df(df_hlm, 'latitude', 'longitude', 4326)
         gdf_hlm = self.formatting_geocoding_result(gdf_hlm)
 
-        static_functions.formatting_gdf_for_shp_export(gdf_hlm, ch_output + 'result_geocoding.shp')
+        static_functions.export_layer(gdf_hlm, ch_output + 'result_geocoding')
         self.output_gdf = gdf_hlm
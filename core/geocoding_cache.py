@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+"""
+
+import json
+import logging
+import sqlite3
+import time
+
+import pandas as pd
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+address_columns = ['NUMVOIE', 'INDREP', 'TYPVOIE', 'NOMVOIE', 'CODEPOSTAL', 'LIBCOM']
+
+""" Classes / methods / functions """
+
+
+class GeocodingCache:
+    """
+    On-disk SQLite cache of the geocoding results, keyed on the geocoding source and the normalized address
+    (NUMVOIE / INDREP / TYPVOIE / NOMVOIE / CODEPOSTAL / LIBCOM) produced by GeocodeHlm.correct_hlm_csv
+
+    A cached result is valid if it has been stored with the same version and is younger than ttl_days
+    """
+
+    def __init__(self, cache_path, version, ttl_days, source=''):
+        """
+        Constructor of the class
+
+        :param cache_path: path of the SQLite file (created if needed)
+        :param version: str - changing it invalidates every stored result
+        :param ttl_days: age limit (in days) of a stored result
+        :param source: str identifying the geocoding engine (see static_functions.geocoding_source) : the results of
+                       two engines are stored apart
+        """
+
+        self.version = str(version)
+        self.source = source
+        self.min_created = time.time() - ttl_days * 86400
+        self.count_hit = 0
+        self.count_miss = 0
+
+        # timeout : the cache can be shared by the workers of the batch mode
+        self.connection = sqlite3.connect(cache_path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS address_cache (address_key TEXT PRIMARY KEY, "
+                                "version TEXT, created REAL, result TEXT)")
+
+    @staticmethod
+    def address_key(df_address):
+        """
+        Build the normalized address key of each row
+
+        :param df_address: pd.DataFrame (str columns) containing the address_columns
+        :return: pd.Series of str
+        """
+
+        address_key = df_address[address_columns[0]].str.strip().str.upper()
+        for column in address_columns[1:]:
+            address_key = address_key + '|' + df_address[column].str.strip().str.upper()
+        return address_key
+
+    def cache_key(self, df_address):
+        """
+        Build the cache key of each row : geocoding source and normalized address
+
+        :param df_address: pd.DataFrame (str columns) containing the address_columns
+        :return: pd.Series of str
+        """
+        return self.source + '#' + self.address_key(df_address)
+
+    def fetch(self, keys):
+        """
+        Read the valid cached results for a list of keys
+
+        :param keys: iterable of address key
+        :return: dict {address key : json result}
+        """
+
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_key (address_key TEXT PRIMARY KEY)")
+        self.connection.execute("DELETE FROM lookup_key")
+        self.connection.executemany("INSERT OR IGNORE INTO lookup_key VALUES (?)", [(key,) for key in keys])
+
+        rows = self.connection.execute("SELECT c.address_key, c.result FROM address_cache c "
+                                       "JOIN lookup_key l ON c.address_key = l.address_key "
+                                       "WHERE c.version = ? AND c.created >= ?", (self.version, self.min_created))
+        return dict(rows.fetchall())
+
+    def split_cached_address(self, df_address):
+        """
+        Separate the addresses already in the cache from the ones to send to the API
+
+        :param df_address: pd.DataFrame (str columns) of the corrected RPLS csv
+        :return df_cached: pd.DataFrame of cached addresses, completed with latitude / longitude / result_* fields
+        :return df_missing: pd.DataFrame of addresses to geocode
+        """
+
+        address_key = self.cache_key(df_address)
+        cached_result = self.fetch(address_key.unique())
+
+        hit = address_key.isin(list(cached_result)).values
+        df_cached = df_address[hit]
+        df_result = pd.DataFrame([json.loads(cached_result[key]) for key in address_key[hit]], index=df_cached.index)
+        df_cached = pd.concat([df_cached, df_result], axis=1)
+
+        self.count_hit = int(hit.sum())
+        self.count_miss = len(df_address) - self.count_hit
+        logging.info("-- geocoding cache : {} hit / {} miss".format(self.count_hit, self.count_miss))
+
+        return df_cached, df_address[~hit]
+
+    def store(self, df_geocoded):
+        """
+        Save the latitude / longitude / result_* fields of the geocoded addresses
+        The addresses not found (empty result_type) are not saved : they are sent again at the next run, instead of
+        staying not found for ttl_days
+
+        :param df_geocoded: pd.DataFrame (str columns) returned by the API
+        """
+
+        if 'result_type' in df_geocoded.columns:
+            df_geocoded = df_geocoded[df_geocoded.result_type.fillna('').astype(str).str.strip() != '']
+
+        result_columns = ['latitude', 'longitude'] + [col for col in df_geocoded.columns if col.startswith('result_')]
+        results = df_geocoded[result_columns].to_dict(orient='records')
+        created = time.time()
+
+        self.connection.executemany("INSERT OR REPLACE INTO address_cache VALUES (?, ?, ?, ?)",
+                                    [(key, self.version, created, json.dumps(result)) for key, result in
+                                     zip(self.cache_key(df_geocoded), results)])
+        self.connection.commit()
+
+
+class PreviousRunResult:
+    """
+    Incremental geocoding : the geocoding results of the previous run (result_geocoding.csv) are carried forward
+    for the addresses still present in the new RPLS extract, only the added / changed addresses are geocoded
+    Same interface as GeocodingCache (split_cached_address / store / count_hit / count_miss)
+    """
+
+    def __init__(self, previous_result_path, fallback_cache=None):
+        """
+        Constructor of the class
+
+        :param previous_result_path: path of the result_geocoding.csv of the previous run
+        :param fallback_cache: optional GeocodingCache looked up for the addresses missing from the previous run
+        """
+
+        self.fallback_cache = fallback_cache
+        self.count_hit = 0
+        self.count_miss = 0
+        self.count_previous = 0
+
+        df_previous = pd.read_csv(previous_result_path, sep=';', encoding='utf-8', dtype=str, keep_default_na=False)
+        if not {'latitude', 'longitude'}.issubset(df_previous.columns):
+            logging.warning("-- incremental geocoding : the previous result contains no coordinates - not used")
+            df_previous = pd.DataFrame(columns=address_columns + ['latitude', 'longitude'])
+
+        result_columns = ['latitude', 'longitude'] + [col for col in df_previous.columns if col.startswith('result_')]
+
+        df_previous.index = GeocodingCache.address_key(df_previous)
+        self.df_previous = df_previous[~df_previous.index.duplicated(keep='first')][result_columns]
+        logging.info("-- incremental geocoding : {} addresses in the previous result".format(len(self.df_previous)))
+
+    def split_cached_address(self, df_address):
+        """
+        Separate the addresses of the previous run (their result is carried forward, with the new attributes)
+        from the added / changed addresses
+
+        :param df_address: pd.DataFrame (str columns) of the corrected RPLS csv
+        :return df_cached: pd.DataFrame of unchanged addresses, completed with the previous result fields
+        :return df_missing: pd.DataFrame of addresses to geocode
+        """
+
+        address_key = GeocodingCache.address_key(df_address)
+        unchanged = address_key.isin(self.df_previous.index).values
+
+        df_cached = df_address[unchanged]
+        df_result = self.df_previous.loc[address_key[unchanged]]
+        df_result.index = df_cached.index
+        df_cached = pd.concat([df_cached, df_result], axis=1)
+        df_missing = df_address[~unchanged]
+
+        self.count_previous = int(unchanged.sum())
+        logging.info("-- incremental geocoding : {} unchanged / {} added or changed".format(self.count_previous,
+                                                                                           len(df_missing)))
+
+        if self.fallback_cache is not None:
+            df_fallback, df_missing = self.fallback_cache.split_cached_address(df_missing)
+            df_cached = pd.concat([df_cached, df_fallback]).sort_index()
+
+        self.count_hit = len(df_cached)
+        self.count_miss = len(df_missing)
+        return df_cached, df_missing
+
+    def store(self, df_geocoded):
+        """ Save the geocoded addresses in the fallback cache (if any) """
+        if self.fallback_cache is not None:
+            self.fallback_cache.store(df_geocoded)
@@ -6,15 +6,25 @@ Created on Tue Jun 19 19:00:00 2019
 
 """
 
+import hashlib
 import json
 import logging
 import os
 import sys
+import time
 
+import fiona
 import geopandas as gpd
+import numpy as np
 import osmnx as ox
-import requests
-
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from core import building_tiles
+from core import footprint_store
+from core import osm_tiles
+from core import profiling
 from core import static_functions
 
 """
@@ -39,11 +49,58 @@ class Building:
 
     def __init__(self):
         self.gdf_building = gpd.GeoDataFrame()
+        self.projected_geometry = None
+
+    def source_description(self):
+        """ Description of the source of the building layer (overridden by each source), see source_key """
+        return {}
+
+    def source_key(self):
+        """
+        Key of the footprint store : hash of the source description and of the processing parameters
+        :return: str - sha256 hex digest
+        """
+
+        description = {"source": param["data"]["osm_shp_postgis_building"], "detail": self.source_description(),
+                       "repair_invalid_geometry": param["data"]["repair_invalid_geometry"],
+                       "small_building_area_m2": param["data"]["small_building_area_m2"],
+                       "epsg": param["global"]["epsg"]}
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def read_footprint_store(self):
+        """
+        Read the processed building layer from the footprint store (param["data"]["footprint_store"]),
+        if it has been written from the same source
+
+        :return: True if the buildings have been read from the store
+        """
+
+        store_param = param["data"]["footprint_store"]
+        if not store_param["enabled"] or not footprint_store.FootprintStore.is_up_to_date(store_param["store_dir"],
+                                                                                          self.source_key()):
+            return False
+
+        logging.info("Read building from the footprint store " + store_param["store_dir"])
+        store = footprint_store.FootprintStore(store_param["store_dir"])
+        self.gdf_building = store.to_gdf()
+        self.projected_geometry = store.projected_geometry()
+        return True
+
+    def write_footprint_store(self):
+        """ Write the processed building layer in the footprint store, read by the next runs """
+
+        store_param = param["data"]["footprint_store"]
+        if store_param["enabled"]:
+            footprint_store.FootprintStore.write(store_param["store_dir"], self.gdf_building, self.source_key(),
+                                                 param["global"]["epsg"])
 
-    def formatting_and_exporting_data(self):
+    @profiling.profiled('gdf_building')
+    def formatting_and_exporting_data(self, export=True):
         """
         Filter building by territory (gdf_area) & drop 'source' field
         Export to shp & formatting the 3 GeoDataFrame
+
+        :param export: export the OSM buildings (False for a tile of the partitioned mode)
         """
         logging.info("start formatting building data")
         assert type(gpd.GeoDataFrame()) == gpd.geodataframe.GeoDataFrame
@@ -58,94 +115,201 @@ class Building:
             self.gdf_building['id'] = self.gdf_building.index
 
         # Clean geometry & filter columns
-        self.gdf_building = static_functions.clean_gdf_by_geometry(self.gdf_building)
+        self.gdf_building = static_functions.clean_gdf_by_geometry(self.gdf_building,
+                                                                  param["data"]["repair_invalid_geometry"])
         self.gdf_building = self.gdf_building[['id', 'geometry']]
 
         # export data to shp
-        if param["data"]["osm_shp_postgis_building"] == "osm":
-            static_functions.formatting_gdf_for_shp_export(self.gdf_building, ch_output + 'building_osm.shp')
+        if export and param["data"]["osm_shp_postgis_building"] == "osm":
+            static_functions.export_layer(self.gdf_building, ch_output + 'building_osm')
 
+    @profiling.profiled('gdf_building')
     def process_small_building(self):
         """
-        Class method for merge small building (area < 30 m²) with the nearest adjoining building
+        Class method for merge small building (area < param["data"]["small_building_area_m2"], 30 m² by default)
+        with the nearest adjoining building
         Else, remove isolated small buidling
         """
 
         logging.info("Merge & Drop small building ")
 
-        def contiguous_small_building_contiguous(gdf):
+        def contiguous_small_building_contiguous(gdf, projected_crs):
             """
             Sub function allowing to isolate the small building (-30m²) and to determine those being
             contiguous or not to other building
-            merge small building contiguously geometry with the geometry of the nearest building
-
-            :param gdf: self.gdf_building -- type : gpd.GeoDataFrame
-            :return small_building: gpd.GeoDataFrame containing only buildings of less than 30m²
-            :return small_building_contiguously: gpd.GeoDataFrame containing only buildings of
-                    less than 30m² contiguous to a larger building
-            :return isolated_small_building_index: set containing only index buildings of
-                    less than 30m² not adjacent to a building
-            """
-
-            logging.info(" -- Identification of small buildings")
-            gdf["neighbors"] = None
-            gdf["neighbors_geom"] = None
-            gdf["small_fusion"] = 0
-            small_building = gdf[gdf.area * 10000000000 < 30]
-            temp_dict = {}
-
-            # Find buildings neighbors for each building in small_building
-            for index, row in gdf.iterrows():
-                if index in set(small_building.index):
-                    # find buildings neighbors
-                    neighbors = gdf[gdf.geometry.touches(row['geometry'])].id.tolist()
-
-                    # deletion of the current id if it is in the list (otherwise, exception handling)
-                    if row.id in neighbors:
-                        neighbors = neighbors.remove(row.id)
+            merge small building contiguously geometry with the geometry of the biggest adjoining building
 
-                    if len(neighbors) > 0:
-                        # recover the max area of neighbors buildings
-                        # biggest_neighbors = neighbors[max(enumerate([gdf.geometry[x].area for x in neighbors]))[0]]
-                        biggest_neighbors = max([[x, gdf.geometry[x].area] for x in neighbors], key=(lambda y: y[1]))[0]
+            The adjoining (touching or overlapping) pairs are found in one spatial join, then the merge targets are
+            resolved as a graph : a small building adjoining another small building is chained to the target of this one
+            The buildings are handled by position (identifiers and index labels are not necessarily unique)
 
-                        small_building.at[index, "neighbors"] = biggest_neighbors
-                        small_building.at[index, "neighbors_geom"] = gdf.geometry[biggest_neighbors]
-
-                        gdf.at[biggest_neighbors, "geometry"] = gdf.at[biggest_neighbors, "geometry"].union(
-                            small_building.at[index, "geometry"])
-                        gdf = gdf.drop([index])
-                        gdf = gdf.dropna(subset=['geometry'])
-
-                        # voir les cas ou le rattachement se fait su un small building ...
-                        # Voir également pour les batiments qui vont se toucher mais devenir des multipolygon
+            :param gdf: self.gdf_building with a 'projected' column (geometry in projected_crs)
+            :param projected_crs: projected CRS of the area computation
+            :return gdf: gpd.GeoDataFrame with the small contiguous buildings merged in their target, and an
+                    'isolated' column flagging the buildings of less than 30m² not adjacent to a building
+            """
 
-            small_building_contiguously = small_building[small_building.neighbors.notnull()]
-            isolated_small_building_index = set(small_building.index[small_building.neighbors.isnull()])
+            logging.info(" -- Identification of small buildings")
+            area = gpd.GeoSeries(list(gdf.projected), crs=projected_crs).area.values
+            small_position = np.flatnonzero(area < param["data"]["small_building_area_m2"])
+            gdf['isolated'] = False
+            if small_position.size == 0:
+                return gdf
+
+            # Find every (small building, adjoining building) pair in one spatial join : 'intersects' rather than
+            # 'touches' (not supported by the join), so that buildings sharing an edge which overlaps slightly
+            # after a reprojection are also merged
+            gdf_position = gpd.GeoDataFrame({'position': np.arange(len(gdf))}, geometry=list(gdf.geometry),
+                                            crs=gdf.crs)
+            touching = gpd.sjoin(gdf_position.iloc[small_position], gdf_position, how='inner', op='intersects')
+            touching = pd.DataFrame({'small': touching.index.values, 'neighbors': touching.index_right.values})
+            touching = touching[touching.small != touching.neighbors]
+
+            # Each small building points to its biggest neighbor
+            touching['neighbors_area'] = area[touching.neighbors.values]
+            touching = touching.sort_values('neighbors_area', ascending=False).drop_duplicates('small', keep='first')
+
+            # Small buildings without any neighbor are isolated
+            isolated = np.zeros(len(gdf), dtype=bool)
+            isolated[np.setdiff1d(small_position, touching.small.values)] = True
+            gdf['isolated'] = isolated
+
+            if touching.empty:
+                return gdf
+
+            # Resolve the chains of merge (small -> small -> building) with the connected components
+            graph = coo_matrix((np.ones(len(touching)), (touching.small.values, touching.neighbors.values)),
+                               shape=(len(gdf), len(gdf)))
+            component = connected_components(graph, directed=False)[1]
+
+            merge_position = np.union1d(touching.small.values, touching.neighbors.values).astype(int)
+            gdf_merge = gdf_position.iloc[merge_position].copy()
+            gdf_merge['component'] = component[merge_position]
+            gdf_merge['area'] = area[merge_position]
+
+            # The biggest building of each component receives the union of the geometries (grouped by component)
+            target_position = gdf_merge.sort_values('area', ascending=False).drop_duplicates('component')
+            target_position = target_position.set_index('component').position
+            merge_geometry = gdf_merge[['component', 'geometry']].dissolve(by='component').geometry
+
+            gdf_target = gdf.iloc[target_position.values].copy()
+            gdf_target['geometry'] = list(merge_geometry.loc[target_position.index])
+            # Only the merged geometries are projected again
+            gdf_target['projected'] = list(gdf_target.geometry.to_crs(projected_crs))
+
+            unchanged = np.ones(len(gdf), dtype=bool)
+            unchanged[merge_position] = False
+            gdf = gpd.GeoDataFrame(pd.concat([gdf[unchanged], gdf_target]).sort_index(kind='mergesort'), crs=gdf.crs)
+            logging.info(" -- {} small buildings have been merged".format(len(touching)))
 
-            return gdf, small_building, small_building_contiguously, isolated_small_building_index
+            return gdf
 
-        def drop_isolated_small_building(gdf, drop_index):
+        def drop_isolated_small_building(gdf):
             """
             Drop row (building) with an area of ​​less than 30m² and not contiguous to another building
 
-            :param gdf: self.gdf_building -- type : gpd.GeoDataFrame
-            :param drop_index: set containing only index buildings of less than 30m² not adjacent to a building
+            :param gdf: self.gdf_building -- type : gpd.GeoDataFrame with an 'isolated' column
             :return: self.gdf_building -- type : gpd.GeoDataFrame without -30m² buildings
             """
 
             logging.info(" -- Drop isolated small building")
-            gdf = gdf[~gdf.id.isin(drop_index)]
-            logging.info(" -- {} buildings have been removed".format(len(drop_index)))
+            logging.info(" -- {} buildings have been removed".format(int(gdf.isolated.sum())))
+            return gdf[~gdf.isolated.values]
+
+        # Areas are computed in the projected CRS : the building layer is projected once, and the projected
+        # geometry is carried as a column (aligned by row through the merge and the cleaning), then kept
+        # for the next metric stages (see get_projected_geometry)
+        projected_crs = {'init': 'epsg:' + str(param["global"]["epsg"])}
+        gdf = self.gdf_building.copy()
+        gdf['projected'] = list(self.gdf_building.geometry.to_crs(projected_crs))
+        gdf = contiguous_small_building_contiguous(gdf, projected_crs)
+        gdf = drop_isolated_small_building(gdf)
+
+        gdf = static_functions.clean_gdf_by_geometry(gdf, param["data"]["repair_invalid_geometry"])
+        projected = gpd.GeoSeries(list(gdf.projected), index=gdf.index, crs=projected_crs)
+        if param["data"]["repair_invalid_geometry"]:
+            # The repaired geometries (buffer(0)) are repaired in the projected CRS too
+            invalid = ~projected.is_valid.values
+            if invalid.any():
+                projected.iloc[np.flatnonzero(invalid)] = projected.iloc[np.flatnonzero(invalid)].buffer(0).values
+
+        self.gdf_building = gdf[["id", "geometry"]]
+        self.projected_geometry = projected
+
+    def get_projected_geometry(self):
+        """
+        Geometry of the buildings in the projected CRS (param["global"]["epsg"]), in the order of self.gdf_building
+        Computed once (by process_small_building, or here if the layer has been read from a store / by tiles),
+        then reused by the metric stages (areas, distances)
 
-            return gdf
+        :return: gpd.GeoSeries
+        """
 
-        gdf, small_buildings, small_buildings_contiguously, isolated_index = contiguous_small_building_contiguous(
-            self.gdf_building)
-        self.gdf_building = drop_isolated_small_building(gdf, isolated_index)
+        if self.projected_geometry is None or len(self.projected_geometry) != len(self.gdf_building):
+            projected_crs = {'init': 'epsg:' + str(param["global"]["epsg"])}
+            self.projected_geometry = self.gdf_building.geometry.to_crs(projected_crs)
+        return self.projected_geometry
 
-        self.gdf_building = static_functions.clean_gdf_by_geometry(self.gdf_building)
-        self.gdf_building = self.gdf_building[["id", "geometry"]]
+    def run_by_tile(self, read_tile, layer_bounds, layer_crs):
+        """
+        Spatially partitioned mode (param["data"]["tile_processing"]) : the building layer is processed tile by tile,
+        each tile being read with a halo so that the merge of small buildings across the tile edges stays correct
+        Each tile keeps only the buildings it owns (see building_tiles.owned_by_tile) and is written to disk,
+        the peak memory of the processing depending on the tile size, not on the size of the territory
+
+        Limits :
+            - only the small building processing is bounded : the tile results are read back in one layer at the end,
+              the next stages (geocoding join, dashboard) holding every building in memory
+            - the halo must be larger than the largest building, else small buildings adjoining a building wider than
+              halo_m can be read by none of its tiles and stay unmerged (a warning is logged for such tiles)
+
+        :param read_tile: function returning the buildings intersecting a bbox (expressed in layer_crs)
+        :param layer_bounds: bbox of the building layer (in layer_crs)
+        :param layer_crs: CRS of the building layer
+        :return: self.gdf_building (epsg: 4326), concatenation of the tile results
+        """
+
+        tile_param = param["data"]["tile_processing"]
+        crs = {'init': 'epsg:' + str(param["global"]["epsg"])}
+        halo = tile_param["halo_m"]
+        spill = building_tiles.TileSpill(tile_param["tile_dir"])
+
+        tiles = building_tiles.tile_grid(building_tiles.bounds_to_crs(layer_bounds, layer_crs, crs),
+                                         tile_param["tile_size_m"])
+        logging.info("Process building by tile : {} tiles".format(len(tiles)))
+
+        for tile_index, tile in enumerate(tiles):
+            xmin, ymin, xmax, ymax = tile
+            self.gdf_building = read_tile(building_tiles.bounds_to_crs((xmin - halo, ymin - halo, xmax + halo,
+                                                                        ymax + halo), crs, layer_crs))
+            if self.gdf_building.empty:
+                continue
+
+            # Identifiers must be the same for a building read by several tiles
+            if {'id'}.issubset(self.gdf_building.columns) is False:
+                self.gdf_building['id'] = building_tiles.geometry_id(self.gdf_building)
+
+            self.formatting_and_exporting_data(export=False)
+            owned = building_tiles.owned_by_tile(self.gdf_building, tile, crs)
+            owned_id = self.gdf_building.id.values[owned]
+
+            largest_size = building_tiles.largest_footprint_size(self.gdf_building[owned], crs)
+            if largest_size > halo:
+                logging.warning("-- tile {} : building of {:.0f} m, larger than the halo ({} m) - small buildings "
+                                "adjoining it may not be merged, increase halo_m".format(tile_index + 1, largest_size,
+                                                                                       halo))
+
+            self.process_small_building()
+            spill.write(self.gdf_building[self.gdf_building.id.isin(owned_id)], tile_index)
+            logging.info("-- tile {} / {} : {} buildings (peak RSS : {} Mo)".format(
+                tile_index + 1, len(tiles), len(owned_id), profiling.peak_rss_mb()))
+
+        # The next stages need every building : the tile results are read back in one layer
+        self.gdf_building = spill.read_all({"init": "epsg:4326"})
+        self.projected_geometry = None
+
+        if param["data"]["osm_shp_postgis_building"] == "osm":
+            static_functions.export_layer(self.gdf_building, ch_output + 'building_osm')
 
 
 class OsmBuilding(Building):
@@ -158,8 +322,9 @@ class OsmBuilding(Building):
 
         Building.__init__(self)
         self.gdf_area = gpd.GeoDataFrame()
-        self.place_name = str(param["data"]["if_osm"]["territory_name"].decode('utf-8-sig'))
+        self.place_name = param["data"]["if_osm"]["territory_name"]
 
+    @profiling.profiled('gdf_area')
     def recover_osm_area(self):
         """
         Recover area from OpenStreetMap, based of a name of locality
@@ -172,36 +337,52 @@ class OsmBuilding(Building):
         self.gdf_area = ox.gdf_from_place(self.place_name)
         assert self.gdf_area.count().max > 0, "No territory name {}".format(self.place_name)
 
+    @profiling.profiled('gdf_building')
     def recover_osm_building(self):
         """
-         Recover building data from OpenStreetMap, based of a name of locality
-         Or from self.gdf_area bbox if the data weight is too important
-         :return: GeoDataFrame (epsg: 4326) : gdf_area
-         """
+        Recover building data from OpenStreetMap on the self.gdf_area polygon
+        The area bbox is split in tiles, downloaded concurrently and cached on disk (see osm_tiles.OsmTileDownloader)
+        :return: GeoDataFrame (epsg: 4326) : gdf_building
+        """
 
         logging.info("-- recover building")
-        try:
-            self.gdf_building = ox.footprints.footprints_from_place(place=self.place_name)
-        except ox.core.EmptyOverpassResponse():
-            logging.error("-- EmptyOverpassResponse -- ")
+        osm_param = param["data"]["if_osm"]
+        downloader = osm_tiles.OsmTileDownloader(osm_param["overpass_url"], osm_param["tile_cache_dir"],
+                                                 osm_param["tile_size"], osm_param["max_workers"],
+                                                 osm_param["tile_max_age_days"], offline=osm_param["offline"])
+
+        self.gdf_building = downloader.download(self.gdf_area.geometry.unary_union)
+        if self.gdf_building.empty:
+            logging.error("-- No building recovered on the territory {} -- ".format(self.place_name))
             sys.exit()
 
-        except requests.exceptions.ReadTimeout:
-            logging.warning("The first recovery of buildings on the territory failed :" \
-                            "the query to the OSM server has returned an TimeOut error")
-            self.gdf_building = ox.footprints.osm_footprints_download(north=self.gdf_area.bbox_north[0],
-                                                                      south=self.gdf_area.bbox_south[0],
-                                                                      east=self.gdf_area.bbox_east[0],
-                                                                      west=self.gdf_area.bbox_west[0],
-                                                                      footprint_type='building', timeout=600)
+        # A way and a relation can have the same OSM id : the identifier is built from both
+        self.gdf_building['id'] = self.gdf_building.osm_type + '/' + self.gdf_building.osm_id.astype(str)
+
+    def source_description(self):
+        """ OSM source : territory, and period of validity of the downloaded tiles """
+        osm_param = param["data"]["if_osm"]
+        return {"territory_name": osm_param["territory_name"], "overpass_url": osm_param["overpass_url"],
+                "period": int(time.time() // (osm_param["tile_max_age_days"] * 86400))}
 
     def run(self):
         """ Execution of the different methods of the class """
 
+        if self.read_footprint_store():
+            return
+
         self.recover_osm_area()
         self.recover_osm_building()
-        self.formatting_and_exporting_data()
-        self.process_small_building()
+
+        if param["data"]["tile_processing"]["enabled"]:
+            gdf_osm = self.gdf_building
+            self.run_by_tile(lambda bounds: gdf_osm.cx[bounds[0]:bounds[2], bounds[1]:bounds[3]].copy(),
+                             gdf_osm.total_bounds, gdf_osm.crs)
+        else:
+            self.formatting_and_exporting_data()
+            self.process_small_building()
+
+        self.write_footprint_store()
 
 
 class ShpBuilding(Building):
@@ -216,6 +397,7 @@ class ShpBuilding(Building):
         self.gdf_path = param["data"]["if_shp"]["shp_building"]
         self.gdf_epsg = param["data"]["if_shp"]["shp_building_epsg"]
 
+    @profiling.profiled('gdf_building')
     def read_building_shp(self):
         """
         Read shapefile and transform to GeoDataFrame
@@ -233,21 +415,72 @@ class ShpBuilding(Building):
             logging.warning(ioe)
             sys.exit()
 
+    def read_building_shp_bbox(self, bounds):
+        """
+        Read the buildings of the shapefile intersecting a bbox (partitioned mode)
+
+        :param bounds: (xmin, ymin, xmax, ymax) in the shapefile CRS
+        :return: Building GeoDataFrame (epsg: 4326)
+        """
+
+        gdf = gpd.read_file(self.gdf_path, bbox=tuple(bounds))
+        gdf.crs = {"init": "epsg:" + str(self.gdf_epsg)}
+        return gdf.to_crs({"init": "epsg:4326"})
+
+    def source_description(self):
+        """ Shapefile source : path, epsg, and modification time / size of the shapefile """
+        return {"shp_building": self.gdf_path, "epsg": self.gdf_epsg, "mtime": os.path.getmtime(self.gdf_path),
+                "size": os.path.getsize(self.gdf_path)}
+
     def run(self):
         """ Execution of the different methods of the class """
-        self.read_building_shp()
-        self.formatting_and_exporting_data()
-        self.process_small_building()
+
+        if self.read_footprint_store():
+            return
+
+        if param["data"]["tile_processing"]["enabled"]:
+            with fiona.open(self.gdf_path) as shp_building:
+                layer_bounds = shp_building.bounds
+            self.run_by_tile(self.read_building_shp_bbox, layer_bounds, {"init": "epsg:" + str(self.gdf_epsg)})
+        else:
+            self.read_building_shp()
+            self.formatting_and_exporting_data()
+            self.process_small_building()
+
+        self.write_footprint_store()
 
 
 class PostGisBuilding(Building):
 
     def __init__(self):
         Building.__init__(self)
+        self.table_fingerprint = None
+
+    def source_description(self):
+        """
+        PostGis source : table, filters and fingerprint of the content of the table (number of buildings and last
+        update time, see static_functions.import_table_fingerprint), queried once by run
+        """
+        if self.table_fingerprint is None:
+            self.table_fingerprint = static_functions.import_table_fingerprint()
+
+        description = {key: value for key, value in param["data"]["if_postgis"].items() if key != "db_password"}
+        description["list_cod_insee"] = param["data"]["list_cod_insee"]
+        description["fingerprint"] = self.table_fingerprint
+        return description
 
     def run(self):
         """ Execution of the different methods of the class """
 
-        self.gdf_building = static_functions.import_table()
-        self.formatting_and_exporting_data()
-        self.process_small_building()
+        if self.read_footprint_store():
+            return
+
+        if param["data"]["tile_processing"]["enabled"]:
+            self.run_by_tile(static_functions.import_table, static_functions.import_table_extent(),
+                             {"init": "epsg:4326"})
+        else:
+            self.gdf_building = static_functions.import_table()
+            self.formatting_and_exporting_data()
+            self.process_small_building()
+
+        self.write_footprint_store()
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+"""
+
+import difflib
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+# Columns of the BAN csv extract (https://adresse.data.gouv.fr/data/ban/adresses/latest/csv) used by the store
+ban_columns = ['id', 'numero', 'rep', 'nom_voie', 'code_postal', 'code_insee', 'nom_commune', 'lon', 'lat']
+
+# Abbreviations of the street types (RPLS TYPVOIE), expanded before the comparison with the BAN street names
+street_type_abbreviation = {'ALL': 'ALLEE', 'AV': 'AVENUE', 'BD': 'BOULEVARD', 'CHE': 'CHEMIN', 'CHEM': 'CHEMIN',
+                            'CHS': 'CHAUSSEE', 'CRS': 'COURS', 'FG': 'FAUBOURG', 'HAM': 'HAMEAU', 'IMP': 'IMPASSE',
+                            'LOT': 'LOTISSEMENT', 'MTE': 'MONTEE', 'PAS': 'PASSAGE', 'PASS': 'PASSAGE',
+                            'PL': 'PLACE', 'PROM': 'PROMENADE', 'QU': 'QUAI', 'QUA': 'QUARTIER', 'RES': 'RESIDENCE',
+                            'RTE': 'ROUTE', 'SEN': 'SENTIER', 'SQ': 'SQUARE', 'TSSE': 'TERRASSE', 'VC': 'VOIE'}
+
+# Repetition index (INDREP / rep) : long forms reduced to the RPLS one letter code
+repetition_abbreviation = {'BIS': 'B', 'TER': 'T', 'QUATER': 'Q', 'QUINQUIES': 'C'}
+
+# Score of each matching level (multiplied by the similarity of the street name for a fuzzy match)
+match_scores = {'exact': 1.0, 'number_without_rep': 0.9, 'street': 0.6}
+
+key_columns = ['citycode', 'street_key', 'number', 'rep']
+
+""" Classes / methods / functions """
+
+
+def normalize_text(series):
+    """
+    Upper case, without accent nor punctuation, single spaced
+
+    :param series: pd.Series of str
+    :return: pd.Series of str
+    """
+
+    series = series.fillna('').astype(str).str.upper().str.normalize('NFKD')
+    series = series.str.encode('ascii', 'ignore').str.decode('ascii')
+    return series.str.replace(r'[^A-Z0-9]+', ' ').str.strip()
+
+
+def normalize_street(series):
+    """
+    Normalized street key : normalized text, the street type (first word) expanded, the articles removed
+    "AV DE LA REPUBLIQUE" and "Avenue de la République" give the same key "AVENUE REPUBLIQUE"
+
+    :param series: pd.Series of str (street type + street name)
+    :return: pd.Series of str
+    """
+
+    series = normalize_text(series)
+    street_type = series.str.partition(' ')
+    series = street_type[0].replace(street_type_abbreviation) + ' ' + street_type[2]
+    series = series.str.replace(r'\b(?:DE|DU|DES|LA|LE|LES|L|D|AU|AUX)\b', ' ')
+    return series.str.replace(r'\s+', ' ').str.strip()
+
+
+def normalize_number(series):
+    """ Street number without leading zero nor decimal part ("012", "12.0" -> "12") """
+    return series.fillna('').astype(str).str.extract(r'(\d+)', expand=False).fillna('').str.lstrip('0')
+
+
+def normalize_rep(series):
+    """ Repetition index reduced to one letter ("bis" -> "B") """
+    series = normalize_text(series)
+    return series.replace(repetition_abbreviation).str[:1]
+
+
+def normalize_citycode(series):
+    """ INSEE code on 5 characters (an INSEE code read as a number loses its leading zero) """
+    return series.fillna('').astype(str).str.replace(r'\.0$', '').str.strip().str.zfill(5)
+
+
+class LocalGeocoder:
+    """
+    Offline geocoder based on a BAN (Base Adresse Nationale) csv extract
+    The extract is normalized once in an indexed store (parquet), rebuilt if the extract is more recent
+
+    The addresses are matched on the normalized citycode / street / number / repetition index :
+        - exact match (housenumber)
+        - same number without the repetition index (housenumber)
+        - street position (mean of its numbers)
+    A street name missing from the commune is first replaced by the closest one (fuzzy match)
+    """
+
+    def __init__(self, ban_csv, store_path, fuzzy_cutoff=0.8):
+        """
+        Constructor of the class
+
+        :param ban_csv: path of the BAN csv extract (';' separator)
+        :param store_path: path of the normalized store (parquet)
+        :param fuzzy_cutoff: minimum similarity (0 - 1) of a fuzzy street match
+        """
+
+        self.fuzzy_cutoff = fuzzy_cutoff
+
+        if not os.path.isfile(store_path) or os.path.getmtime(store_path) < os.path.getmtime(ban_csv):
+            self.build_store(ban_csv, store_path)
+        self.df_store = pd.read_parquet(store_path)
+
+        # Indexes of the 3 matching levels
+        self.df_housenumber = self.df_store.drop_duplicates(key_columns).set_index(key_columns)
+        self.df_number = self.df_store.sort_values('rep').drop_duplicates(key_columns[:3]).set_index(key_columns[:3])
+        self.df_street = self.df_store.groupby(key_columns[:2]).agg({'lon': 'mean', 'lat': 'mean',
+                                                                     'street_label': 'first',
+                                                                     'city_label': 'first'})
+        self.df_street['label'] = self.df_street.street_label + ' ' + self.df_street.city_label
+        self.df_street['id'] = ''
+
+    @staticmethod
+    def build_store(ban_csv, store_path, chunk_size=500000):
+        """
+        Normalize the BAN csv extract (read by chunks) and save it in the store
+
+        :param ban_csv: path of the BAN csv extract
+        :param store_path: path of the normalized store (parquet)
+        :param chunk_size: number of lines read by chunk
+        """
+
+        logging.info("-- build the local geocoding store from " + ban_csv)
+        store_chunks = []
+
+        for chunk in pd.read_csv(ban_csv, sep=';', usecols=ban_columns, dtype=str, keep_default_na=False,
+                                 chunksize=chunk_size, encoding='utf-8'):
+            street_label = chunk.nom_voie.str.strip()
+            city_label = chunk.code_postal.str.strip() + ' ' + chunk.nom_commune.str.strip()
+            number_label = (chunk.numero.str.strip() + ' ' + chunk.rep.str.strip()).str.strip()
+
+            store_chunks.append(pd.DataFrame({'citycode': normalize_citycode(chunk.code_insee),
+                                              'street_key': normalize_street(chunk.nom_voie),
+                                              'number': normalize_number(chunk.numero),
+                                              'rep': normalize_rep(chunk.rep),
+                                              'id': chunk.id,
+                                              'lon': pd.to_numeric(chunk.lon, errors='coerce'),
+                                              'lat': pd.to_numeric(chunk.lat, errors='coerce'),
+                                              'label': number_label + ' ' + street_label + ' ' + city_label,
+                                              'street_label': street_label,
+                                              'city_label': city_label}))
+
+        df_store = pd.concat(store_chunks, ignore_index=True).dropna(subset=['lon', 'lat'])
+        df_store.to_parquet(store_path, index=False)
+        logging.info("-- {} BAN addresses in the store".format(len(df_store)))
+
+    @staticmethod
+    def address_key(df_address):
+        """
+        Normalized keys of the RPLS addresses
+
+        :param df_address: pd.DataFrame (str columns) of the corrected RPLS csv
+        :return: pd.DataFrame with key_columns, same index
+        """
+
+        return pd.DataFrame({'citycode': normalize_citycode(df_address.DEPCOM),
+                             'street_key': normalize_street(df_address.TYPVOIE + ' ' + df_address.NOMVOIE),
+                             'number': normalize_number(df_address.NUMVOIE),
+                             'rep': normalize_rep(df_address.INDREP)}, index=df_address.index)
+
+    def correct_street_key(self, df_key):
+        """
+        Replace the street keys missing from their commune by the closest street key of the commune
+
+        :param df_key: pd.DataFrame of unique address keys
+        :return: pd.DataFrame with the corrected street_key and its similarity (1 if unchanged)
+        """
+
+        df_key = df_key.copy()
+        df_key['similarity'] = 1.
+
+        unknown = ~df_key.set_index(key_columns[:2]).index.isin(self.df_street.index)
+        if not unknown.any():
+            return df_key
+
+        # Fuzzy match on the unique unknown streets, against the streets of their commune
+        street_by_city = self.df_street.reset_index().groupby('citycode').street_key.apply(list)
+        corrected_street = {}
+        for citycode, street_key in df_key[unknown][key_columns[:2]].drop_duplicates().itertuples(index=False):
+            if citycode not in street_by_city.index or street_key == '':
+                continue
+            closest = difflib.get_close_matches(street_key, street_by_city[citycode], n=1, cutoff=self.fuzzy_cutoff)
+            if closest:
+                corrected_street[(citycode, street_key)] = (
+                    closest[0], difflib.SequenceMatcher(None, street_key, closest[0]).ratio())
+
+        if corrected_street:
+            correction = pd.DataFrame([key + value for key, value in corrected_street.items()],
+                                      columns=['citycode', 'street_key', 'corrected_street_key', 'ratio'])
+            df_key = df_key.merge(correction, on=key_columns[:2], how='left')
+            corrected = df_key.corrected_street_key.notna()
+            df_key.loc[corrected, 'street_key'] = df_key.corrected_street_key[corrected]
+            df_key.loc[corrected, 'similarity'] = df_key.ratio[corrected]
+            df_key = df_key.drop(columns=['corrected_street_key', 'ratio'])
+
+        logging.info("-- local geocoding : {} street names corrected by fuzzy match".format(len(corrected_street)))
+        return df_key
+
+    def match_address(self, df_key):
+        """
+        Successive matching levels (exact, number without repetition index, street) on unique address keys
+
+        :param df_key: pd.DataFrame of unique address keys (with street_key corrected and similarity)
+        :return: pd.DataFrame with key_columns, latitude, longitude, result_* fields
+        """
+
+        df_match = df_key.copy()
+        for column in ['latitude', 'longitude', 'result_label', 'result_type', 'result_score', 'result_id']:
+            df_match[column] = np.nan
+        remaining = df_key
+
+        for level, columns, df_index, result_type in [('exact', key_columns, self.df_housenumber, 'housenumber'),
+                                                      ('number_without_rep', key_columns[:3], self.df_number,
+                                                       'housenumber'),
+                                                      ('street', key_columns[:2], self.df_street, 'street')]:
+            matched = remaining[remaining.number != ''] if result_type == 'housenumber' else remaining
+            matched = matched.join(df_index[['lon', 'lat', 'label', 'id']], on=columns, how='inner')
+            if matched.empty:
+                continue
+
+            df_match.loc[matched.index, 'latitude'] = matched.lat
+            df_match.loc[matched.index, 'longitude'] = matched.lon
+            df_match.loc[matched.index, 'result_label'] = matched.label
+            df_match.loc[matched.index, 'result_type'] = result_type
+            df_match.loc[matched.index, 'result_score'] = np.round(match_scores[level] * matched.similarity, 2)
+            df_match.loc[matched.index, 'result_id'] = matched['id']
+            remaining = remaining.drop(matched.index)
+
+        df_match['result_citycode'] = np.where(df_match.result_type.notna(), df_match.citycode, '')
+        logging.info("-- local geocoding : {} / {} addresses not found".format(len(remaining), len(df_key)))
+        return df_match
+
+    def geocode(self, df_address):
+        """
+        Geocode the RPLS addresses, with the same output as the api-adresse /search/csv/ endpoint :
+        input columns completed with latitude / longitude / result_label / result_score / result_type /
+        result_id / result_citycode (empty if the address is not found)
+
+        :param df_address: pd.DataFrame (str columns) of the corrected RPLS csv
+        :return: pd.DataFrame, same index as df_address
+        """
+
+        df_key = self.address_key(df_address)
+
+        # Each unique address is matched once
+        df_unique = df_key.drop_duplicates().reset_index(drop=True)
+        df_match = self.match_address(self.correct_street_key(df_unique))
+        df_match.index = pd.MultiIndex.from_frame(df_unique)
+
+        df_result = df_key.join(df_match.drop(columns=key_columns + ['similarity']), on=key_columns)
+        return pd.concat([df_address, df_result.drop(columns=key_columns)], axis=1)
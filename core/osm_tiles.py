@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gpd
+import numpy as np
+import requests
+from shapely.geometry import MultiPolygon, Polygon, box
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+from core import static_functions
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+overpass_query = '[out:json][timeout:{timeout}];(way["building"]({bbox});relation["building"]({bbox}););out body;>;' \
+                 'out skel qt;'
+
+""" Classes / methods / functions """
+
+
+class OverpassRemarkError(requests.exceptions.RequestException):
+    """ Overpass response with a remark (timeout or runtime error of the query) : its elements are incomplete """
+
+
+def split_bbox_in_tiles(bounds, tile_size):
+    """
+    Split a bbox in a grid of square tiles, aligned on multiples of tile_size (the same tiles, and the same cache files,
+    are used by two areas sharing a part of their extent)
+
+    :param bounds: (west, south, east, north) in epsg 4326
+    :param tile_size: size of a tile (in degrees)
+    :return: list of (west, south, east, north)
+    """
+
+    west, south, east, north = bounds
+    x_start = np.floor(west / tile_size) * tile_size
+    y_start = np.floor(south / tile_size) * tile_size
+
+    return [(round(x, 6), round(y, 6), round(x + tile_size, 6), round(y + tile_size, 6))
+            for x in np.arange(x_start, east, tile_size) for y in np.arange(y_start, north, tile_size)]
+
+
+def assemble_rings(way_node_ids):
+    """
+    Assemble the member ways of a multipolygon relation into closed rings : a ring can be split in several
+    unclosed ways, joined by their end nodes (in any direction)
+
+    :param way_node_ids: list of the node identifiers of each way
+    :return: list of closed rings (list of node identifiers), the ways which cannot be closed being ignored
+    """
+
+    rings = [list(node_ids) for node_ids in way_node_ids if len(node_ids) > 1 and node_ids[0] == node_ids[-1]]
+    open_ways = [list(node_ids) for node_ids in way_node_ids if len(node_ids) > 1 and node_ids[0] != node_ids[-1]]
+
+    while open_ways:
+        ring = open_ways.pop()
+        while ring[0] != ring[-1]:
+            for position, node_ids in enumerate(open_ways):
+                if node_ids[0] == ring[-1]:
+                    ring = ring + node_ids[1:]
+                elif node_ids[-1] == ring[-1]:
+                    ring = ring + node_ids[-2::-1]
+                elif node_ids[-1] == ring[0]:
+                    ring = node_ids[:-1] + ring
+                elif node_ids[0] == ring[0]:
+                    ring = node_ids[:0:-1] + ring
+                else:
+                    continue
+                del open_ways[position]
+                break
+            else:
+                # No way continues the ring
+                break
+
+        if ring[0] == ring[-1]:
+            rings.append(ring)
+
+    return rings
+
+
+def overpass_elements_to_polygons(elements):
+    """
+    Build the building polygons of an Overpass json response : closed ways, and multipolygon relations
+    (outer rings minus inner rings, a ring being possibly split in several ways)
+
+    :param elements: list of the Overpass elements (nodes, ways, relations)
+    :return: dict {(osm type, osm id) : Polygon / MultiPolygon}
+    """
+
+    nodes = {element['id']: (element['lon'], element['lat']) for element in elements if element['type'] == 'node'}
+    ways = {element['id']: element['nodes'] for element in elements if element['type'] == 'way'}
+
+    def way_to_polygon(node_ids):
+        if len(node_ids) < 4 or node_ids[0] != node_ids[-1] or not all(node in nodes for node in node_ids):
+            return None
+        return Polygon([nodes[node] for node in node_ids])
+
+    polygons = {}
+    for element in elements:
+        if element.get('tags', {}).get('building') is None:
+            continue
+
+        if element['type'] == 'way':
+            polygon = way_to_polygon(element['nodes'])
+
+        elif element['type'] == 'relation':
+            member_ways = {'outer': [], 'inner': []}
+            for member in element.get('members', []):
+                if member['type'] == 'way' and member.get('role') in member_ways and member['ref'] in ways:
+                    member_ways[member['role']].append(ways[member['ref']])
+
+            rings = {}
+            for role, role_ways in member_ways.items():
+                rings[role] = [ring for ring in map(way_to_polygon, assemble_rings(role_ways)) if ring is not None]
+            if not rings['outer']:
+                continue
+            polygon = unary_union(rings['outer'])
+            if rings['inner']:
+                polygon = polygon.difference(unary_union(rings['inner']))
+
+        else:
+            continue
+
+        if polygon is not None and isinstance(polygon, (Polygon, MultiPolygon)) and not polygon.is_empty:
+            polygons[(element['type'], element['id'])] = polygon
+
+    return polygons
+
+
+class OsmTileDownloader:
+    """
+    Download of the OSM buildings of an area by tiles : the tiles are requested concurrently to the Overpass API
+    and each response is cached on disk, then the tiles are stitched and deduplicated on the OSM id
+
+    With offline = True, only the cached (recorded) responses are used, whatever their age
+    """
+
+    def __init__(self, overpass_url, cache_dir, tile_size, max_workers, max_age_days, timeout=180, max_retries=3,
+                 backoff=5, offline=False):
+        """
+        Constructor of the class
+
+        :param overpass_url: url of the Overpass API interpreter (or of a local stub)
+        :param cache_dir: directory of the cached tile responses
+        :param tile_size: size of a tile (in degrees)
+        :param max_workers: number of tiles downloaded simultaneously
+        :param max_age_days: age limit (in days) of a cached tile
+        :param timeout: timeout (in s) of a tile request
+        :param max_retries: number of new attempts of a failed tile request
+        :param backoff: waiting time (in s) before the first new attempt, doubled at each attempt
+        :param offline: only use the cached responses
+        """
+
+        self.overpass_url = overpass_url
+        self.cache_dir = cache_dir
+        self.tile_size = tile_size
+        self.max_workers = max_workers
+        self.max_age = max_age_days * 86400
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.offline = offline
+        self.count_cached_tile = 0
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def tile_cache_path(self, query):
+        """ Path of the cached response of a tile query """
+        return os.path.join(self.cache_dir, hashlib.sha256(query.encode('utf-8')).hexdigest()[:24] + ".json")
+
+    def fetch_tile(self, tile):
+        """
+        Read the Overpass elements of a tile from the cache, or request them (retrying with an exponential backoff
+        the timeouts, 429 and 5xx responses - see static_functions.is_retryable_error - and the responses with a remark)
+        Only a complete response is written in the cache
+
+        :param tile: (west, south, east, north)
+        :return: list of the Overpass elements
+        """
+
+        west, south, east, north = tile
+        query = overpass_query.format(timeout=self.timeout, bbox="{},{},{},{}".format(south, west, north, east))
+        cache_path = self.tile_cache_path(query)
+
+        if os.path.isfile(cache_path) and (self.offline or time.time() - os.path.getmtime(cache_path) < self.max_age):
+            self.count_cached_tile += 1
+            with open(cache_path, encoding='utf-8') as cache_file:
+                return json.load(cache_file)['elements']
+
+        assert not self.offline, "offline mode : no recorded response for the tile {}".format(tile)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = requests.post(self.overpass_url, data={'data': query}, timeout=self.timeout + 30)
+                response.raise_for_status()
+                # A timeout or a runtime error of the query is returned with a 200 status and partial elements
+                overpass_result = response.json()
+                if overpass_result.get('remark'):
+                    raise OverpassRemarkError(overpass_result['remark'])
+                break
+
+            except requests.exceptions.RequestException as error:
+                retryable = isinstance(error, OverpassRemarkError) or static_functions.is_retryable_error(error)
+                if attempt == self.max_retries or not retryable:
+                    logging.error("-- tile {} : download failed after {} attempts".format(tile, attempt + 1))
+                    raise
+
+                waiting_time = self.backoff * 2 ** attempt
+                logging.warning("-- tile {} : {} - new attempt in {} s".format(tile, error, waiting_time))
+                time.sleep(waiting_time)
+
+        # Written in a temporary file, then renamed : an interrupted download never leaves a truncated tile
+        with open(cache_path + ".tmp", 'wb') as cache_file:
+            cache_file.write(response.content)
+        os.replace(cache_path + ".tmp", cache_path)
+
+        return overpass_result['elements']
+
+    def download(self, area_geometry):
+        """
+        Download the buildings intersecting an area
+
+        :param area_geometry: Polygon / MultiPolygon of the area (epsg 4326)
+        :return: gpd.GeoDataFrame (epsg : 4326) with [osm_type, osm_id, geometry]
+        """
+
+        tiles = [tile for tile in split_bbox_in_tiles(area_geometry.bounds, self.tile_size)
+                 if box(*tile).intersects(area_geometry)]
+        logging.info("-- {} tiles to recover".format(len(tiles)))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            tile_elements = list(executor.map(self.fetch_tile, tiles))
+        logging.info("-- {} tiles read from the cache".format(self.count_cached_tile))
+
+        # Stitch the tiles : a building crossing a tile border is returned by each tile, under the same OSM id
+        polygons = {}
+        for elements in tile_elements:
+            polygons.update(overpass_elements_to_polygons(elements))
+
+        gdf = gpd.GeoDataFrame({'osm_type': [key[0] for key in polygons], 'osm_id': [key[1] for key in polygons]},
+                               geometry=list(polygons.values()), crs={'init': 'epsg:4326'})
+        prepared_area = prep(area_geometry)
+        gdf = gdf[[prepared_area.intersects(geometry) for geometry in gdf.geometry]].reset_index(drop=True)
+        logging.info("-- {} buildings recovered".format(len(gdf)))
+
+        return gdf
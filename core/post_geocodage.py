@@ -6,19 +6,26 @@ Created on Tue Jun 19 19:00:00 2019
 
 """
 
+import json
 import logging
 import os
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 from shapely.geometry import LineString
-from shapely.ops import nearest_points
 
+from core import profiling
+from core import spatial_index
 from core import static_functions
 
 """
 Globals variables 
 """
+# lecture du json
+json_param = open("param.json")
+param = json.load(json_param)
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
 ch_dir = os.getcwd().replace('\\', '/')
 ch_output = ch_dir + "/output/"
@@ -28,52 +35,41 @@ ch_output = ch_dir + "/output/"
 
 class PostGeocodeData:
 
-    def __init__(self, gdf_hlm, gdf_building):
+    def __init__(self, gdf_hlm, gdf_building, projected_building=None):
         """
         link the geocoding results to the nearest building (from the building inside centroid)
 
         :param gdf_hlm: gpd.GeoDataFrame (epsg : 4326) containing geocoding results retrieve upstream
         :param gdf_building: gpd.GeoDataFrame (epsg : 4326) containing buildings retrieve upstream
+        :param projected_building: optional gpd.GeoSeries - building geometry in param["global"]["epsg"], same order
+                                   as gdf_building (see import_building.Building.get_projected_geometry)
         """
         self.gdf_building = gdf_building.copy()
-        self.gdf_building.id = range(0, len(self.gdf_building))
+        self.projected_building = projected_building
+        self.gdf_building['id'] = np.arange(len(self.gdf_building))
         # Read & filter result geocoding hlm
-        self.gdf_hlm = gdf_hlm.copy()
-        self.gdf_hlm = self.gdf_hlm[self.gdf_hlm.result_type == "housenumber"]
-        self.gdf_hlm.id = range(0, len(self.gdf_hlm))
-        logging.info(' -- only geocoding is taken into account with street number accuracy -- {} result will not be' \
-                     'taken into account'.format(gdf_building.count().max() - self.gdf_hlm.count().max()))
-
-
+        self.gdf_street_result = gpd.GeoDataFrame()
+        if param["post_geocoding"]["street_assignment"]:
+            self.gdf_street_result = gdf_hlm[gdf_hlm.result_type.isin(["street", "locality"])].copy()
+        self.gdf_hlm = gdf_hlm[gdf_hlm.result_type == "housenumber"].copy()
+        self.gdf_hlm['id'] = np.arange(len(self.gdf_hlm))
+
+        if param["post_geocoding"]["street_assignment"]:
+            logging.info(' -- geocoding results with street number accuracy are linked to a building, street / '
+                         'locality results are distributed across the nearby buildings -- {} result will not be '
+                         'taken into account'.format(len(gdf_hlm) - len(self.gdf_hlm) - len(self.gdf_street_result)))
+        else:
+            logging.info(' -- only geocoding is taken into account with street number accuracy -- {} result will not '
+                         'be taken into account'.format(len(gdf_hlm) - len(self.gdf_hlm)))
 
         # Create empty GeoDataFrame
         self.gdf_surf_geom = gpd.GeoDataFrame()
         self.gdf_geom_point = gpd.GeoDataFrame()
         self.gdf_connexion_line = gpd.GeoDataFrame()
         self.init_result_geocoder = gpd.GeoDataFrame()
+        self.footprint_index = None
 
-    @staticmethod
-    def nearest(row, geom_union, df1, df2, geom1_col='geometry', geom2_col='geometry', src_column=None):
-        """
-        Find the nearest point and return the corresponding value from specified column. (use in a loop)
-        source : https://automating-gis-processes.github.io/2017/lessons/L3/nearest-neighbour.html
-
-        :param row: gpd.GeoDataFrame element
-        :param geom_union: gpd.GeoDataFrame.geometry : unary_union of geometry of neighbors to reattach
-        :param df1: ?????
-        :param df2: gpd.GeoDataFrame containing the elements to be recovered (nearest neighbors)
-        :param geom1_col: gpd.GeoDataFrame.geometry containing the geocoding result geometry
-        :param geom2_col: gpd.GeoDataFrame.geometry containing the building geometry
-        :param src_column: gpd.GeoDataFrame.id -- nearest neighbor identifier
-        :return: nearest neighbor identifier
-        """
-
-        # Find the geometry that is closest
-        nearest = df2[geom2_col] == nearest_points(row[geom1_col], geom_union)[1]
-        # Get the corresponding value from df2 (matching is based on the geometry)
-        value = df2[nearest][src_column].get_values()[0]
-        return value
-
+    @profiling.profiled('gdf_building')
     def inside_centroid_building(self):
         """
         Creation of inside centroid centroid (conservation of the initial geometry
@@ -88,20 +84,68 @@ class PostGeocodeData:
         self.gdf_building.geometry = self.gdf_building.geom_point
         self.gdf_building.index = self.gdf_building.id
 
+        # Build the footprint index once
+        self.footprint_index = spatial_index.FootprintIndex(self.gdf_building, 'id', 'surf_geom',
+                                                            param["global"]["epsg"], self.projected_building)
+
+    @profiling.profiled('gdf_hlm')
     def finding_nearest_neighbour(self):
         """
-        Attachment of the points resulting from the geocoding result to the nearest building
-        :return: gpd.GeoDataFrame (epsg : 4326) containing geocoding results and the geometry of
-                the nearest building (centroid and surface)
+        Attachment of the points resulting from the geocoding result to a building :
+        the building containing the point, else the building with the nearest footprint edge
+        (within param["post_geocoding"]["max_distance_m"]) - the points further from any building are dropped
+
+        :return: gpd.GeoDataFrame (epsg : 4326) containing geocoding results, the building identifier, the distance
+                (in meters) to its footprint and the match method ('within' / 'edge')
         """
         logging.info(" -- Find nearest neighbour")
-        logging.info(' ---- This part is currently time-consuming')
 
-        unary_union = self.gdf_building.unary_union
-        self.gdf_hlm['nearest_id'] = self.gdf_hlm.apply(self.nearest, geom_union=unary_union, df1=self.gdf_hlm,
-                                                        df2=self.gdf_building, geom1_col='geometry', src_column='id',
-                                                        axis=1)
+        position, nearest_id, nearest_distance, method = self.footprint_index.query(
+            self.gdf_hlm, param["post_geocoding"]["max_distance_m"])
+
+        self.gdf_hlm = self.gdf_hlm.iloc[position]
+        self.gdf_hlm['nearest_id'] = nearest_id
+        self.gdf_hlm['near_dist'] = np.round(nearest_distance, 2)
+        self.gdf_hlm['match_type'] = method
+
+    @profiling.profiled('gdf_hlm')
+    def assign_street_result(self):
+        """
+        Street-level assignment : each street / locality result is distributed across the buildings within
+        param["post_geocoding"]["street_buffer_m"] of its point, proportionally to their footprint area
+        (the nb & SURFHAB of the address are split with the same weights)
+        The candidate buildings of every street point are found in one grouped spatial join
+
+        :return: self.gdf_hlm completed with one row by (street result, candidate building) - match_type 'street'
+        """
 
+        if self.gdf_street_result.empty:
+            return
+
+        logging.info(" -- Distribute street results across the nearby buildings")
+        gdf_point = self.footprint_index.project_points(self.gdf_street_result)
+        pair = self.footprint_index.footprints_within_distance(gdf_point, param["post_geocoding"]["street_buffer_m"])
+        point_position = pair.point_position.values.astype(int)
+        footprint_position = pair.footprint_position.values.astype(int)
+
+        # Weight of each candidate building : its share of the footprint area of the candidates of the street point
+        weight = pd.Series(self.footprint_index.area[footprint_position])
+        weight = (weight / weight.groupby(point_position).transform('sum')).values
+
+        gdf_assigned = self.gdf_street_result.iloc[point_position].copy()
+        gdf_assigned['nb'] = np.round(gdf_assigned.nb.values * weight, 2)
+        gdf_assigned['SURFHAB'] = np.round(gdf_assigned.SURFHAB.values * weight, 2)
+        gdf_assigned['nearest_id'] = self.footprint_index.ids[footprint_position]
+        gdf_assigned['near_dist'] = np.round(pair.distance.values, 2)
+        gdf_assigned['match_type'] = 'street'
+        gdf_assigned['id'] = np.arange(len(gdf_assigned)) + (int(self.gdf_hlm.id.max()) + 1 if len(self.gdf_hlm) else 0)
+
+        logging.info(" -- {} / {} street results distributed across {} buildings".format(
+            len(np.unique(point_position)), len(self.gdf_street_result), len(np.unique(footprint_position))))
+        self.gdf_hlm = gpd.GeoDataFrame(pd.concat([self.gdf_hlm, gdf_assigned], ignore_index=True),
+                                        crs=self.gdf_hlm.crs)
+
+    @profiling.profiled('gdf_hlm')
     def formatting_hlm_building_output(self):
         """
         Update self.gdf_hlm with nearest building geometry (inside centroid and area) & export the result
@@ -110,7 +154,7 @@ class PostGeocodeData:
         def formatting_and_export_building_result(gdf, new_geometry, output_name):
             gdf.geometry = gdf[new_geometry]
             gdf = gdf.drop(columns=["surf_geom", "geom_point"])
-            static_functions.formatting_gdf_for_shp_export(gdf, ch_output + output_name)
+            static_functions.export_layer(gdf, ch_output + output_name)
             return gdf
 
         logging.info(" -- formatting output HLM building")
@@ -122,12 +166,14 @@ class PostGeocodeData:
         # hlm_gdf recover nearest building geometries
         logging.info("Add information to output file ")
         self.init_result_geocoder = self.gdf_hlm.copy()
-        self.gdf_hlm.update(self.gdf_building)
+        # Only the geometries : the other building columns (id...) would overwrite the HLM attributes of same name
+        self.gdf_hlm.update(self.gdf_building[['geometry', 'geom_point', 'surf_geom']])
 
         # Create gpd.GeoDataFrame surf_geom (HLM building area)
-        self.gdf_surf_geom = formatting_and_export_building_result(self.gdf_hlm, "surf_geom", "suf_geom.shp")
-        self.gdf_geom_point = formatting_and_export_building_result(self.gdf_hlm, "geom_point", "geom_point.shp")
+        self.gdf_surf_geom = formatting_and_export_building_result(self.gdf_hlm, "surf_geom", "suf_geom")
+        self.gdf_geom_point = formatting_and_export_building_result(self.gdf_hlm, "geom_point", "geom_point")
 
+    @profiling.profiled('gdf_surf_geom')
     def drop_duplicate_geometry(self):
         def count_duplicate_value_before_drop(gdf):
             """
@@ -145,8 +191,8 @@ class PostGeocodeData:
             gdf['index'] = gdf.index
             gdf['geom_fictive'] = gdf.geometry.astype(str)
 
-            nb_group_by = gdf.groupby('geom_fictive')["nb"].apply(lambda x: x.astype(int).sum())
-            surface_group_by = gdf.groupby('geom_fictive')["SURFHAB"].apply(lambda x: x.astype(int).sum())
+            nb_group_by = gdf.groupby('geom_fictive')["nb"].apply(lambda x: x.astype(float).sum())
+            surface_group_by = gdf.groupby('geom_fictive')["SURFHAB"].apply(lambda x: x.astype(float).sum())
 
             assert type(gdf) == gpd.GeoDataFrame
             return gdf, nb_group_by, surface_group_by
@@ -196,6 +242,7 @@ class PostGeocodeData:
         self.gdf_geom_point = update_nb_and_surface_column(gdf_building, nb_unique_geometry, nb_unique_surface)
 
     @staticmethod
+    @profiling.profiled()
     def connect_result_point_to_line(gdf_street, gdf_building_point):
         """
         Method for create Line GeoDataFrame, connecting result point to API geocoding and corresponding building
@@ -207,32 +254,28 @@ class PostGeocodeData:
 
         logging.info(' -- Connect geocoding result and building centroid')
 
-        # Drop duplicate based on nearest_id columns
-        gdf_building_point = gdf_building_point.drop_duplicates(subset='nearest_id', keep='first', inplace=False)
-
-        # Create & "formatting df_geometry_merge" for concatenate street point and building point
-        df_geometry_merge = pd.DataFrame(columns=['id', 'geom_street', 'geom_building', 'geometry_sum'],
-                                         index=gdf_street.index)
-        df_geometry_merge.id = gdf_street.nearest_id
-        df_geometry_merge.geom_street = gdf_street.geometry
-        df_geometry_merge = df_geometry_merge.reset_index(drop=True)
-
-        for street_index in df_geometry_merge.index:
-            common_id = df_geometry_merge.id[street_index]
-            df_geometry_merge.geom_building[street_index] = gdf_building_point.geometry[common_id]
-            df_geometry_merge.geometry_sum[street_index] = [df_geometry_merge.geom_building[street_index],
-                                                            df_geometry_merge.geom_street[street_index]]
+        # Align the building point of each geocoding result on nearest_id (index join)
+        building_point = gdf_building_point.drop_duplicates(subset='nearest_id', keep='first', inplace=False)
+        building_point = pd.Series(list(building_point.geometry), index=building_point.nearest_id.values)
+        position = building_point.index.get_indexer(gdf_street.nearest_id.values)
+        gdf_street = gdf_street[position >= 0]
+        building_point = building_point.iloc[position[position >= 0]]
 
+        # Lines built from the coordinate arrays : shape (n, 2 points, 2 coordinates)
+        line_coords = np.stack([spatial_index.points_to_array(building_point),
+                                spatial_index.points_to_array(gdf_street.geometry)], axis=1)
 
-        # Create gdf_connexion_line GeoDataFrame
-        df_geometry_merge.id = df_geometry_merge.index
+        # Length (in meters) computed in the projected CRS
+        crs = {'init': 'epsg:' + str(param["global"]["epsg"])}
+        projected_building = gpd.GeoSeries(list(building_point), crs=gdf_building_point.crs).to_crs(crs)
+        projected_street = gdf_street.geometry.to_crs(crs)
+        length = np.hypot(*(spatial_index.points_to_array(projected_building) -
+                            spatial_index.points_to_array(projected_street)).T)
 
-        gdf_connexion_line = gpd.GeoDataFrame(columns=['id', 'geometry'], index=df_geometry_merge.index)
-        gdf_connexion_line.id = gdf_connexion_line.index
-        gdf_connexion_line.geometry = df_geometry_merge.geometry_sum.apply(lambda x: LineString(x))
-        gdf_connexion_line.crs = gdf_building_point.crs
+        gdf_connexion_line = gpd.GeoDataFrame({'id': np.arange(len(line_coords)), 'length_m': np.round(length, 2)},
+                                              geometry=list(map(LineString, line_coords)), crs=gdf_building_point.crs)
 
-        static_functions.formatting_gdf_for_shp_export(gdf_connexion_line, ch_output + "connexion_line_point.shp")
+        static_functions.export_layer(gdf_connexion_line, ch_output + "connexion_line_point")
 
         return gdf_connexion_line
 
@@ -243,6 +286,7 @@ class PostGeocodeData:
 
         self.inside_centroid_building()
         self.finding_nearest_neighbour()
+        self.assign_street_result()
         self.formatting_hlm_building_output()
         self.drop_duplicate_geometry()
         self.gdf_connexion_line = self.connect_result_point_to_line(self.init_result_geocoder, self.gdf_geom_point)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+"""
+
+import functools
+import json
+import logging
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows : the peak RSS is not available
+    resource = None
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+# Measures of the profiled steps, in execution order
+records = []
+
+""" Classes / methods / functions """
+
+
+def peak_rss_mb():
+    """ Peak resident set size of the process (in Mo), None if not available """
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS, in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(max_rss / (1048576. if sys.platform == 'darwin' else 1024.), 1)
+
+
+def count_rows(result, args, rows_attribute):
+    """
+    Row count of a profiled step : length of the returned DataFrame, else of the instance attribute rows_attribute
+
+    :return: int or None
+    """
+
+    if hasattr(result, '__len__') and hasattr(result, 'columns'):
+        return len(result)
+    if rows_attribute is not None and args and hasattr(args[0], rows_attribute):
+        return len(getattr(args[0], rows_attribute))
+    return None
+
+
+def profiled(rows_attribute=None):
+    """
+    Decorator recording the wall time, CPU time, peak RSS and row count of a pipeline step in records
+
+    :param rows_attribute: name of the instance attribute (DataFrame) counted after the step,
+                           if the step does not return a DataFrame
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            wall_start = time.time()
+            cpu_start = time.process_time()
+
+            result = function(*args, **kwargs)
+
+            record = {"step": function.__qualname__,
+                      "wall_time_s": round(time.time() - wall_start, 3),
+                      "cpu_time_s": round(time.process_time() - cpu_start, 3),
+                      "peak_rss_mb": peak_rss_mb(),
+                      "rows": count_rows(result, args, rows_attribute)}
+            records.append(record)
+            logging.info("-- {step} : {wall_time_s} s (cpu {cpu_time_s} s) - {rows} rows".format(**record))
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def write_report(report_path):
+    """
+    Write the measures of the profiled steps in a JSON report
+
+    :param report_path: path of the JSON report
+    """
+
+    with open(report_path, 'w') as report_file:
+        json.dump({"total_wall_time_s": round(sum(record["wall_time_s"] for record in records), 3),
+                   "peak_rss_mb": peak_rss_mb(),
+                   "steps": records}, report_file, indent=2)
+    logging.info("Performance report : " + report_path)
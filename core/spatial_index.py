@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+"""
+
+import logging
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+""" Classes / methods / functions """
+
+
+def points_to_array(geoseries):
+    """
+    Extract the x / y coordinates of a Point GeoSeries in a numpy array
+
+    :param geoseries: gpd.GeoSeries (Point)
+    :return: np.array of shape (n, 2)
+    """
+    return np.array([geom.coords[0] for geom in geoseries], dtype=float).reshape(-1, 2)
+
+
+class FootprintIndex:
+    """
+    Spatial index built once on building footprints, attaching points by batch :
+        - point-in-polygon join first (the point falls inside a footprint : distance 0)
+        - only the unmatched points are attached to the nearest footprint edge, within a maximum distance
+    Geometries are indexed in a projected CRS so that the distances are in meters
+    """
+
+    def __init__(self, gdf_building, id_column, geometry_column, epsg, projected_geometry=None):
+        """
+        Constructor of the class
+
+        :param gdf_building: gpd.GeoDataFrame containing the footprints
+        :param id_column: name of the column returned by the queries
+        :param geometry_column: name of the footprint geometry column (Polygon / MultiPolygon)
+        :param epsg: projected epsg code used for the distance computation
+        :param projected_geometry: optional gpd.GeoSeries - footprints already projected in epsg (same order as
+                                   gdf_building), reused instead of projecting the layer again
+        """
+
+        logging.info(" -- Build footprint index on {} buildings".format(len(gdf_building)))
+        assert len(gdf_building) > 0, "the footprint index can't be built on an empty layer"
+
+        self.crs = {'init': 'epsg:' + str(epsg)}
+        self.ids = gdf_building[id_column].values
+        if projected_geometry is not None and len(projected_geometry) == len(gdf_building):
+            self.gdf_footprint = gpd.GeoDataFrame({'footprint_position': np.arange(len(gdf_building))},
+                                                  geometry=list(projected_geometry), crs=self.crs)
+        else:
+            self.gdf_footprint = gpd.GeoDataFrame({'footprint_position': np.arange(len(gdf_building))},
+                                                  geometry=list(gdf_building[geometry_column]),
+                                                  crs=gdf_building.crs).to_crs(self.crs)
+        self.area = self.gdf_footprint.area.values
+        # The R-tree is built here, once, then reused by every query
+        self.gdf_footprint.sindex
+
+    def project_points(self, gdf_point):
+        """ Points of gdf_point in the projected CRS, with their position in gdf_point """
+        return gpd.GeoDataFrame({'point_position': np.arange(len(gdf_point))}, geometry=list(gdf_point.geometry),
+                                crs=gdf_point.crs).to_crs(self.crs)
+
+    def footprints_within_distance(self, gdf_projected_point, max_distance):
+        """
+        Every (point, footprint) pair closer than max_distance : candidate footprints intersecting the square of
+        side 2 * max_distance around the point (one spatial join), then exact distance to the footprint edge
+
+        :param gdf_projected_point: gpd.GeoDataFrame returned by project_points
+        :param max_distance: maximum distance (in meters)
+        :return: pd.DataFrame [point_position, footprint_position, distance]
+        """
+
+        if gdf_projected_point.empty:
+            return pd.DataFrame({'point_position': [], 'footprint_position': [], 'distance': []})
+
+        gdf_square = gpd.GeoDataFrame(gdf_projected_point[['point_position']],
+                                      geometry=gdf_projected_point.geometry.buffer(max_distance, cap_style=3),
+                                      crs=self.crs)
+        pair = gpd.sjoin(gdf_square, self.gdf_footprint, how='inner', op='intersects')
+        pair = pd.DataFrame({'point_position': pair.point_position.values,
+                             'footprint_position': pair.footprint_position.values})
+
+        point_geometry = pd.Series(list(gdf_projected_point.geometry), index=gdf_projected_point.point_position.values)
+        point_geometry = point_geometry.loc[pair.point_position.values].values
+        footprint_geometry = self.gdf_footprint.geometry.values[pair.footprint_position.values]
+        pair['distance'] = [point.distance(footprint) for point, footprint in zip(point_geometry, footprint_geometry)]
+
+        return pair[pair.distance <= max_distance]
+
+    def query(self, gdf_point, max_distance):
+        """
+        Attach each point of gdf_point to a footprint
+
+        :param gdf_point: gpd.GeoDataFrame (Point) to attach
+        :param max_distance: maximum distance (in meters) between an unmatched point and the footprint edge
+        :return: np.array of the attached point positions (in gdf_point), np.array of footprint identifier,
+                 np.array of distance (in meters) & np.array of match method ('within' / 'edge')
+        """
+
+        gdf_point = self.project_points(gdf_point)
+
+        # Bulk point-in-polygon join (a point inside overlapping footprints keeps the first one)
+        within = gpd.sjoin(gdf_point, self.gdf_footprint, how='inner', op='within')
+        within = within.drop_duplicates('point_position')[['point_position', 'footprint_position']]
+        within['distance'] = 0.
+        within['method'] = 'within'
+
+        # Only the unmatched points are attached to the nearest footprint edge
+        gdf_unmatched = gdf_point[~gdf_point.point_position.isin(within.point_position.values)]
+        edge = self.footprints_within_distance(gdf_unmatched, max_distance)
+        edge = edge.sort_values('distance').drop_duplicates('point_position')
+        edge['method'] = 'edge'
+
+        logging.info(" -- {} points inside a footprint, {} attached to the nearest edge, {} further than {} m".format(
+            len(within), len(edge), len(gdf_point) - len(within) - len(edge), max_distance))
+
+        match = pd.concat([within, edge]).sort_values('point_position')
+        return (match.point_position.values.astype(int), self.ids[match.footprint_position.values.astype(int)],
+                match.distance.values, match.method.values)
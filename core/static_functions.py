@@ -6,17 +6,24 @@ Created on Tue Jun 19 19:00:00 2019
 
 """
 
+import io
 import json
 import logging
-import subprocess
-import sys
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
+import requests
+import sqlalchemy
+from shapely import wkb
 from shapely.geometry import Point
-from sqlalchemy import create_engine
+
+from core import local_geocoder
+from core import profiling
 
 """
 Globals variables 
@@ -27,6 +34,13 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s --
 json_param = open("param.json")
 param = json.load(json_param)
 
+# SqlAlchemy Engine of the PostGis database (see create_engine) & SRID of the building table (see table_srid)
+postgis_engine = None
+postgis_table_srid = None
+
+# Offline geocoder, loaded once by process (see geocode_with_api)
+ban_geocoder = None
+
 """
 Classes / methods / functions 
 """
@@ -35,28 +49,161 @@ Classes / methods / functions
 def create_engine():
     """
     Create SqlAlchemy Engine with user parameters
+    The engine (and its connection pool) is created once, then reused
     :return: SqlAlchemy Engine
     """
-    db_name = param["data"]["if_postgis"]["db_name"]
-    username = param["data"]["if_postgis"]["db_username"]
-    password = param["data"]["if_postgis"]["db_password"]
-    port = param["data"]["if_postgis"]["port"]
-    host = param["data"]["if_postgis"]["host"]
-    engine = create_engine('postgresql://{}:{}@{}:{}/{}'.format(username, password, host, port, host, db_name))
-    return engine
+    global postgis_engine
+
+    if postgis_engine is None:
+        db_name = param["data"]["if_postgis"]["db_name"]
+        username = param["data"]["if_postgis"]["db_username"]
+        password = param["data"]["if_postgis"]["db_password"]
+        port = param["data"]["if_postgis"]["port"]
+        host = param["data"]["if_postgis"]["host"]
+        postgis_engine = sqlalchemy.create_engine('postgresql://{}:{}@{}:{}/{}'.format(username, password, host, port,
+                                                                                       db_name), pool_size=2)
+    return postgis_engine
+
+
+def table_srid():
+    """
+    SRID of the geometry column of the building table (Find_SRID), queried once
+    :return: int - 0 if the geometries have no SRID
+    """
+    global postgis_table_srid
 
+    if postgis_table_srid is None:
+        postgis_param = param["data"]["if_postgis"]
+        schema, _, table = postgis_param["table_name"].rpartition('.')
+        with create_engine().connect() as con:
+            postgis_table_srid = int(con.execute(sqlalchemy.text("SELECT Find_SRID(:schema, :table, :column)"),
+                                                 {"schema": schema or "public", "table": table,
+                                                  "column": postgis_param["geom_column"]}).scalar())
+    return postgis_table_srid
 
-def import_table():
-    """ Read Postgis Table and return GeoDataFrame  """
-    con = create_engine()
-    gdf = gpd.GeoDataFrame.from_postgis("SELECT * FROM " + param["data"]["if_postgis"]["table_name"], con,
-                                        geom_col='geom')
-    gdf.crs = {'init': 'epsg:' + str(param["data"]["if_postgis"]["epsg"])}
-    gdf = gdf.to_crs({"init": "epsg :4326"})
 
-    if gdf.geometry.name == 'geom':
-        gdf = gdf.rename(columns={"geom": "geometry"})
+def building_query(bbox=None, select="rows", srid=None):
+    """
+    SQL query of the building table : only the identifier and the geometry (transformed to epsg 4326 by the server),
+    filtered by the server on a bbox (epsg 4326) or on the polygons of the communes of list_cod_insee
+    The geometries of a table without SRID (0) are considered in param["data"]["if_postgis"]["epsg"] (ST_SetSRID)
+
+    :param bbox: (xmin, ymin, xmax, ymax) in epsg 4326 - filter of a tile (partitioned mode), added to the filters of
+                 param.json
+    :param select: "rows" (the buildings), "extent" (the bbox in epsg 4326 of the filtered buildings) or
+                   "fingerprint" (the count and the last update time of the filtered buildings)
+    :param srid: SRID of the geometry column (see table_srid), queried if None
+    :return: sqlalchemy.text query & dict of query parameters
+    """
+
+    postgis_param = param["data"]["if_postgis"]
+    if srid is None:
+        srid = table_srid()
+
+    geom = "b." + postgis_param["geom_column"]
+    geom_with_srid = "ST_SetSRID({}, {})".format(geom, postgis_param["epsg"]) if srid == 0 else geom
+
+    def to_table_srid(filter_geometry):
+        """ Filter geometry expressed in the srid of the table, to use its spatial index """
+        if srid == 0:
+            return "ST_SetSRID(ST_Transform({}, {}), 0)".format(filter_geometry, postgis_param["epsg"])
+        return "ST_Transform({}, {})".format(filter_geometry, srid)
+
+    if select == "extent":
+        query = "SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM (SELECT ST_Extent(ST_Transform({}, " \
+                "4326)) AS e FROM {} b".format(geom_with_srid, postgis_param["table_name"])
+    elif select == "fingerprint":
+        query = "SELECT count(*), {} FROM {} b".format(
+            "max(b.{})".format(postgis_param["update_column"]) if postgis_param["update_column"] else "NULL",
+            postgis_param["table_name"])
+    else:
+        query = "SELECT b.{} AS id, ST_AsBinary(ST_Transform({}, 4326)) AS wkb_geometry FROM {} b".format(
+            postgis_param["id_column"], geom_with_srid, postgis_param["table_name"])
+    envelope = "{} && {}".format(geom, to_table_srid("ST_MakeEnvelope(:{0}xmin, :{0}ymin, :{0}xmax, :{0}ymax, 4326)"))
+    conditions = []
+    query_param = {}
+
+    if postgis_param["commune_table"]:
+        conditions.append("ST_Intersects({}, (SELECT {} FROM {} c WHERE c.{} IN :list_cod_insee))".format(
+            geom, to_table_srid("ST_Union(c.{})".format(postgis_param["commune_geom_column"])),
+            postgis_param["commune_table"],
+            postgis_param["commune_insee_column"]))
+        query_param["list_cod_insee"] = tuple(local_geocoder.normalize_citycode(
+            pd.Series(param["data"]["list_cod_insee"], dtype=object)))
+
+    elif postgis_param["bbox"]:
+        conditions.append(envelope.format(''))
+        query_param.update(dict(zip(['xmin', 'ymin', 'xmax', 'ymax'], postgis_param["bbox"])))
+
+    if bbox is not None:
+        conditions.append(envelope.format('tile_'))
+        query_param.update(dict(zip(['tile_xmin', 'tile_ymin', 'tile_xmax', 'tile_ymax'],
+                                    [float(value) for value in bbox])))
+
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if select == "extent":
+        query += ") extent"
+
+    statement = sqlalchemy.text(query)
+    if "list_cod_insee" in query_param:
+        statement = statement.bindparams(sqlalchemy.bindparam("list_cod_insee", expanding=True))
+    return statement, query_param
+
+
+def import_table_extent():
+    """
+    Bbox of the buildings of the Postgis Table (with the filters of param.json), computed by the server
+
+    :return: (xmin, ymin, xmax, ymax) in epsg 4326
+    """
+
+    statement, query_param = building_query(select="extent")
+    with create_engine().connect() as con:
+        return tuple(con.execute(statement, query_param).fetchone())
+
+
+def import_table_fingerprint():
+    """
+    Fingerprint of the content of the Postgis Table (with the filters of param.json) : number of buildings and,
+    if param["data"]["if_postgis"]["update_column"] is set, last update time, computed by the server
+
+    :return: str
+    """
 
+    statement, query_param = building_query(select="fingerprint")
+    with create_engine().connect() as con:
+        count, last_update = con.execute(statement, query_param).fetchone()
+    return "{}|{}".format(count, last_update)
+
+
+@profiling.profiled()
+def import_table(bbox=None):
+    """
+    Read Postgis Table and return GeoDataFrame (epsg : 4326)
+    The rows are streamed by batch from a server-side cursor
+
+    :param bbox: (xmin, ymin, xmax, ymax) in epsg 4326 - optional filter of a tile (partitioned mode)
+    """
+
+    statement, query_param = building_query(bbox)
+    batch_size = param["data"]["if_postgis"]["batch_size"]
+    batch_gdf = []
+
+    with create_engine().connect() as con:
+        result = con.execution_options(stream_results=True).execute(statement, query_param)
+        rows = result.fetchmany(batch_size)
+        while rows:
+            batch_gdf.append(gpd.GeoDataFrame({'id': [row[0] for row in rows]},
+                                              geometry=[wkb.loads(bytes(row[1])) for row in rows],
+                                              crs={'init': 'epsg:4326'}))
+            logging.info("-- {} buildings read".format(sum(len(gdf) for gdf in batch_gdf)))
+            rows = result.fetchmany(batch_size)
+
+    if not batch_gdf:
+        return gpd.GeoDataFrame(columns=['id', 'geometry'], crs={'init': 'epsg:4326'})
+
+    gdf = gpd.GeoDataFrame(pd.concat(batch_gdf, ignore_index=True), crs={'init': 'epsg:4326'})
     assert type(gdf) == gpd.geodataframe.GeoDataFrame, "the output file in not a GeoDataFrame"
     return gdf
 
@@ -97,12 +244,50 @@ def formatting_gdf_for_shp_export(gdf, output_path_and_name):
             gdf = gdf.rename(columns={gdf_column: gdf_column[:10]})
 
     gdf = gdf.to_crs({'init': 'epsg:' + str(param['global']['epsg'])})
-    gdf.to_file(output_path_and_name)
+    # The index (nearest_id for the building layers) is not a field of the shapefile
+    gdf.to_file(output_path_and_name, index=False)
     return gdf
 
 
-def clean_gdf_by_geometry(gdf):
-    """ Clean a GeoDataFrame : drop null / invalid / empty geometry """
+def export_layer(gdf, output_path_and_name):
+    """
+    Export a layer in the output format of the user (param["output"]["format"]) :
+        - "parquet" (GeoParquet) or "feather" : lossless and fast to write / re-read (default)
+        - "shp" : formatting & export to shapefile (see formatting_gdf_for_shp_export)
+    The layers listed in param["output"]["shp_export_layers"] are also exported to shapefile
+
+    :type gdf: GeoDataFrame
+    :param output_path_and_name: path and name for the output layer, without extension
+    """
+
+    output_format = param["output"]["format"]
+    layer_name = os.path.basename(output_path_and_name)
+
+    start_time = time.time()
+    if output_format == "parquet":
+        gdf.reset_index(drop=True).to_parquet(output_path_and_name + '.parquet')
+    elif output_format == "feather":
+        gdf.reset_index(drop=True).to_feather(output_path_and_name + '.feather')
+    elif output_format == "shp":
+        formatting_gdf_for_shp_export(gdf, output_path_and_name + '.shp')
+    else:
+        raise ValueError("the value of the key 'format' must be 'parquet' or 'feather' or 'shp'")
+    logging.info("-- export {} ({}) in {:.2f} s".format(layer_name, output_format, time.time() - start_time))
+
+    if output_format != "shp" and layer_name in param["output"]["shp_export_layers"]:
+        start_time = time.time()
+        formatting_gdf_for_shp_export(gdf, output_path_and_name + '.shp')
+        logging.info("-- export {} (shp) in {:.2f} s".format(layer_name, time.time() - start_time))
+
+
+def clean_gdf_by_geometry(gdf, repair_invalid=False):
+    """
+    Clean a GeoDataFrame : drop null / invalid / empty geometry, drop duplicate geometry
+    The validity is computed once and each geometry is serialized once to WKB for the duplicate detection
+
+    :type gdf: GeoDataFrame
+    :param repair_invalid: if True, the invalid geometries are repaired (buffer(0)) instead of being dropped
+    """
 
     logging.info("drop null & invalid & duplicate geometry \n")
 
@@ -110,74 +295,201 @@ def clean_gdf_by_geometry(gdf):
     if "id" not in gdf.columns:
         gdf = gdf.reset_index()
 
-    # Check geometry validity
-    invalid_geometry = gdf[gdf.geometry.is_valid == False].count().max()
+    # Check geometry validity (null geometry are invalid)
+    not_null = gdf.geometry.notnull().values
+    valid = not_null & gdf.geometry.is_valid.values
+    invalid_geometry = int((~valid).sum())
+
+    if invalid_geometry > 0 and repair_invalid:
+        repair_position = np.flatnonzero(not_null & ~valid)
+        repaired_geometry = gdf.geometry.iloc[repair_position].buffer(0)
+
+        gdf = gdf.copy()
+        gdf.iloc[repair_position, gdf.columns.get_loc("geometry")] = repaired_geometry.values
+        valid[repair_position] = repaired_geometry.is_valid.values
+        logging.info("-- We found and repair {} invalid geometry".format(int(valid[repair_position].sum())))
+        invalid_geometry = int((~valid).sum())
+
     if invalid_geometry > 0:
-        gdf = gdf[gdf.geometry.is_valid == True]
+        gdf = gdf[valid]
         logging.info("-- We found and drop {} invalid geometry".format(invalid_geometry))
 
     # check empty geometry
-    null_geometry = gdf[gdf.geometry.is_valid == True].count().max()
-    if null_geometry > 0:
-        gdf = gdf[gdf.geometry.is_empty == False]
-
-    # Check duplicates geometry
-    unique_geometry = gdf.geometry.astype(str).nunique()
-    number_duplicate_geometry = gdf.geometry.count() - unique_geometry
+    gdf = gdf[~gdf.geometry.is_empty.values]
 
-    if unique_geometry != gdf.geometry.count():
-        wkb_geometry = gdf["geometry"].apply(lambda geom: geom.wkb)
-        gdf = gdf.loc[wkb_geometry.drop_duplicates().index]
-
-    logging.info("We found and drop {} duplicates geometry \n".format(number_duplicate_geometry))
-    assert unique_geometry == gdf.geometry.count(), "Geometry problem in the input data: the deleted entity" \
-                                                    "number is greater than the duplicate entity number"
+    # Check duplicates geometry (one WKB serialization, hashed by duplicated)
+    # (not GeoSeries.apply : on an empty layer, e.g. a tile of isolated small buildings, it returns geometries)
+    duplicate_geometry = pd.Series([geom.wkb for geom in gdf.geometry], dtype=object).duplicated(keep='first').values
+    gdf = gdf[~duplicate_geometry]
+    logging.info("We found and drop {} duplicates geometry \n".format(int(duplicate_geometry.sum())))
 
     # re-initialization of the indexes in relation to the identifiers
     gdf.index = gdf.id
     return gdf
 
 
-def geocode_with_api(ch_output, ch_dir):
+def split_csv_in_chunks(df, chunk_size):
+    """
+    Split a DataFrame in csv chunks of at most chunk_size lines, each chunk repeating the header
+
+    :param df: pd.DataFrame (str columns) to split
+    :param chunk_size: maximum number of lines (without header) by chunk
+    :return: list of str, each one being a complete csv
+    """
+
+    return [df.iloc[start:start + chunk_size].to_csv(sep=';', index=False) for start in
+            range(0, len(df), chunk_size)]
+
+
+def is_retryable_error(error):
+    """
+    A failed request is sent again only on a timeout, a 429 (too many requests) or a 5xx response :
+    any other 4xx response would fail again the same way
+
+    :param error: requests.exceptions.RequestException
+    :return: bool
+    """
+
+    if isinstance(error, requests.exceptions.Timeout):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+def post_csv_chunk_to_api(csv_chunk, chunk_index):
+    """
+    Send one csv chunk to the /search/csv/ endpoint, retrying with an exponential backoff
+    (timeouts, 429 and 5xx responses only, see is_retryable_error)
+
+    :param csv_chunk: str containing a complete csv (header included)
+    :param chunk_index: position of the chunk, for logging
+    :return: str containing the csv returned by the API
+    """
+
+    geocoding_param = param["geocoding"]
+    columns = [('columns', column) for column in ['NUMVOIE', 'INDREP', 'TYPVOIE', 'NOMVOIE', 'CODEPOSTAL', 'LIBCOM']]
+
+    for attempt in range(geocoding_param["max_retries"] + 1):
+        try:
+            response = requests.post(geocoding_param["api_url"], data=columns,
+                                     files={'data': ('RPLS_correct.csv', csv_chunk.encode('utf-8'))},
+                                     timeout=geocoding_param["timeout"])
+            response.raise_for_status()
+            return response.content.decode('utf_8_sig')
+
+        except requests.exceptions.RequestException as error:
+            if attempt == geocoding_param["max_retries"] or not is_retryable_error(error):
+                logging.error("-- chunk {} : geocoding failed after {} attempts".format(chunk_index, attempt + 1))
+                raise
+
+            waiting_time = geocoding_param["backoff"] * 2 ** attempt
+            logging.warning("-- chunk {} : {} - new attempt in {} s".format(chunk_index, error, waiting_time))
+            time.sleep(waiting_time)
+
+
+def geocode_address_with_api(df_address):
+    """
+    Geocoding of addresses by the api-adresse /search/csv/ endpoint : the addresses are split in chunks
+    (param["geocoding"]["chunk_size"]) sent concurrently (param["geocoding"]["max_workers"])
+
+    :param df_address: pd.DataFrame (str columns) of the corrected RPLS csv
+    :return: pd.DataFrame (str columns) returned by the API, same index as df_address
+    """
+
+    chunk_size = param["geocoding"]["chunk_size"]
+    csv_chunks = split_csv_in_chunks(df_address, chunk_size)
+    logging.info("-- {} chunks to geocode".format(len(csv_chunks)))
+
+    with ThreadPoolExecutor(max_workers=param["geocoding"]["max_workers"]) as executor:
+        result_chunks = list(executor.map(post_csv_chunk_to_api, csv_chunks, range(len(csv_chunks))))
+
+    # Merge the results in the input order
+    if not result_chunks:
+        return pd.DataFrame()
+
+    # Each chunk must return one line by address sent, else the results could not be aligned on the addresses
+    df_chunks = []
+    for chunk_index, result_chunk in enumerate(result_chunks):
+        df_chunk = pd.read_csv(io.StringIO(result_chunk), sep=';', dtype=str, keep_default_na=False)
+        count_sent = len(df_address.iloc[chunk_index * chunk_size:(chunk_index + 1) * chunk_size])
+        if len(df_chunk) != count_sent:
+            raise ValueError("chunk {} : {} lines returned by the API for {} addresses sent".format(
+                chunk_index, len(df_chunk), count_sent))
+        df_chunks.append(df_chunk)
+
+    df_geocoded = pd.concat(df_chunks, ignore_index=True)
+    df_geocoded.index = df_address.index
+    return df_geocoded
+
+
+@profiling.profiled()
+def geocoding_source():
+    """
+    Identify the geocoding engine of param.json : the api url, or the BAN extract of the local engine
+
+    :return: str
+    """
+
+    if param["geocoding"]["engine"] == "local":
+        return "local|" + os.path.abspath(param["geocoding"]["ban_csv"])
+    return "api|" + param["geocoding"]["api_url"]
+
+
+def geocode_with_api(ch_output, ch_dir, cache=None):
     """
     Geocoding of HLMs from the corrected csv, by use of the api of the French government
     https://api-adresse.data.gouv.fr
+    or, if param["geocoding"]["engine"] is "local", by the offline geocoder based on a BAN extract
+    (local_geocoder.LocalGeocoder, same output fields)
+
+    If a geocoding_cache.GeocodingCache is given, only the addresses missing from the cache are geocoded (the cache
+    must be built with the source of the engine, see geocoding_source)
 
     :return: pandas.DataFrame with latitude and longitude information
     """
 
+    global ban_geocoder
     logging.info("START geocoding \n")
 
-    geocode_rqt = "curl -X POST -F data=@{} -F columns=NUMVOIE -F columns=INDREP -F columns=TYPVOIE -F " \
-                  "columns=NOMVOIE -F columns=CODEPOSTAL -F columns=LIBCOM " \
-                  "https://api-adresse.data.gouv.fr/search/csv/".format(ch_output + "RPLS_correct.csv")
-
-    # Execute request to API according to the user OS (MAC is not supported)
-    if sys.platform == 'win32':
-        result_geocoding = subprocess.check_output(geocode_rqt)
-        result_geocoding = result_geocoding.decode('utf_8_sig')
-        result_geocoding = result_geocoding.encode('utf_8_sig')
+    df_address = pd.read_csv(ch_output + "RPLS_correct.csv", sep=';', encoding='utf-8', dtype=str,
+                             keep_default_na=False)
+    df_cached = pd.DataFrame()
+    if cache is not None:
+        df_cached, df_address = cache.split_cached_address(df_address)
+
+    if df_address.empty:
+        df_geocoded = pd.DataFrame()
+    elif param["geocoding"]["engine"] == "local":
+        if ban_geocoder is None:
+            ban_geocoder = local_geocoder.LocalGeocoder(param["geocoding"]["ban_csv"],
+                                                        param["geocoding"]["ban_store_path"],
+                                                        param["geocoding"]["fuzzy_cutoff"])
+        df_geocoded = ban_geocoder.geocode(df_address)
+    else:
+        df_geocoded = geocode_address_with_api(df_address)
 
-        with open('output/result_geocoding.csv', "w") as output_csv:
-            output_csv.write(result_geocoding)
+    if cache is not None and {'latitude', 'longitude'}.issubset(df_geocoded.columns):
+        cache.store(df_geocoded)
 
-    elif sys.platform == 'linux':
-        result_geocoding = os.system(geocode_rqt + " > output/result_geocoding.csv")
-    else:
-        raise OSError('Your OS is not supported')
+    df_result = pd.concat([df_geocoded, df_cached]).sort_index()
+    df_result = df_result[list(df_geocoded.columns) + [col for col in df_cached.columns
+                                                       if col not in df_geocoded.columns]]
+    df_result.to_csv(ch_output + "result_geocoding.csv", sep=';', index=False, encoding='utf-8')
 
-    df_hlm = pd.read_csv(ch_dir + "/output/result_geocoding.csv", sep=';', encoding="utf-8")
+    df_hlm = pd.read_csv(ch_output + "result_geocoding.csv", sep=';', encoding="utf-8")
 
     try:
         logging.info("END geocoding : {} result \n".format(df_hlm.REG.count()))
     except AttributeError:
         logging.warning('Erreur lors du géocaodage, le résultat ne contient aucun résultat')
-        logging.warning(result_geocoding)
+        logging.warning(list(df_result.columns))
         sys.exit()
 
     return df_hlm
 
 
+@profiling.profiled()
 def geocode_df(df, latitude_field, longitude_field, epsg):
     """
     Transform a DataFrame to GeoDataFrame based on x, y field
@@ -6,18 +6,28 @@ Created on Tue Jun 19 19:00:00 2019
 
 """
 
+import argparse
 import json
 import logging
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
+import geopandas as gpd
+import pandas as pd
 from bokeh.layouts import layout
-from bokeh.plotting import output_file, show
+from bokeh.plotting import output_file, save
+from bokeh.util.browser import view
 
+from core import checkpoint
 from core import diagram_generator
+from core import footprint_store
 from core import geocode_hlm_core
 from core import import_building
+from core import local_geocoder
 from core import post_geocodage
+from core import profiling
+from core import static_functions
 
 """
 Globals variables 
@@ -30,56 +40,70 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s --
 ch_dir = os.getcwd().replace('\\', '/')
 ch_output = ch_dir + "/output/"
 
+# Building layer (or footprint store) of a batch worker process (see init_batch_worker)
+worker_gdf_building = None
+worker_footprint_store = None
+
 """ Classes / methods / functions """
 
 
-def init_building_gdf():
+def building_source():
     """
-    Creation of building GeoDataFrame :
-    Read the user choice and import building data
-         - read a building shapefile
-         - import data from OSM
-         - import data from PostGis Database
+    Read the user choice of building source (not yet imported) :
+         - a building shapefile
+         - data from OSM
+         - a PostGis Database table
 
-    :return: building GeoDataFrame (epsg : 4326)
+    :return: import_building.Building
     """
     # Process building with shp
     if param["data"]["osm_shp_postgis_building"] == "shp":
         logging.info("Start process with specified building shapefile")
-        building_process = import_building.ShpBuilding()
-        building_process.run()
+        return import_building.ShpBuilding()
 
     # Process building with OSM
     elif param["data"]["osm_shp_postgis_building"] == "osm":
         logging.info("Start process with osm building")
-        building_process = import_building.OsmBuilding()
-        building_process.run()
+        return import_building.OsmBuilding()
 
     # Process building with Postgis Table
     elif param["data"]["osm_shp_postgis_building"] == "postgis":
         logging.info("Start process with specified PostGis building Table")
-        building_process = import_building.PostGisBuilding()
-        building_process.run()
+        return import_building.PostGisBuilding()
 
     # If input param is poorly defined
-    else:
-        logging.warning("the value of the key 'osm_shp_postgis_building' must be 'shp' or 'osm' or 'postgis'")
-        sys.exit()
+    logging.warning("the value of the key 'osm_shp_postgis_building' must be 'shp' or 'osm' or 'postgis'")
+    sys.exit()
+
+
+def init_building_gdf(building_process=None):
+    """
+    Creation of building GeoDataFrame : import the building data of the user choice (see building_source)
+
+    :param building_process: import_building.Building to run (building_source() if None)
+    :return: import_building.Building containing the building GeoDataFrame (epsg : 4326)
+    """
+
+    if building_process is None:
+        building_process = building_source()
+    building_process.run()
 
     return building_process
 
 
-def generate_dashboard_indicator(obj_geocoder, obj_post_geocoder):
+def build_dashboard_layout(obj_geocoder, obj_post_geocoder, max_feature_detail, simplify_tolerance_px=1,
+                           aggregate_polygons=False):
     """
-    Generation of the dashboard is part of the dictionaries or information made upstream
+    Creation of the charts & map of the dashboard
 
     :param obj_geocoder: geocode_hlm_core.GeocodeHlm use upstream
-    :return: bokeh.layout in ch_output + "layout_grid.html"
+    :param obj_post_geocoder: post_geocodage.PostGeocodeData use upstream
+    :param max_feature_detail: number of features of a map layer above which the layer is aggregated / simplified
+    :param simplify_tolerance_px: tolerance (in pixels at the extent of the map) of the simplified polygon layers
+    :param aggregate_polygons: the polygon layers which are not detailed are aggregated by hexagon
+    :return: bokeh.layout
     """
 
-    logging.info('Generate dashboard indicator')
-    output_file(ch_output + "layout_grid.html")
-
     # Creation of pie chart for result synthesis
     synthesis_chart = diagram_generator.BokehPieChart(u'Synthèse des résultats du géocodage',
                                                       obj_geocoder.dict_count_entity, 'data',
@@ -111,7 +135,9 @@ def generate_dashboard_indicator(obj_geocoder, obj_post_geocoder):
 
     # Creation of Bokhe map with geocoding result
     synthesis_map = diagram_generator.BokehMap("Cartographie du géocodage", obj_geocoder.output_gdf,
-                                               u"Résultat du géocodage")
+                                               u"Résultat du géocodage", max_feature_detail,
+                                               param["dashboard"]["hexbin_size_m"], simplify_tolerance_px,
+                                               aggregate_polygons)
     synthesis_map.init_map()
     synthesis_map.add_first_layer_to_map("orange", "green")
 
@@ -120,28 +146,335 @@ def generate_dashboard_indicator(obj_geocoder, obj_post_geocoder):
     diagram_generator.add_new_data_in_bokeh_map(synthesis_map, obj_post_geocoder.gdf_connexion_line,
                                                 u"Connexion résultat - HLM", "green", "orange")
 
-    show(layout([[synthesis_chart.chart, correction_chart.chart, result_type_chart.chart], [result_score_chart.chart],
-                 [synthesis_map.chart]], sizing_mode='stretch_width'))
+    dashboard_grid = [[synthesis_chart.chart, correction_chart.chart, result_type_chart.chart],
+                      [result_score_chart.chart], [synthesis_map.chart]]
+
+    # Pipeline performance panel (only the steps computed during this run)
+    if profiling.records:
+        wall_time_serie = pd.DataFrame(profiling.records).groupby("step").wall_time_s.sum()
+        wall_time_serie.index.name = None
+        performance_chart = diagram_generator.BokehBarChart(u"Performance de la chaîne de traitement",
+                                                            wall_time_serie, u"Part du temps d'exécution", u"étape")
+        performance_chart.run()
+
+        performance_table = diagram_generator.BokehPerformanceTable(u"Détail des étapes", profiling.records)
+        performance_table.run()
+        dashboard_grid += [[performance_chart.chart], [performance_table.chart]]
+
+    return layout(dashboard_grid, sizing_mode='stretch_width')
+
+
+def generate_dashboard_indicator(obj_geocoder, obj_post_geocoder, open_browser=True):
+    """
+    Generation of the dashboard is part of the dictionaries or information made upstream
+    While the html file is bigger than param["dashboard"]["target_size_mb"], the map is generated again
+    with a lower level of detail : 4 times less detailed features by layer (the other points being aggregated
+    by hexagon and the other lines not displayed), and a simplification tolerance of the polygons 4 times larger
+    When the size no longer decreases, the polygons which are not detailed are aggregated by hexagon, then the
+    generation stops
+
+    :param obj_geocoder: geocode_hlm_core.GeocodeHlm use upstream
+    :param obj_post_geocoder: post_geocodage.PostGeocodeData use upstream
+    :param open_browser: if False, the dashboard is only saved (no browser opening)
+    :return: bokeh.layout in ch_output + "layout_grid.html"
+    """
+
+    logging.info('Generate dashboard indicator')
+    dashboard_path = ch_output + "layout_grid.html"
+    output_file(dashboard_path)
+
+    max_feature_detail = param["dashboard"]["max_feature_detail"]
+    simplify_tolerance_px = 1
+    aggregate_polygons = False
+    save(build_dashboard_layout(obj_geocoder, obj_post_geocoder, max_feature_detail, simplify_tolerance_px))
+    dashboard_size = os.path.getsize(dashboard_path) / 1048576.
+    previous_size = None
+
+    # max_feature_detail None : always full detail, the map is not generated again
+    while max_feature_detail is not None and dashboard_size > param["dashboard"]["target_size_mb"] and \
+            max_feature_detail > 100:
+        if previous_size is not None and dashboard_size >= previous_size * 0.95:
+            if aggregate_polygons:
+                logging.warning("-- dashboard of {:.1f} Mo : the size no longer decreases, target of {} Mo not "
+                                "reached".format(dashboard_size, param["dashboard"]["target_size_mb"]))
+                break
+
+            # The simplification no longer reduces the size : the polygons are aggregated instead
+            aggregate_polygons = True
+            logging.info("-- dashboard of {:.1f} Mo : map generated again with the polygons aggregated by "
+                         "hexagon".format(dashboard_size))
+        else:
+            max_feature_detail //= 4
+            simplify_tolerance_px *= 4
+            logging.info("-- dashboard of {:.1f} Mo : map generated again with at most {} detailed features by "
+                         "layer, polygons simplified at {} pixels".format(dashboard_size, max_feature_detail,
+                                                                          simplify_tolerance_px))
+
+        save(build_dashboard_layout(obj_geocoder, obj_post_geocoder, max_feature_detail, simplify_tolerance_px,
+                                    aggregate_polygons))
+        previous_size, dashboard_size = dashboard_size, os.path.getsize(dashboard_path) / 1048576.
+
+    logging.info("-- dashboard size : {:.1f} Mo".format(dashboard_size))
+    if open_browser:
+        view(dashboard_path)
+
+
+class BatchResult:
+    """
+    Merge of the partition results of the batch mode, exposing the same attributes as
+    GeocodeHlm and PostGeocodeData for the dashboard generation
+    """
+
+    def __init__(self, partition_results):
+        """
+        :param partition_results: list of dict returned by run_partition
+        """
+
+        self.dict_count_entity = {}
+        self.dict_error = {}
+        for partition_result in partition_results:
+            for key, value in partition_result["dict_count_entity"].items():
+                self.dict_count_entity[key] = self.dict_count_entity.get(key, 0) + value
+            for key, value in partition_result["dict_error"].items():
+                self.dict_error[key] = self.dict_error.get(key, 0) + value
+
+        self.output_gdf = self.concat_layer(partition_results, "output_gdf")
+        self.gdf_surf_geom = self.concat_layer(partition_results, "gdf_surf_geom")
+        self.gdf_geom_point = self.concat_layer(partition_results, "gdf_geom_point")
+        self.gdf_connexion_line = self.concat_layer(partition_results, "gdf_connexion_line")
+
+    @staticmethod
+    def concat_layer(partition_results, layer_name):
+        """ Concatenation of one layer of every partition """
+        layers = [result[layer_name] for result in partition_results if not result[layer_name].empty]
+        if not layers:
+            return gpd.GeoDataFrame()
+
+        gdf = gpd.GeoDataFrame(pd.concat(layers, ignore_index=True), crs=layers[0].crs)
+        gdf['id'] = gdf.index
+        return gdf
+
+
+def partition_rpls_csv():
+    """
+    Split the RPLS csv file by commune, in one chunked read by the parent process : the rows of the communes of
+    param["batch"]["list_cod_insee"] and of the communes of param["batch"]["list_departement"] are written in
+    ch_output/<cod_insee>/RPLS_input.csv, the only file read by the worker of the partition
+
+    :return: list of INSEE code (str on 5 characters) of the partitions
+    """
+
+    csv_path = param["data"]["csv_hlm"]
+    list_cod_insee = set(local_geocoder.normalize_citycode(pd.Series(param["batch"]["list_cod_insee"], dtype=object)))
+    list_departement = set(str(departement).zfill(2) for departement in param["batch"]["list_departement"])
+    logging.info("Split the RPLS csv by commune")
+
+    def split_by_commune(reader):
+        # The first chunk of a commune creates its file : a new reading (latin-1) rewrites the partitions
+        partition_paths = {}
+        for chunk in reader:
+            depcom = local_geocoder.normalize_citycode(chunk.DEPCOM)
+            kept = (depcom.isin(list_cod_insee) | depcom.str[:2].isin(list_departement)).values
+
+            for cod_insee, df_commune in chunk[kept].groupby(depcom[kept].values):
+                if cod_insee not in partition_paths:
+                    partition_paths[cod_insee] = ch_output + cod_insee + "/RPLS_input.csv"
+                    if not os.path.isdir(ch_output + cod_insee):
+                        os.makedirs(ch_output + cod_insee)
+                    df_commune.to_csv(partition_paths[cod_insee], sep=';', index=False, encoding='utf-8')
+                else:
+                    df_commune.to_csv(partition_paths[cod_insee], sep=';', index=False, encoding='utf-8', mode='a',
+                                      header=False)
+        return partition_paths
+
+    partition_paths = geocode_hlm_core.GeocodeHlm.read_csv_with_fallback(
+        csv_path, split_by_commune, sep=';', dtype=str, keep_default_na=False,
+        chunksize=param["data"]["csv_chunk_size"])
+
+    for cod_insee in sorted(list_cod_insee - set(partition_paths)):
+        logging.warning("-- commune {} : no row in the RPLS csv, not processed".format(cod_insee))
+
+    return sorted(partition_paths)
+
+
+def init_batch_worker(gdf_building, store_dir=None):
+    """
+    Initializer of the batch worker processes : the building layer is sent once by process,
+    or, if the footprint store is enabled, each process opens the store (memory maps shared by the processes)
+
+    :param gdf_building: gpd.GeoDataFrame (epsg : 4326) of every building of the batch territory (None if store_dir)
+    :param store_dir: directory of the footprint store
+    """
+    global worker_gdf_building, worker_footprint_store
+    worker_gdf_building = gdf_building
+    if store_dir is not None:
+        worker_footprint_store = footprint_store.FootprintStore(store_dir)
+
+
+def run_partition(cod_insee):
+    """
+    Execution of geocoding & post-geocoding for one commune (batch worker process)
+    The outputs of the partition are written in ch_output/<cod_insee>/
+
+    :param cod_insee: INSEE code of the commune (str on 5 characters)
+    :return: dict containing the counters, the result layers and the profiling records of the partition
+    """
+
+    logging.info("START partition {}".format(cod_insee))
+    first_record = len(profiling.records)
+    partition_output = ch_output + cod_insee + "/"
+
+    # The modules globals are local to the worker process : the worker only reads the rows of its commune,
+    # written by partition_rpls_csv
+    geocode_hlm_core.param["data"]["csv_hlm"] = partition_output + "RPLS_input.csv"
+    geocode_hlm_core.param["data"]["list_cod_insee"] = [cod_insee]
+    geocode_hlm_core.ch_output = partition_output
+    post_geocodage.ch_output = partition_output
+
+    hlm = geocode_hlm_core.GeocodeHlm(gpd.GeoDataFrame())
+    hlm.run()
+
+    # The profiling records of the worker process are returned to the parent process (a worker process runs
+    # several partitions : only the records of this partition are returned)
+    partition_result = {"dict_count_entity": hlm.dict_count_entity, "dict_error": hlm.dict_error,
+                        "output_gdf": hlm.output_gdf, "gdf_surf_geom": gpd.GeoDataFrame(),
+                        "gdf_geom_point": gpd.GeoDataFrame(), "gdf_connexion_line": gpd.GeoDataFrame(),
+                        "records": profiling.records[first_record:]}
+
+    # Buildings of the partition : bbox of the geocoding result, with a margin
+    if hlm.output_gdf.empty:
+        logging.warning("-- partition {} : no geocoding result".format(cod_insee))
+        return partition_result
+
+    margin = param["batch"]["building_margin"]
+    xmin, ymin, xmax, ymax = hlm.output_gdf.total_bounds
+    partition_bounds = (xmin - margin, ymin - margin, xmax + margin, ymax + margin)
+    if worker_footprint_store is not None:
+        building_position = worker_footprint_store.query_bbox(partition_bounds)
+    else:
+        building_position = list(worker_gdf_building.sindex.intersection(partition_bounds))
+
+    if len(building_position) == 0:
+        logging.warning("-- partition {} : no building around the geocoding result".format(cod_insee))
+        return partition_result
+
+    # The store also holds the projected coordinates : the buildings of the partition are not reprojected
+    projected_building = None
+    if worker_footprint_store is not None:
+        gdf_building = worker_footprint_store.to_gdf(building_position)
+        projected_building = worker_footprint_store.projected_geometry(building_position)
+    else:
+        gdf_building = worker_gdf_building.iloc[building_position]
+
+    post_geocoding = post_geocodage.PostGeocodeData(hlm.output_gdf, gdf_building, projected_building)
+    post_geocoding.run()
+
+    partition_result.update({"gdf_surf_geom": post_geocoding.gdf_surf_geom,
+                             "gdf_geom_point": post_geocoding.gdf_geom_point,
+                             "gdf_connexion_line": post_geocoding.gdf_connexion_line,
+                             "records": profiling.records[first_record:]})
+    logging.info("END partition {}".format(cod_insee))
+    return partition_result
+
+
+def main_batch():
+    """
+    Batch mode : the RPLS csv is split by commune and the building layer is imported once, then each commune
+    is geocoded and attached to the buildings in a process pool. The partitions results are merged in ch_output
+    """
 
+    list_cod_insee = partition_rpls_csv()
+    logging.info("Batch mode : {} communes to process".format(len(list_cod_insee)))
 
-def main():
-    # Read / recover building
     main_building_process = init_building_gdf()
 
-    # Read & geocode RLPS
+    # With the footprint store, the workers open the store instead of receiving a copy of the building layer
+    store_param = param["data"]["footprint_store"]
+    worker_args = (None, store_param["store_dir"]) if store_param["enabled"] else (main_building_process.gdf_building,)
+
+    with ProcessPoolExecutor(max_workers=param["batch"]["max_workers"], initializer=init_batch_worker,
+                             initargs=worker_args) as executor:
+        partition_results = list(executor.map(run_partition, list_cod_insee))
+
+    # Merge partitions results
+    logging.info("Merge {} partitions".format(len(partition_results)))
+    for cod_insee, partition_result in zip(list_cod_insee, partition_results):
+        profiling.records.extend(dict(record, partition=cod_insee) for record in partition_result["records"])
+    batch_result = BatchResult(partition_results)
+    for gdf, output_name in [(batch_result.output_gdf, 'result_geocoding'),
+                             (batch_result.gdf_surf_geom, 'suf_geom'),
+                             (batch_result.gdf_geom_point, 'geom_point'),
+                             (batch_result.gdf_connexion_line, 'connexion_line_point')]:
+        if not gdf.empty:
+            static_functions.export_layer(gdf, ch_output + output_name)
+
+    # Generate dashboard
+    generate_dashboard_indicator(batch_result, batch_result)
+    profiling.write_report(ch_output + "performance_report.json")
+
+
+def building_input_paths():
+    """ Input files of the building stage (the shapefile and its sidecar files if building are read from a shp) """
+
+    if param["data"]["osm_shp_postgis_building"] != "shp":
+        return []
+    shp_stem = os.path.splitext(param["data"]["if_shp"]["shp_building"])[0]
+    return [shp_stem + extension for extension in ['.shp', '.shx', '.dbf', '.prj'] if
+            os.path.isfile(shp_stem + extension)]
+
+
+def run_geocoding(main_building_process):
+    """ Read, correct & geocode RLPS """
     hlm = geocode_hlm_core.GeocodeHlm(main_building_process.gdf_building)
     hlm.run()
+    return hlm
+
 
-    post_geocoding = post_geocodage.PostGeocodeData(hlm.output_gdf, main_building_process.gdf_building)
+def run_post_geocoding(hlm, main_building_process):
+    """ Attach the geocoding result to the buildings """
+    post_geocoding = post_geocodage.PostGeocodeData(hlm.output_gdf, main_building_process.gdf_building,
+                                                    main_building_process.get_projected_geometry())
     post_geocoding.run()
+    return post_geocoding
+
+
+def main(from_stage=None):
+    """
+    Each stage is read from its checkpoint if its inputs (param.json, input files, previous stages) are unchanged
+
+    :param from_stage: name of the first stage to compute again (see checkpoint.stages)
+    """
+
+    stage_checkpoint = checkpoint.StageCheckpoint(ch_output + "checkpoint/", "param.json", from_stage)
+
+    # Read / recover building : the key of the stage includes the key of the source (content of the PostGis table,
+    # period of validity of the OSM tiles), so that a changed source is imported again
+    building_process = building_source()
+    main_building_process = stage_checkpoint.run('building', building_input_paths(), init_building_gdf,
+                                                 building_process, source_key=building_process.source_key())
+
+    # Read & geocode RLPS
+    hlm = stage_checkpoint.run('geocoding', [param["data"]["csv_hlm"]], run_geocoding, main_building_process)
+
+    post_geocoding = stage_checkpoint.run('post_geocoding', [], run_post_geocoding, hlm, main_building_process)
 
     # Generate dashboard
-    generate_dashboard_indicator(hlm, post_geocoding)
+    stage_checkpoint.run('dashboard', [], generate_dashboard_indicator, hlm, post_geocoding)
+    profiling.write_report(ch_output + "performance_report.json")
 
 
 """
 PROCESS
 """
 if __name__ == "__main__":
-    main()
-
+    parser = argparse.ArgumentParser(description="Geocoding of the RPLS file and attachment to the buildings")
+    parser.add_argument("--batch", action="store_true",
+                        help="process every commune of param['batch'] in a process pool")
+    parser.add_argument("--from-stage", choices=checkpoint.stages, default=None,
+                        help="compute again this stage and the following ones, even if their inputs are unchanged")
+    args = parser.parse_args()
+
+    if args.batch:
+        main_batch()
+    else:
+        main(args.from_stage)
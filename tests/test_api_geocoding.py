@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+Chunked geocoding by the api-adresse csv endpoint (core.static_functions.geocode_address_with_api), against the
+stub geocoder of the benchmark
+"""
+
+import copy
+import logging
+
+import pandas as pd
+import pytest
+import requests
+
+from benchmark import synthetic_data
+from core import static_functions
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+""" Classes / methods / functions """
+
+
+class FaultyGeocoderHandler(synthetic_data.StubGeocoderHandler):
+    """
+    Stub geocoder failing on chosen chunks (identified by their first NUMAPPT) : statuses lists the HTTP errors
+    returned before the result, short_chunks the chunks returned without their last line
+    """
+
+    statuses = {}
+    short_chunks = set()
+    posted_chunks = []
+
+    def do_POST(self):
+        df = self.posted_csv()
+        chunk = df.NUMAPPT.iloc[0]
+        self.posted_chunks.append(chunk)
+
+        if self.statuses.get(chunk):
+            self.send_error(self.statuses[chunk].pop(0))
+            return
+
+        df = self.geocode(df)
+        self.send_csv(df.iloc[:-1] if chunk in self.short_chunks else df)
+
+
+@pytest.fixture
+def stub_geocoder(monkeypatch):
+    """ Faulty stub geocoder, and param.json of static_functions pointing to it (chunks of 7 addresses) """
+
+    FaultyGeocoderHandler.statuses, FaultyGeocoderHandler.short_chunks = {}, set()
+    FaultyGeocoderHandler.posted_chunks = []
+    server, api_url = synthetic_data.start_stub_geocoder(synthetic_data.StubGeocoderHandler.bbox,
+                                                         FaultyGeocoderHandler)
+
+    test_param = copy.deepcopy(static_functions.param)
+    test_param["geocoding"].update({"api_url": api_url, "chunk_size": 7, "max_workers": 3, "max_retries": 2,
+                                    "backoff": 0, "timeout": 10})
+    monkeypatch.setattr(static_functions, "param", test_param)
+
+    yield FaultyGeocoderHandler
+    server.shutdown()
+
+
+@pytest.fixture
+def df_address(tmp_path):
+    """ 30 synthetic RPLS rows, with a shuffled index, read as geocode_with_api reads them """
+
+    csv_path = str(tmp_path / "rpls.csv")
+    synthetic_data.generate_rpls_csv(30, csv_path)
+    df = pd.read_csv(csv_path, sep=';', dtype=str, keep_default_na=False)
+    df.index = range(100, 130)[::-1]
+    return df
+
+
+def test_results_in_the_input_order(stub_geocoder, df_address):
+    df_geocoded = static_functions.geocode_address_with_api(df_address)
+
+    # 5 chunks sent concurrently, merged in the input order
+    assert len(stub_geocoder.posted_chunks) == 5
+    assert list(df_geocoded.index) == list(df_address.index)
+    assert list(df_geocoded.NUMAPPT) == list(df_address.NUMAPPT)
+    assert df_geocoded.latitude.ne('').all()
+
+
+def test_failed_chunk_is_sent_again(stub_geocoder, df_address):
+    stub_geocoder.statuses = {'7': [503, 429]}
+
+    df_geocoded = static_functions.geocode_address_with_api(df_address)
+
+    assert stub_geocoder.posted_chunks.count('7') == 3
+    assert list(df_geocoded.NUMAPPT) == list(df_address.NUMAPPT)
+
+
+def test_chunk_failing_after_every_attempt(stub_geocoder, df_address):
+    stub_geocoder.statuses = {'14': [503] * 3}
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        static_functions.geocode_address_with_api(df_address)
+    assert stub_geocoder.posted_chunks.count('14') == 3
+
+
+def test_client_error_is_not_sent_again(stub_geocoder, df_address):
+    stub_geocoder.statuses = {'0': [400, 400]}
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        static_functions.geocode_address_with_api(df_address)
+    assert stub_geocoder.posted_chunks.count('0') == 1
+
+
+def test_short_response_is_rejected(stub_geocoder, df_address):
+    stub_geocoder.short_chunks = {'21'}
+
+    with pytest.raises(ValueError, match="chunk 3 : 6 lines returned by the API for 7 addresses sent"):
+        static_functions.geocode_address_with_api(df_address)
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+Smoke test of the benchmark harness (benchmark.run_benchmark) : the whole pipeline on a small synthetic territory
+"""
+
+import copy
+import logging
+
+import pandas as pd
+
+from benchmark import run_benchmark
+from benchmark import synthetic_data
+from core import geocode_hlm_core
+from core import import_building
+from core import post_geocodage
+from core import static_functions
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+""" Classes / methods / functions """
+
+
+def test_synthetic_csv_has_the_rpls_columns(tmp_path):
+    csv_path = str(tmp_path / "rpls.csv")
+    synthetic_data.generate_rpls_csv(10, csv_path)
+
+    assert list(pd.read_csv(csv_path, sep=';', nrows=0).columns) == synthetic_data.rpls_columns
+
+
+def test_benchmark_runs_end_to_end(monkeypatch):
+    # configure_pipeline points the modules to temporary data : their param and output directory are restored
+    for module in [geocode_hlm_core, import_building, post_geocodage, static_functions,
+                   run_benchmark.geocoder_RPLS]:
+        monkeypatch.setattr(module, "param", copy.deepcopy(module.param))
+        if hasattr(module, "ch_output"):
+            monkeypatch.setattr(module, "ch_output", module.ch_output)
+
+    timings = run_benchmark.run_benchmark(100, 200)
+
+    assert set(timings) >= {"process_small_building", "geocode_hlm_run", "finding_nearest_neighbour",
+                            "connect_result_point_to_line", "generate_dashboard"}
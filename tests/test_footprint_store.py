@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+Footprint store (core.footprint_store) : geometries read back from the coordinate buffers
+"""
+
+import logging
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import MultiPolygon, Polygon, box
+
+from core import footprint_store
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+# A simple building, a building with a hole and a multipolygon building
+geometries = [box(3.0, 43.0, 3.001, 43.001),
+              Polygon(box(3.01, 43.0, 3.02, 43.01).exterior.coords,
+                      [box(3.012, 43.002, 3.014, 43.004).exterior.coords]),
+              MultiPolygon([box(3.03, 43.0, 3.031, 43.001), box(3.04, 43.0, 3.041, 43.001)])]
+
+""" Classes / methods / functions """
+
+
+@pytest.fixture
+def store(tmp_path):
+    gdf = gpd.GeoDataFrame({'id': [11, 12, 13]}, geometry=geometries, crs={'init': 'epsg:4326'})
+    footprint_store.FootprintStore.write(str(tmp_path), gdf, "source", 2154)
+    return footprint_store.FootprintStore(str(tmp_path))
+
+
+@pytest.mark.parametrize("vectorised", [True, False])
+def test_geometries_read_back(store, monkeypatch, vectorised):
+    if not vectorised:
+        monkeypatch.setattr(footprint_store, "shapely_polygons", None)
+
+    gdf = store.to_gdf(np.array([2, 0]))
+
+    assert list(gdf.id) == [13, 11]
+    assert gdf.geometry.iloc[0].equals(geometries[2]) and gdf.geometry.iloc[1].equals(geometries[0])
+    assert len(store.to_gdf()) == 3
+
+
+def test_projected_geometry_without_reprojection(store):
+    reference = gpd.GeoSeries(geometries, crs={'init': 'epsg:4326'}).to_crs({'init': 'epsg:2154'})
+
+    projected = store.projected_geometry()
+
+    assert list(projected.index) == [11, 12, 13]
+    for geometry, reference_geometry in zip(projected, reference):
+        assert geometry.symmetric_difference(reference_geometry).area == pytest.approx(0, abs=1e-6)
+
+
+def test_store_of_another_source_is_not_up_to_date(store, tmp_path):
+    assert footprint_store.FootprintStore.is_up_to_date(str(tmp_path), "source")
+    assert not footprint_store.FootprintStore.is_up_to_date(str(tmp_path), "another source")
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+On-disk cache of the geocoding results (core.geocoding_cache.GeocodingCache)
+"""
+
+import logging
+
+import pandas as pd
+import pytest
+
+from core import geocoding_cache
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+""" Classes / methods / functions """
+
+
+@pytest.fixture
+def df_address():
+    """ Two corrected RPLS addresses """
+    return pd.DataFrame({'NUMVOIE': ['1', '3'], 'INDREP': ['', 'B'], 'TYPVOIE': ['RUE', 'AV'],
+                         'NOMVOIE': ['DE LA GARE', 'JEAN JAURES'], 'CODEPOSTAL': ['11000', '11100'],
+                         'LIBCOM': ['CARCASSONNE', 'NARBONNE']})
+
+
+def test_address_not_found_is_not_stored(tmp_path, df_address):
+    cache = geocoding_cache.GeocodingCache(str(tmp_path / "cache.sqlite"), "1", 365)
+    df_geocoded = df_address.assign(latitude=['43.2', ''], longitude=['2.35', ''],
+                                    result_type=['housenumber', ''], result_score=['0.95', ''])
+
+    cache.store(df_geocoded)
+    df_cached, df_missing = cache.split_cached_address(df_address)
+
+    assert list(df_cached.NOMVOIE) == ['DE LA GARE']
+    assert df_cached.latitude.iloc[0] == '43.2'
+    assert list(df_missing.NOMVOIE) == ['JEAN JAURES']
+
+
+def test_results_of_two_engines_are_stored_apart(tmp_path, df_address):
+    cache_path = str(tmp_path / "cache.sqlite")
+    api_cache = geocoding_cache.GeocodingCache(cache_path, "1", 365, "api|https://api-adresse.data.gouv.fr/search/csv/")
+    local_cache = geocoding_cache.GeocodingCache(cache_path, "1", 365, "local|/data/adresses-11.csv")
+
+    api_cache.store(df_address.assign(latitude=['43.2', '43.18'], longitude=['2.35', '3.0'],
+                                      result_type=['housenumber', 'street']))
+    local_cache.store(df_address.iloc[:1].assign(latitude=['43.21'], longitude=['2.36'], result_type=['housenumber']))
+
+    assert list(api_cache.split_cached_address(df_address)[0].latitude) == ['43.2', '43.18']
+    df_cached, df_missing = local_cache.split_cached_address(df_address)
+    assert list(df_cached.latitude) == ['43.21']
+    assert list(df_missing.NOMVOIE) == ['JEAN JAURES']
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+Tiled download of the OSM buildings (core.osm_tiles), with a stub of the Overpass API
+"""
+
+import json
+import logging
+
+import os
+
+import pytest
+import requests
+from shapely.geometry import box
+
+from core import osm_tiles
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+# A square building (way 10) and a building relation with the same id, whose outer ring is split in two open ways
+# and which has an inner ring
+overpass_elements = [
+    {"type": "node", "id": 1, "lon": 3.000, "lat": 43.000},
+    {"type": "node", "id": 2, "lon": 3.001, "lat": 43.000},
+    {"type": "node", "id": 3, "lon": 3.001, "lat": 43.001},
+    {"type": "node", "id": 4, "lon": 3.000, "lat": 43.001},
+    {"type": "node", "id": 5, "lon": 3.0002, "lat": 43.0002},
+    {"type": "node", "id": 6, "lon": 3.0004, "lat": 43.0002},
+    {"type": "node", "id": 7, "lon": 3.0004, "lat": 43.0004},
+    {"type": "node", "id": 8, "lon": 3.0002, "lat": 43.0004},
+    {"type": "node", "id": 11, "lon": 3.005, "lat": 43.005},
+    {"type": "node", "id": 12, "lon": 3.006, "lat": 43.005},
+    {"type": "node", "id": 13, "lon": 3.006, "lat": 43.006},
+    {"type": "node", "id": 14, "lon": 3.005, "lat": 43.006},
+    {"type": "way", "id": 10, "nodes": [11, 12, 13, 14, 11], "tags": {"building": "yes"}},
+    {"type": "way", "id": 20, "nodes": [1, 2, 3]},
+    {"type": "way", "id": 21, "nodes": [1, 4, 3]},
+    {"type": "way", "id": 22, "nodes": [5, 6, 7, 8, 5]},
+    {"type": "relation", "id": 10, "tags": {"building": "yes", "type": "multipolygon"},
+     "members": [{"type": "way", "ref": 20, "role": "outer"}, {"type": "way", "ref": 21, "role": "outer"},
+                 {"type": "way", "ref": 22, "role": "inner"}]}]
+
+""" Classes / methods / functions """
+
+
+class StubResponse:
+    """ Response of the Overpass API stub """
+
+    def __init__(self, elements, remark=None, status_code=200):
+        result = {"elements": elements}
+        if remark:
+            result["remark"] = remark
+        self.content = json.dumps(result).encode('utf-8')
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError("{} error".format(self.status_code), response=self)
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+@pytest.fixture
+def overpass_failures():
+    """ Responses returned by the Overpass API stub before the tile elements """
+    return []
+
+
+@pytest.fixture
+def overpass_requests(monkeypatch, overpass_failures):
+    """ Replace the Overpass API by a stub returning overpass_elements for each tile, and record the requests """
+    requests = []
+
+    def post(url, data, timeout):
+        requests.append(data['data'])
+        return overpass_failures.pop(0) if overpass_failures else StubResponse(overpass_elements)
+
+    monkeypatch.setattr(osm_tiles.requests, "post", post)
+    return requests
+
+
+def downloader(cache_dir, offline=False):
+    return osm_tiles.OsmTileDownloader("http://overpass.stub/api/interpreter", str(cache_dir), tile_size=0.004,
+                                       max_workers=2, max_age_days=30, max_retries=2, backoff=0, offline=offline)
+
+
+def test_ring_assembled_from_open_ways():
+    rings = osm_tiles.assemble_rings([[1, 2, 3], [5, 4, 3], [5, 6, 1], [7, 8, 9]])
+
+    assert len(rings) == 1
+    assert rings[0][0] == rings[0][-1]
+    assert sorted(set(rings[0])) == [1, 2, 3, 4, 5, 6]
+
+
+def test_multipolygon_relation_split_in_open_ways():
+    polygons = osm_tiles.overpass_elements_to_polygons(overpass_elements)
+
+    relation = polygons[('relation', 10)]
+    assert len(relation.interiors) == 1
+    assert relation.area == pytest.approx(0.001 ** 2 - 0.0002 ** 2)
+    # The way with the same id is another building
+    assert polygons[('way', 10)].area == pytest.approx(0.001 ** 2)
+
+
+def test_tiles_are_stitched_deduplicated_and_cached(tmp_path, overpass_requests):
+    area = box(3.0, 43.0, 3.007, 43.007)
+
+    gdf = downloader(tmp_path).download(area)
+
+    # Each tile returns both buildings : they are kept once
+    assert len(overpass_requests) == 4
+    assert sorted(zip(gdf.osm_type, gdf.osm_id)) == [('relation', 10), ('way', 10)]
+
+    # Second download : every tile is read from the cache
+    cached_downloader = downloader(tmp_path)
+    assert len(cached_downloader.download(area)) == 2
+    assert len(overpass_requests) == 4
+    assert cached_downloader.count_cached_tile == 4
+
+
+def test_offline_mode_only_reads_the_cache(tmp_path, overpass_requests):
+    with pytest.raises(AssertionError):
+        downloader(tmp_path, offline=True).download(box(3.0, 43.0, 3.003, 43.003))
+    assert overpass_requests == []
+
+
+def test_response_with_a_remark_is_sent_again_and_not_cached(tmp_path, overpass_requests, overpass_failures):
+    overpass_failures.extend([StubResponse(overpass_elements[:3], remark="runtime error: Query timed out")] * 3)
+    tile_downloader = downloader(tmp_path)
+
+    with pytest.raises(osm_tiles.OverpassRemarkError):
+        tile_downloader.fetch_tile((3.0, 43.0, 3.004, 43.004))
+    assert len(overpass_requests) == 3
+    assert not [file_name for file_name in os.listdir(str(tmp_path)) if file_name.endswith('.json')]
+
+    # The next request returns the complete tile
+    assert len(tile_downloader.fetch_tile((3.0, 43.0, 3.004, 43.004))) == len(overpass_elements)
+
+
+def test_client_error_is_not_sent_again(tmp_path, overpass_requests, overpass_failures):
+    overpass_failures.append(StubResponse([], status_code=400))
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        downloader(tmp_path).fetch_tile((3.0, 43.0, 3.004, 43.004))
+    assert len(overpass_requests) == 1
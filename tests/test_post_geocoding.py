@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+Geocoding results joined to their nearest building (core.post_geocodage.PostGeocodeData.formatting_hlm_building_output)
+"""
+
+import logging
+
+import geopandas as gpd
+from shapely.geometry import Point, box
+
+from core import post_geocodage
+from core import static_functions
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+""" Classes / methods / functions """
+
+
+def test_building_geometries_keep_the_hlm_attributes(monkeypatch):
+    monkeypatch.setattr(static_functions, "export_layer", lambda gdf, output_path_and_name: None)
+
+    footprints = [box(3.0, 43.0, 3.001, 43.001), box(3.01, 43.0, 3.011, 43.001)]
+    gdf_building = gpd.GeoDataFrame({'id': [7, 8]}, geometry=[footprint.representative_point()
+                                                              for footprint in footprints], crs={'init': 'epsg:4326'})
+    gdf_building['geom_point'] = gdf_building.geometry
+    gdf_building['surf_geom'] = footprints
+    gdf_building.index = gdf_building.id
+
+    post_geocoder = post_geocodage.PostGeocodeData.__new__(post_geocodage.PostGeocodeData)
+    post_geocoder.gdf_building = gdf_building
+    post_geocoder.gdf_hlm = gpd.GeoDataFrame({'id': [0, 1], 'nearest_id': [8, 7], 'NUMAPPT': ['a', 'b']},
+                                             geometry=[Point(3.0105, 43.0005), Point(3.0005, 43.0005)],
+                                             crs={'init': 'epsg:4326'})
+
+    post_geocoder.formatting_hlm_building_output()
+
+    gdf_surf_geom = post_geocoder.gdf_surf_geom
+    assert list(gdf_surf_geom.id) == [0, 1]
+    assert list(gdf_surf_geom.NUMAPPT) == ['a', 'b']
+    assert gdf_surf_geom.geometry.iloc[0].equals(footprints[1])
+    assert gdf_surf_geom.geometry.iloc[1].equals(footprints[0])
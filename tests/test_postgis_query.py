@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+SQL queries of the PostGis building table (core.static_functions.building_query), built without database
+"""
+
+import copy
+import logging
+
+import pytest
+
+from core import static_functions
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+postgis_param = {"table_name": "schema.building", "epsg": "2154", "id_column": "id", "geom_column": "geom",
+                 "bbox": None, "commune_table": None, "commune_insee_column": "insee", "commune_geom_column": "geom",
+                 "update_column": None}
+
+""" Classes / methods / functions """
+
+
+@pytest.fixture
+def param(monkeypatch):
+    """ param.json of static_functions with the PostGis parameters of the tests """
+    test_param = copy.deepcopy(static_functions.param)
+    test_param["data"]["if_postgis"].update(postgis_param)
+    test_param["data"]["list_cod_insee"] = [1053, "11262"]
+    monkeypatch.setattr(static_functions, "param", test_param)
+    return test_param
+
+
+def test_rows_query_of_a_table_with_srid(param):
+    statement, query_param = static_functions.building_query(srid=2154)
+    query = str(statement)
+
+    assert query.startswith("SELECT b.id AS id, ST_AsBinary(ST_Transform(b.geom, 4326)) AS wkb_geometry "
+                            "FROM schema.building b")
+    assert "ST_SetSRID" not in query
+    assert "WHERE" not in query
+    assert query_param == {}
+
+
+def test_geometries_without_srid_are_set_to_the_layer_epsg(param):
+    param["data"]["if_postgis"]["bbox"] = [3.0, 43.1, 3.1, 43.2]
+    statement, query_param = static_functions.building_query(srid=0)
+    query = str(statement)
+
+    assert "ST_Transform(ST_SetSRID(b.geom, 2154), 4326)" in query
+    # The filter is compared to the raw column (SRID 0), to use the spatial index
+    assert "b.geom && ST_SetSRID(ST_Transform(ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, 4326), 2154), 0)" in query
+    assert query_param == {"xmin": 3.0, "ymin": 43.1, "xmax": 3.1, "ymax": 43.2}
+
+
+def test_filters_are_expressed_in_the_table_srid(param):
+    param["data"]["if_postgis"]["bbox"] = [3.0, 43.1, 3.1, 43.2]
+    query = str(static_functions.building_query(srid=3857)[0])
+
+    assert "b.geom && ST_Transform(ST_MakeEnvelope(:xmin, :ymin, :xmax, :ymax, 4326), 3857)" in query
+
+
+def test_tile_bbox_is_added_to_the_bbox_of_param(param):
+    param["data"]["if_postgis"]["bbox"] = [3.0, 43.1, 3.1, 43.2]
+    statement, query_param = static_functions.building_query(bbox=(3.02, 43.12, 3.04, 43.14), srid=2154)
+    query = str(statement)
+
+    assert query.count(" AND ") == 1
+    assert "ST_MakeEnvelope(:tile_xmin, :tile_ymin, :tile_xmax, :tile_ymax, 4326)" in query
+    assert query_param["tile_xmin"] == 3.02 and query_param["xmin"] == 3.0
+
+
+def test_commune_filter_with_zero_padded_insee_code(param):
+    param["data"]["if_postgis"]["commune_table"] = "admin.commune"
+    param["data"]["if_postgis"]["bbox"] = [3.0, 43.1, 3.1, 43.2]
+    statement, query_param = static_functions.building_query(srid=0)
+    query = str(statement)
+
+    assert "ST_Intersects(b.geom, (SELECT ST_SetSRID(ST_Transform(ST_Union(c.geom), 2154), 0) FROM admin.commune c " \
+           "WHERE c.insee IN" in query
+    # The commune filter replaces the bbox of param
+    assert "xmin" not in query_param
+    assert query_param["list_cod_insee"] == ("01053", "11262")
+
+
+def test_commune_geometry_column_of_param(param):
+    param["data"]["if_postgis"].update({"commune_table": "admin.commune", "commune_geom_column": "the_geom"})
+    query = str(static_functions.building_query(srid=2154)[0])
+
+    assert "(SELECT ST_Transform(ST_Union(c.the_geom), 2154) FROM admin.commune c" in query
+
+
+def test_extent_and_fingerprint_queries(param):
+    param["data"]["if_postgis"]["update_column"] = "updated_at"
+    extent_query = str(static_functions.building_query(select="extent", srid=0)[0])
+    fingerprint_query = str(static_functions.building_query(select="fingerprint", srid=2154)[0])
+
+    assert extent_query.startswith("SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM (SELECT "
+                                   "ST_Extent(ST_Transform(ST_SetSRID(b.geom, 2154), 4326)) AS e")
+    assert extent_query.endswith(") extent")
+    assert fingerprint_query == "SELECT count(*), max(b.updated_at) FROM schema.building b"
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+Parity of the vectorized RPLS pre-treatment (core.geocode_hlm_core) with the previous row-wise rules
+To be launched from the project directory (param.json is read by the core modules) :
+
+     python -m pytest tests
+"""
+
+import io
+import logging
+
+import pandas as pd
+import pytest
+
+from core import geocode_hlm_core
+from core import static_functions
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+address_columns = ['NUMVOIE', 'INDREP', 'TYPVOIE', 'NOMVOIE', 'CODEPOSTAL', 'LIBCOM']
+
+# One row by rule : hour formatted NUMVOIE (AM / AP), BIS / TER, duplicate address, street type repeated in the
+# street name, lieu-dit without number nor street type, accents, float / "n/m" numbers, '?' and INCONNUE values
+rpls_csv = u"""DEPCOM;NUMVOIE;INDREP;TYPVOIE;NOMVOIE;CODEPOSTAL;LIBCOM;LIEUDIT;SURFHAB
+11262;12;;RUE;RUE DE LA REPUBLIQUE;11100;NARBONNE;;65
+11262;9:00AM;;AV;DES ÉTANGS;11100;NARBONNE;;70
+11262;3:00AP;B;BD;BD GÉNÉRAL DE GAULLE;11100;NARBONNE;;48
+11262;5;B;RUE;DES ÉCOLES;11100;NARBONNE;;52
+11262;5;T;RUE;DES ÉCOLES;11100;NARBONNE;;40
+11262;5;B;RUE;DES ÉCOLES;11100;NARBONNE;;30
+11262;;;;LES MOULINS;11100;NARBONNE;LES MOULINS;80
+11262;;;LD;LD LA PRADE;11100;NARBONNE;LA PRADE;75
+11262;7/9;;IMP;DU MIDI ?;11100;NARBONNE;;55
+11262;14.0;;INCONNUE;CHEMIN DE L'ÉGLISE;11100;NARBONNE;;60
+11262;22;;;CHEMIN SAINT-PIERRE;11100;NARBONNE;;45
+"""
+
+""" Classes / methods / functions """
+
+
+def read_fixture():
+    """ Fixture rows, typed by pandas as read by the previous row-wise pre-treatment """
+    return pd.read_csv(io.StringIO(rpls_csv), sep=';')
+
+
+def read_rpls_csv(csv_path, chunk_size=4):
+    """ Rows of the commune 11262 read by GeocodeHlm.read_rpls_csv """
+    hlm = geocode_hlm_core.GeocodeHlm.__new__(geocode_hlm_core.GeocodeHlm)
+    return hlm.read_rpls_csv(csv_path, [11262], chunk_size)
+
+
+@pytest.fixture
+def rpls_csv_path(tmp_path):
+    csv_path = str(tmp_path / "rpls.csv")
+    with open(csv_path, 'w', encoding='utf-8') as csv_file:
+        csv_file.write(rpls_csv + u"11001;1;;RUE;DU PORT;11000;AUTRE COMMUNE;;50\n")
+    return csv_path
+
+
+def baseline_pretreatment(df_hlm):
+    """
+    Row-wise pre-treatment of the RPLS rows, as before the vectorization
+    (the chained assignments of the previous version are written with .at)
+
+    :param df_hlm: pd.DataFrame of RPLS rows
+    :return: corrected pd.DataFrame & dict of the error counters
+    """
+
+    df_hlm = df_hlm.copy()
+    dict_error = {}
+
+    # correct_street_name_time_format
+    df_hlm['NUMVOIE'] = df_hlm.NUMVOIE.astype(str).astype(object)
+    num_street_time_index = df_hlm.index[df_hlm.NUMVOIE.str.contains('AM|AP') == True]
+    dict_error["time format error"] = len(num_street_time_index)
+    for time_street_number in num_street_time_index:
+        if df_hlm.NUMVOIE.loc[time_street_number][-2:] == 'AM':
+            df_hlm.at[time_street_number, 'NUMVOIE'] = df_hlm.NUMVOIE.loc[time_street_number].split(':')[0]
+        elif df_hlm.NUMVOIE.loc[time_street_number][-2:] == 'AP':
+            df_hlm.at[time_street_number, 'NUMVOIE'] = int(
+                df_hlm.NUMVOIE.loc[time_street_number].split(':')[0]) + 12
+
+    # correct_type_street_is_in_name_street
+    type_street_error_count = 0
+    cut_name_list = df_hlm.NOMVOIE.str.split(' ')
+    for cut_name_index in cut_name_list.index:
+        try:
+            if cut_name_list[cut_name_index][0] == df_hlm.TYPVOIE[cut_name_index]:
+                df_hlm.at[cut_name_index, 'NOMVOIE'] = ' '.join(cut_name_list[cut_name_index][1:])
+                type_street_error_count += 1
+        except TypeError:
+            # Error caused by nan value in cut_name_list
+            pass
+    dict_error["duplicate street name"] = type_street_error_count
+
+    # drop_duplicate_address : number of housing & living space summed by address
+    df_hlm['nb'] = 1
+    df_hlm['temp_address'] = df_hlm.apply(lambda row: ' '.join(str(row[column]) for column in address_columns),
+                                          axis=1)
+    df_sum = df_hlm.groupby('temp_address')[['nb', 'SURFHAB']].sum()
+    count_address_before = len(df_hlm)
+    df_hlm = df_hlm.drop_duplicates(address_columns, keep='first')
+    df_hlm['nb'] = df_sum.nb.loc[df_hlm.temp_address].values
+    df_hlm['SURFHAB'] = df_sum.SURFHAB.loc[df_hlm.temp_address].values
+    dict_error["duplicate adress (drop)"] = count_address_before - len(df_hlm)
+    df_hlm = df_hlm.drop(columns=['temp_address'])
+
+    # patch_before_export
+    df_hlm['NUMVOIE'] = df_hlm.NUMVOIE.apply(lambda x: str(x).split('.')[0])
+    df_hlm['NUMVOIE'] = df_hlm.NUMVOIE.apply(lambda x: str(x).split('/')[0])
+    df_hlm['TYPVOIE'] = [u'' if typvoie == numvoie else typvoie for typvoie, numvoie in
+                         zip(df_hlm.TYPVOIE, df_hlm.NUMVOIE)]
+    df_hlm = static_functions.drop_value_in_column(df_hlm, 'TYPVOIE', 'INCONNUE', '')
+    for geocoding_cols in address_columns:
+        df_hlm = static_functions.drop_value_in_column(df_hlm, geocoding_cols, '?', 'E')
+        df_hlm = static_functions.drop_value_in_column(df_hlm, geocoding_cols, 'nan', '')
+
+    return df_hlm, dict_error
+
+
+def vectorized_pretreatment(df_hlm):
+    """
+    Pre-treatment of the RPLS rows by GeocodeHlm (without reading the csv nor exporting the result)
+
+    :param df_hlm: pd.DataFrame of RPLS rows
+    :return: corrected pd.DataFrame & dict of the error counters
+    """
+
+    hlm = geocode_hlm_core.GeocodeHlm.__new__(geocode_hlm_core.GeocodeHlm)
+    hlm.df_hlm = df_hlm.copy()
+    hlm.dict_error = {}
+    hlm.dict_count_entity = {}
+
+    hlm.correct_street_name_time_format()
+    hlm.correct_type_street_is_in_name_street()
+    hlm.drop_duplicate_address()
+    hlm.patch_before_export()
+    return hlm.df_hlm, hlm.dict_error
+
+
+def sorted_by_address(df_hlm):
+    """ Address columns, nb & SURFHAB, sorted by address (the order of the rows is not part of the rules) """
+    df_hlm = df_hlm[address_columns + ['nb', 'SURFHAB']].fillna('').astype(str)
+    return df_hlm.sort_values(address_columns).reset_index(drop=True)
+
+
+def test_time_format_numvoie(rpls_csv_path):
+    df_hlm, dict_error = vectorized_pretreatment(read_rpls_csv(rpls_csv_path))
+    numvoie = set(df_hlm.NUMVOIE)
+
+    assert dict_error["time format error"] == 2
+    assert {'9', '15'}.issubset(numvoie)
+    assert not any(':' in str(value) for value in numvoie)
+
+
+def test_street_type_in_street_name(rpls_csv_path):
+    df_hlm, dict_error = vectorized_pretreatment(read_rpls_csv(rpls_csv_path))
+
+    assert dict_error["duplicate street name"] == 3
+    assert set(df_hlm.NOMVOIE) >= {'DE LA REPUBLIQUE', u'GÉNÉRAL DE GAULLE', 'LA PRADE', 'LES MOULINS'}
+
+
+def test_bis_ter_are_distinct_addresses(rpls_csv_path):
+    df_hlm, dict_error = vectorized_pretreatment(read_rpls_csv(rpls_csv_path))
+    df_ecoles = df_hlm[df_hlm.NOMVOIE == u'DES ÉCOLES'].set_index('INDREP')
+
+    assert dict_error["duplicate adress (drop)"] == 1
+    assert df_ecoles.nb.astype(int).to_dict() == {'B': 2, 'T': 1}
+    assert df_ecoles.SURFHAB.astype(int).to_dict() == {'B': 82, 'T': 40}
+
+
+def test_parity_with_row_wise_pretreatment(rpls_csv_path):
+    df_vectorized, error_vectorized = vectorized_pretreatment(read_rpls_csv(rpls_csv_path))
+    df_baseline, error_baseline = baseline_pretreatment(read_fixture())
+
+    assert error_vectorized == error_baseline
+    pd.testing.assert_frame_equal(sorted_by_address(df_vectorized), sorted_by_address(df_baseline))
+
+
+def test_rows_of_the_commune_read_as_str(rpls_csv_path):
+    df_hlm = read_rpls_csv(rpls_csv_path)
+
+    assert len(df_hlm) == 11
+    assert df_hlm.DEPCOM.eq('11262').all() and df_hlm.NUMVOIE.iloc[0] == '12'
+    assert df_hlm.SURFHAB.dtype == float
+
+
+def test_latin_1_byte_after_the_detection_sample(rpls_csv_path, monkeypatch):
+    # The last chunk contains a latin-1 byte which the detection sample did not reach
+    with open(rpls_csv_path, 'ab') as csv_file:
+        csv_file.write(u"11262;30;;RUE;DE L'ÉTANG;11100;NARBONNE;;50\n".encode('latin-1'))
+    monkeypatch.setattr(geocode_hlm_core.GeocodeHlm, "detect_csv_encoding", staticmethod(lambda csv_path: 'utf-8'))
+
+    df_hlm = read_rpls_csv(rpls_csv_path)
+
+    assert len(df_hlm) == 12
+    assert df_hlm.NOMVOIE.iloc[-1] == u"DE L'ÉTANG"
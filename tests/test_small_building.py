@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Jun 19 19:00:00 2019
+
+@author: bdaniere
+
+Merge & drop of the small buildings (core.import_building.Building.process_small_building)
+"""
+
+import logging
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import box
+
+from core import import_building
+
+"""
+Globals variables
+"""
+logging.basicConfig(level=logging.INFO, format='%(asctime)s -- %(levelname)s -- %(message)s')
+
+# Squares in Lambert 93 (m) : a 20 m building with a 4 m annex on its east side, chained to a second 4 m annex,
+# an isolated 4 m building and an isolated 20 m building
+x0, y0 = 700000., 6230000.
+squares = {'building': box(x0, y0, x0 + 20, y0 + 20),
+           'annex': box(x0 + 20, y0, x0 + 24, y0 + 4),
+           'chained_annex': box(x0 + 24, y0, x0 + 28, y0 + 4),
+           'isolated_small': box(x0 + 100, y0, x0 + 104, y0 + 4),
+           'isolated': box(x0 + 200, y0, x0 + 220, y0 + 20)}
+
+""" Classes / methods / functions """
+
+
+@pytest.fixture
+def building(monkeypatch):
+    monkeypatch.setitem(import_building.param["data"], "small_building_area_m2", 30)
+    monkeypatch.setitem(import_building.param["data"], "repair_invalid_geometry", False)
+    monkeypatch.setitem(import_building.param["global"], "epsg", 2154)
+
+    building = import_building.Building()
+    building.gdf_building = gpd.GeoDataFrame({'id': list(squares)}, geometry=list(squares.values()),
+                                             crs={'init': 'epsg:2154'}).to_crs({'init': 'epsg:4326'})
+    building.process_small_building()
+    return building
+
+
+def test_annexes_are_merged_and_isolated_small_building_dropped(building):
+    assert sorted(building.gdf_building.id) == ['building', 'isolated']
+
+    area = dict(zip(building.gdf_building.id, building.get_projected_geometry().area))
+    assert area['building'] == pytest.approx(400 + 16 + 16, rel=1e-3)
+    assert area['isolated'] == pytest.approx(400, rel=1e-3)
+
+
+def test_projected_geometry_aligned_with_the_buildings(building):
+    projected = building.get_projected_geometry()
+    reference = building.gdf_building.to_crs({'init': 'epsg:2154'}).geometry
+
+    assert len(projected) == len(building.gdf_building)
+    for geometry, reference_geometry in zip(projected, reference):
+        assert geometry.symmetric_difference(reference_geometry).area == pytest.approx(0, abs=1e-3)
+
+
+def test_tiles_give_the_same_merge_and_warn_on_a_narrow_halo(monkeypatch, tmp_path, caplog):
+    monkeypatch.setitem(import_building.param["data"], "small_building_area_m2", 30)
+    monkeypatch.setitem(import_building.param["data"], "repair_invalid_geometry", False)
+    monkeypatch.setitem(import_building.param["data"], "osm_shp_postgis_building", "shp")
+    monkeypatch.setitem(import_building.param["global"], "epsg", 2154)
+    # The building and its annexes are owned by two tiles ; the halo is narrower than the 20 m buildings
+    monkeypatch.setitem(import_building.param["data"], "tile_processing",
+                        {"enabled": True, "tile_size_m": 22, "halo_m": 10, "tile_dir": str(tmp_path)})
+
+    gdf_layer = gpd.GeoDataFrame({'id': list(squares)}, geometry=list(squares.values()), crs={'init': 'epsg:2154'})
+
+    building = import_building.Building()
+    building.run_by_tile(lambda bounds: gdf_layer[gdf_layer.intersects(box(*bounds))].copy(),
+                         tuple(gdf_layer.total_bounds), gdf_layer.crs)
+
+    assert sorted(building.gdf_building.id) == ['building', 'isolated']
+    area = dict(zip(building.gdf_building.id, building.get_projected_geometry().area))
+    assert area['building'] == pytest.approx(400 + 16 + 16, rel=1e-3)
+    assert "building of 20 m, larger than the halo (10 m)" in caplog.text